@@ -0,0 +1,79 @@
+"""
+Import-time benchmark of the ctrace package.
+
+Short-lived jobs pay the import cost of the package on every start. This
+benchmark imports the package in fresh interpreters and fails if the import
+exceeds the startup budget, or if heavy dependencies are loaded eagerly.
+
+Usage:
+
+    python benchmarks/import_time.py [--budget-ms 50] [--data-budget-ms 300]
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+from typing import Dict, List
+
+# These dependencies must not be imported by `import ctrace` or by `import ctrace.data`.
+_heavy_modules = ["pyarrow", "pooch", "huggingface_hub", "numpy", "duckdb"]
+
+_probe = """
+import json, sys, time
+t = time.perf_counter()
+{stmt}
+elapsed = time.perf_counter() - t
+print(json.dumps({{"elapsed": elapsed, "modules": sorted(sys.modules)}}))
+"""
+
+
+def _measure(stmt: str, repeat: int) -> Dict:
+    """The best time of several fresh imports, and the imported modules."""
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run(  # noqa: S603
+            [sys.executable, "-c", _probe.format(stmt=stmt)],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        runs.append(json.loads(out.stdout))
+    return {
+        "elapsed": min(r["elapsed"] for r in runs),
+        "modules": runs[-1]["modules"],
+    }
+
+
+def main(argv: List[str]) -> int:
+    """Runs the checks and returns the exit code."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--budget-ms", type=float, default=50.0)
+    parser.add_argument("--data-budget-ms", type=float, default=300.0)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+    checks = [
+        ("import ctrace", args.budget_ms),
+        ("import ctrace.data", args.data_budget_ms),
+    ]
+    failed = False
+    for stmt, budget in checks:
+        res = _measure(stmt, args.repeat)
+        elapsed_ms = 1000 * res["elapsed"]
+        heavy = [
+            m
+            for m in _heavy_modules
+            if any(n.split(".")[0] == m for n in res["modules"])
+        ]
+        status = "ok"
+        if elapsed_ms > budget or heavy:
+            status = "FAILED"
+            failed = True
+        print(f"{stmt}: {elapsed_ms:.1f} ms (budget {budget:.0f} ms) {status}")
+        if heavy:
+            print(f"  eagerly imported: {heavy}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
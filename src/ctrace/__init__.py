@@ -6,11 +6,103 @@ released by the Climate TRACE Consortium.
 
 __version__ = "0.4.0"
 
-# Just importing everything, there are too many imported constants.
-from . import data
-from .data import (
-    read_country_emissions,
-    read_source_emissions,
-    recast_parquet,
-)
-from .enums import *
+import importlib
+import os
+from typing import Any, List
+
+# The environment variables of the runtime configuration (CTRACE_THREADS, ...)
+# must be applied before Polars and pyarrow are imported.
+if any(k.startswith("CTRACE_") for k in os.environ):
+    importlib.import_module(".runtime", __name__)._apply_env()
+
+# The submodules, functions and enumerations are loaded on first access, to keep
+# the import of the package fast. There are too many enumerations to list them all:
+# all the public attributes of `ctrace.enums` are available.
+_submodules = [
+    "cache",
+    "co2e",
+    "constants",
+    "data",
+    "dataset_catalog",
+    "diff",
+    "duckdb_engine",
+    "enums",
+    "grid",
+    "name_index",
+    "profiling",
+    "ranking",
+    "reconcile",
+    "regions",
+    "remote",
+    "runtime",
+    "sample",
+    "shards",
+    "stream",
+    "tensor",
+    "timeseries",
+    "tuning",
+    "uncertainty",
+    "validation",
+]
+# The functions available at the top level, with their submodule.
+_functions = {
+    "catalog": "dataset_catalog",
+    "read_country_emissions": "data",
+    "read_source_emissions": "data",
+    "recast_parquet": "data",
+    "search_sources": "name_index",
+}
+
+# The enumerations and the constants exported by `from ctrace import *`.
+_enum_names = [
+    "CO2E_20YR",
+    "CONFIDENCES",
+    "DOMESTIC_AVIATION",
+    "DOMESTIC_SHIPPING",
+    "ELECTRICITY_GENERATION",
+    "GAS",
+    "GAS_LIST",
+    "INTERNATIONAL_AVIATION",
+    "INTERNATIONAL_SHIPPING",
+    "INVENTORY_SECTORS",
+    "ISO3_COUNTRY",
+    "ORIGINAL_INVENTORY_SECTORS",
+    "ROAD_TRANSPORTATION",
+    "SECTOR",
+    "SECTORS",
+    "SUBSECTOR",
+    "SUBSECTORS",
+    "TEMPORAL_GRANULARITIES",
+    "TEMPORAL_GRANULARITY",
+    "column_enums",
+    "confidence_level_enum",
+    "gas_enum",
+    "inventory_sector_enum",
+    "iso3_enum",
+    "original_inventory_sector_enum",
+    "sector_enum",
+    "subsector_enum",
+    "temporal_granularity_enum",
+]
+# The names are resolved by `__getattr__` on the star import. Polars was exported
+# with the enumerations before they were loaded lazily, and still is.
+__all__ = ["constants", "data", "enums", "pl", *_functions, *_enum_names]
+
+
+def __getattr__(name: str) -> Any:
+    if name in _submodules:
+        return importlib.import_module(f".{name}", __name__)
+    if name in _functions:
+        module = importlib.import_module(f".{_functions[name]}", __name__)
+        return getattr(module, name)
+    if not name.startswith("_"):
+        enums = importlib.import_module(".enums", __name__)
+        if name in dir(enums):
+            return getattr(enums, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__() -> List[str]:
+    enums = importlib.import_module(".enums", __name__)
+    public_enums = [n for n in dir(enums) if not n.startswith("_")]
+    return sorted(set(globals()) | set(_submodules + list(_functions) + public_enums))
@@ -0,0 +1,464 @@
+"""
+The local cache of the downloaded data.
+
+All the downloaded files are stored under a single directory (see `cache_dir`):
+
+- archives/: the archives released by Climate TRACE (fetched with pooch)
+- hub/: the parquet files from the HuggingFace hub
+- blocks/: the blocks of the remote files (see `ctrace.remote`)
+
+Concurrent fetches of the same file, from several threads or processes, are
+serialized with file locks: the file is downloaded only once.
+
+The cache can be bounded in size with the `CTRACE_CACHE_MAX_SIZE` environment
+variable (in bytes, or with a K, M, G or T suffix). The least recently used files
+are then evicted after each download, starting with the files of the older
+versions of the dataset.
+
+The cache can also be inspected and pruned from the command line:
+
+    python -m ctrace.cache info
+    python -m ctrace.cache prune --max-size 50G
+    python -m ctrace.cache refresh
+
+The files of the HuggingFace hub are recorded in a manifest once downloaded.
+They are then resolved locally, without any network access, until they are
+explicitly refreshed. This also allows working offline.
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional
+
+from .constants import *
+from .data import version as _current_version
+
+if TYPE_CHECKING:
+    import pooch  # type: ignore
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore
+
+_logger = logging.getLogger(__name__)
+
+# The environment variables controlling the cache.
+CACHE_DIR_ENV = "CTRACE_CACHE_DIR"
+MAX_SIZE_ENV = "CTRACE_CACHE_MAX_SIZE"
+
+# The kinds of cached data
+ARCHIVE = "archive"
+HUB = "hub"
+BLOCKS = "blocks"
+
+_kind_dirs = {ARCHIVE: "archives", HUB: "hub", BLOCKS: "blocks"}
+
+# The dataset versions look like v3-2024 (archives) or v3-2024-ct5 (parquet files).
+_version_re = re.compile(r"v\d+-\d{4}(?:-ct\d+)?")
+
+# The year and gas of the source files.
+_source_file_re = re.compile(r"_(\d{4})_([a-z0-9_]+)\.parquet$")
+
+_lock_suffix = ".lock"
+_manifest_name = "manifest.json"
+
+# flock does not serialize the threads of a same process.
+_thread_locks: Dict[str, threading.Lock] = {}
+_thread_locks_lock = threading.Lock()
+
+
+def cache_dir() -> Path:
+    """
+    The root directory of the cache.
+
+    It is set by the `CTRACE_CACHE_DIR` environment variable, and defaults to the
+    cache directory of the operating system.
+    """
+    p = os.environ.get(CACHE_DIR_ENV)
+    if p:
+        return Path(p)
+    import pooch  # type: ignore
+
+    return Path(pooch.os_cache("ctrace"))
+
+
+def kind_dir(kind: str) -> Path:
+    """The directory of one kind of cached data."""
+    return cache_dir() / _kind_dirs[kind]
+
+
+@dataclass(frozen=True)
+class CacheEntry:
+    """
+    A file, or a directory of blocks, in the cache.
+
+    version: the version of the dataset, if it is known.
+    last_access: the time of the last access, in seconds since the epoch.
+    """
+
+    path: Path
+    kind: str
+    version: Optional[str]
+    size: int
+    last_access: float
+
+    def is_current(self) -> bool:
+        """True if the entry belongs to the current version of the dataset."""
+        return self.version is None or _current_version.startswith(self.version)
+
+
+@contextlib.contextmanager
+def lock(p: Path, blocking: bool = True) -> Iterator[bool]:
+    """
+    Holds an exclusive lock on the given path, across threads and processes.
+
+    The lock is a companion file next to the path. If blocking is False, yields
+    False instead of waiting when the lock is held by someone else.
+    """
+    lock_p = p.with_name(p.name + _lock_suffix)
+    lock_p.parent.mkdir(parents=True, exist_ok=True)
+    with _thread_locks_lock:
+        t_lock = _thread_locks.setdefault(str(lock_p), threading.Lock())
+    if not t_lock.acquire(blocking=blocking):
+        yield False
+        return
+    try:
+        with open(lock_p, "a") as f:
+            if fcntl is None:
+                _logger.warning("file locks are not supported on this platform")
+                yield True
+                return
+            flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            try:
+                fcntl.flock(f, flags)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+    finally:
+        t_lock.release()
+
+
+def touch(p: Path) -> None:
+    """Marks a cached file as used, for the eviction policy."""
+    with contextlib.suppress(FileNotFoundError):
+        os.utime(p)
+
+
+def fetch_archive(dset: "pooch.Pooch", name: str) -> Path:
+    """Fetches an archive with pooch, at most once across processes."""
+    p = Path(dset.abspath) / name
+    with lock(p):
+        local_p = Path(dset.fetch(name))
+    touch(local_p)
+    _auto_prune()
+    return local_p
+
+
+def fetch_hub(filename: str) -> Path:
+    """
+    Fetches a file of the dataset from the HuggingFace hub.
+
+    The files already in the manifest are returned without any network access.
+    Use `refresh` to check for updates of the cached files.
+    """
+    local_p = resolve(filename)
+    if local_p is not None:
+        touch(local_p)
+        return local_p
+    local_p = _download_hub(filename)
+    _update_manifest({filename: _manifest_entry(filename, local_p)})
+    _auto_prune()
+    return local_p
+
+
+def _download_hub(filename: str, force: bool = False) -> Path:
+    import huggingface_hub  # type: ignore
+
+    hub_p = kind_dir(HUB)
+    with lock(hub_p / filename):
+        local_p = Path(
+            huggingface_hub.hf_hub_download(
+                repo_id="tjhunter/climate-trace",
+                filename=filename,
+                repo_type="dataset",
+                local_dir=hub_p,
+                force_download=force,
+            )
+        )
+    touch(local_p)
+    return local_p
+
+
+def resolve(filename: str) -> Optional[Path]:
+    """
+    The local path of a file of the HuggingFace hub, or None if it is not cached.
+
+    This only reads the local manifest: it never accesses the network.
+    """
+    entry = read_manifest().get(filename)
+    if entry is not None:
+        local_p = cache_dir() / entry["path"]
+        if local_p.exists():
+            return local_p
+    # Files downloaded before the manifest existed.
+    local_p = kind_dir(HUB) / filename
+    if local_p.exists():
+        _update_manifest({filename: _manifest_entry(filename, local_p)})
+        return local_p
+    return None
+
+
+def refresh(filenames: Optional[List[str]] = None) -> List[str]:
+    """
+    Checks the cached files of the HuggingFace hub for updates, and downloads the
+    files that changed. Returns the names of the updated files.
+
+    filenames: the files to check, by default all the files of the manifest.
+    """
+    if filenames is None:
+        filenames = sorted(read_manifest())
+    updated = []
+    for filename in filenames:
+        before = resolve(filename)
+        before_st = before.stat() if before is not None else None
+        local_p = _download_hub(filename)
+        st = local_p.stat()
+        # An updated file is downloaded and moved in place: it gets a new inode.
+        if before_st is None or (before_st.st_ino, before_st.st_size) != (
+            st.st_ino,
+            st.st_size,
+        ):
+            updated.append(filename)
+        _update_manifest({filename: _manifest_entry(filename, local_p)})
+    return updated
+
+
+def _manifest_path() -> Path:
+    return cache_dir() / _manifest_name
+
+
+def read_manifest() -> Dict[str, Dict[str, Any]]:
+    """
+    The manifest of the cached files of the HuggingFace hub.
+
+    It maps the name of each file to its path (relative to the cache directory),
+    and to the version, year and gas of its data when they are known.
+    """
+    manifest_p = _manifest_path()
+    if not manifest_p.exists():
+        return {}
+    files: Dict[str, Dict[str, Any]] = json.loads(manifest_p.read_text())["files"]
+    return files
+
+
+def _update_manifest(updates: Dict[str, Optional[Dict[str, Any]]]) -> None:
+    """Adds, replaces or removes (if None) entries of the manifest."""
+    manifest_p = _manifest_path()
+    with lock(manifest_p):
+        files = read_manifest()
+        for filename, entry in updates.items():
+            if entry is None:
+                files.pop(filename, None)
+            else:
+                files[filename] = entry
+        manifest_p.parent.mkdir(parents=True, exist_ok=True)
+        tmp_p = manifest_p.with_name(f"{_manifest_name}.{os.getpid()}.tmp")
+        tmp_p.write_text(json.dumps({"files": files}, indent=1, sort_keys=True))
+        os.replace(tmp_p, manifest_p)
+
+
+def _manifest_entry(filename: str, local_p: Path) -> Dict[str, Any]:
+    m = _source_file_re.search(filename)
+    return {
+        "path": str(local_p.relative_to(cache_dir())),
+        "version": _parse_version(filename),
+        "year": int(m.group(1)) if m else None,
+        "gas": m.group(2) if m else None,
+    }
+
+
+def entries() -> List[CacheEntry]:
+    """All the entries of the cache."""
+    res: List[CacheEntry] = []
+    for kind in _kind_dirs:
+        kind_p = kind_dir(kind)
+        if not kind_p.exists():
+            continue
+        if kind == BLOCKS:
+            # One entry for all the blocks of a remote file.
+            for d in kind_p.iterdir():
+                if d.is_dir():
+                    res.append(_blocks_entry(d))
+            continue
+        for dirpath, dirnames, filenames in os.walk(kind_p):
+            # The download metadata of the HuggingFace hub.
+            dirnames[:] = [d for d in dirnames if d != ".cache"]
+            for n in filenames:
+                if n.endswith(_lock_suffix) or n.startswith("."):
+                    continue
+                p = Path(dirpath) / n
+                st = p.stat()
+                res.append(
+                    CacheEntry(
+                        path=p,
+                        kind=kind,
+                        version=_parse_version(str(p.relative_to(kind_p))),
+                        size=st.st_size,
+                        last_access=st.st_mtime,
+                    )
+                )
+    return res
+
+
+def _blocks_entry(d: Path) -> CacheEntry:
+    stats = [p.stat() for p in d.iterdir() if p.is_file()]
+    url_p = d / "url"
+    url = url_p.read_text() if url_p.exists() else ""
+    return CacheEntry(
+        path=d,
+        kind=BLOCKS,
+        version=_parse_version(url),
+        size=sum(st.st_size for st in stats),
+        last_access=max([st.st_mtime for st in stats], default=0.0),
+    )
+
+
+def _parse_version(s: str) -> Optional[str]:
+    m = _version_re.search(s)
+    return m.group(0) if m else None
+
+
+def prune(
+    max_size: Optional[int] = None,
+    keep_versions: Optional[List[str]] = None,
+    dry_run: bool = False,
+) -> List[CacheEntry]:
+    """
+    Evicts entries from the cache, and returns the evicted entries.
+
+    max_size: the maximum total size of the cache, in bytes. The entries of the
+      older versions of the dataset are evicted first, and then the least
+      recently used entries.
+    keep_versions: if provided, all the entries of the other versions are evicted.
+    dry_run: only returns the entries that would be evicted.
+
+    The files that are being downloaded are never evicted.
+    """
+    es = entries()
+    evicted: List[CacheEntry] = []
+    if keep_versions is not None:
+        evicted += [
+            e for e in es if e.version is not None and e.version not in keep_versions
+        ]
+    remaining = [e for e in es if e not in evicted]
+    if max_size is not None:
+        total = sum(e.size for e in remaining)
+        for e in sorted(remaining, key=lambda e: (e.is_current(), e.last_access)):
+            if total <= max_size:
+                break
+            evicted.append(e)
+            total -= e.size
+    if dry_run:
+        return evicted
+    res = []
+    for e in evicted:
+        with lock(e.path, blocking=False) as acquired:
+            if not acquired:
+                _logger.debug(f"skipping {e.path}: in use")
+                continue
+            _logger.debug(f"evicting {e.path}")
+            if e.path.is_dir():
+                shutil.rmtree(e.path, ignore_errors=True)
+            else:
+                e.path.unlink(missing_ok=True)
+            res.append(e)
+    hub_p = kind_dir(HUB)
+    stale = [
+        str(e.path.relative_to(hub_p)).replace(os.sep, "/")
+        for e in res
+        if e.kind == HUB
+    ]
+    if stale:
+        _update_manifest(dict.fromkeys(stale))
+    return res
+
+
+def _auto_prune() -> None:
+    max_size = os.environ.get(MAX_SIZE_ENV)
+    if max_size:
+        prune(max_size=parse_size(max_size))
+
+
+def parse_size(s: str) -> int:
+    """Parses a size in bytes, with an optional K, M, G or T suffix."""
+    s = s.strip().upper().removesuffix("B")
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    if s and s[-1] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+    return int(s)
+
+
+def _format_size(n: float) -> str:
+    for unit in ["B", "K", "M", "G"]:
+        if n < 1024:
+            return f"{n:.1f}{unit}"
+        n /= 1024
+    return f"{n:.1f}T"
+
+
+def _main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m ctrace.cache", description="Manages the ctrace cache."
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("info", help="lists the cache content by kind and version")
+    prune_p = sub.add_parser("prune", help="evicts entries from the cache")
+    prune_p.add_argument("--max-size", type=parse_size, default=None)
+    prune_p.add_argument("--keep-version", action="append", default=None)
+    prune_p.add_argument("--dry-run", action="store_true")
+    refresh_p = sub.add_parser("refresh", help="updates the cached files of the hub")
+    refresh_p.add_argument("filenames", nargs="*")
+    args = parser.parse_args(argv)
+    print(f"cache directory: {cache_dir()}")
+    if args.command == "info":
+        groups: Dict[tuple, List[CacheEntry]] = {}
+        for e in entries():
+            groups.setdefault((e.kind, e.version or "-"), []).append(e)
+        for (kind, v), es in sorted(groups.items()):
+            last = time.strftime(
+                "%Y-%m-%d %H:%M", time.localtime(max(e.last_access for e in es))
+            )
+            size = _format_size(sum(e.size for e in es))
+            print(f"{kind:8} {v:14} {len(es):5} entries {size:>8}  last used {last}")
+    elif args.command == "refresh":
+        updated = refresh(args.filenames or None)
+        print(f"updated {len(updated)} files")
+        for filename in updated:
+            print(f"  {filename}")
+    else:
+        evicted = prune(args.max_size, args.keep_version, args.dry_run)
+        verb = "would evict" if args.dry_run else "evicted"
+        size = _format_size(sum(e.size for e in evicted))
+        print(f"{verb} {len(evicted)} entries ({size})")
+        for e in evicted:
+            print(f"  {e.path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main(sys.argv[1:]))
@@ -0,0 +1,245 @@
+"""
+CO2 equivalent emissions derived from the emissions of CO2, CH4 and N2O.
+
+The co2e_100yr files restate the emissions of the other gases, weighted by
+their global warming potentials (GWP). Instead of reading them, the CO2
+equivalents can be computed at query time from the base gases, with any GWP
+table. This also gives the co2e_20yr emissions, which are not published.
+
+The derived gases are read with `derived=True` in `read_source_emissions` and
+`read_country_emissions`. `check_source_co2e` and `check_country_co2e` compare
+the published co2e_100yr emissions with the derived ones.
+"""
+
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+import polars as pl
+from polars import col as C
+
+from . import enums
+from .constants import *
+from .data import (
+    Frame,
+    _check_year,
+    read_country_emissions,
+    read_source_emissions,
+)
+
+_logger = logging.getLogger(__name__)
+
+# The weight of each base gas in a CO2 equivalent.
+GwpTable = Dict[Gas, float]
+
+# The global warming potentials of the IPCC Sixth Assessment Report (AR6).
+gwp_100yr: GwpTable = {CO2: 1.0, CH4: 29.8, N2O: 273.0}
+gwp_20yr: GwpTable = {CO2: 1.0, CH4: 82.5, N2O: 273.0}
+
+default_gwp: Dict[Gas, GwpTable] = {CO2E_100YR: gwp_100yr, CO2E_20YR: gwp_20yr}
+
+# The records of the base gases that make one record of a derived gas.
+source_keys = [SOURCE_ID, START_TIME]
+country_keys = [ISO3_COUNTRY, SUBSECTOR, START_TIME, END_TIME]
+
+# The columns that only make sense for a single gas. They are null for the
+# derived gases.
+_gas_columns = [EMISSIONS_FACTOR, EMISSIONS_FACTOR_UNITS, "conf_" + EMISSIONS_FACTOR]
+
+# Output columns
+PUBLISHED_EMISSIONS = "published_emissions"
+DERIVED_EMISSIONS = "derived_emissions"
+ABS_GAP = "abs_gap"
+REL_GAP = "rel_gap"
+
+
+def derive(
+    df: Frame,
+    gases: List[Gas],
+    keys: List[str],
+    gwp: Optional[Dict[Gas, GwpTable]] = None,
+) -> Frame:
+    """
+    Computes the emissions of the derived gases from the records of the base gases.
+
+    The records of the base gases are pivoted by `keys` in a single aggregation,
+    and each derived gas is a weighted sum of the base emissions. The other
+    columns are taken from one of the base records, except the confidence of the
+    emissions, which is the lowest of the base records, and the gas-specific
+    columns (emission factors), which are null.
+
+    gwp: the GWP table of each derived gas, replacing the default tables.
+
+    Returns the records of the derived gases, with the same columns as `df`.
+    """
+    tables = {**default_gwp, **(gwp or {})}
+    for g in gases:
+        assert g in tables, f"No GWP table for {g}. Known tables: {list(tables)}"
+    schema = df.collect_schema()
+    names = schema.names()
+    bases = sorted({b for g in gases for b in tables[g]})
+    conf_col = "conf_" + EMISSIONS_QUANTITY
+    other_aggs = []
+    for c in names:
+        if c in keys or c in [GAS, EMISSIONS_QUANTITY] or c in _gas_columns:
+            continue
+        other_aggs.append(C(c).max() if c == conf_col else C(c).first())
+    wide = (
+        df.filter(c_gas.cast(pl.String).is_in(bases))
+        .group_by(keys)
+        .agg(
+            *[
+                pl.when(c_gas == b).then(c_emissions_quantity).sum().alias(f"_{b}")
+                for b in bases
+            ],
+            c_emissions_quantity.count().alias("_count"),
+            *other_aggs,
+        )
+    )
+    dfs = []
+    for g in gases:
+        total = pl.sum_horizontal([C(f"_{b}") * w for (b, w) in tables[g].items()])
+        dfs.append(
+            wide.with_columns(
+                pl.lit(g, enums.gas_enum).alias(GAS),
+                pl.when(C("_count") > 0).then(total).alias(EMISSIONS_QUANTITY),
+                *[pl.lit(None, schema[c]).alias(c) for c in _gas_columns if c in names],
+            ).select(names)
+        )
+    return pl.concat(dfs)
+
+
+def read_sources(
+    gases: List[Gas],
+    year: Union[int, List[int], None] = None,
+    p: Union[Path, str, None] = None,
+    columns: Optional[List[str]] = None,
+    remote: bool = False,
+    gwp: Optional[Dict[Gas, GwpTable]] = None,
+) -> pl.LazyFrame:
+    """
+    The source emissions, with the derived gases computed from the base gases
+    (see `read_source_emissions`).
+    """
+    ys = _check_year(year)
+    dfs = []
+    read_gases = [g for g in gases if g not in DERIVED_GAS_LIST]
+    if read_gases:
+        dfs.append(read_source_emissions(read_gases, ys, p, columns, remote))
+    derived = [g for g in gases if g in DERIVED_GAS_LIST]
+    if derived:
+        base_cols = None
+        if columns is not None:
+            base_cols = list(
+                dict.fromkeys(source_keys + [GAS, EMISSIONS_QUANTITY] + columns)
+            )
+        base_df = read_source_emissions(_bases(derived, gwp), ys, p, base_cols, remote)
+        df = derive(base_df, derived, source_keys, gwp)
+        dfs.append(df if columns is None else df.select(columns))
+    return pl.concat(dfs)
+
+
+def read_countries(
+    gases: List[Gas],
+    archive_path: Union[Path, bool, None] = None,
+    parquet_path: Optional[Path] = None,
+    gwp: Optional[Dict[Gas, GwpTable]] = None,
+) -> pl.DataFrame:
+    """
+    The country emissions, with the derived gases computed from the base gases
+    (see `read_country_emissions`).
+    """
+    derived = [g for g in gases if g in DERIVED_GAS_LIST]
+    read_gases = [g for g in gases if g not in DERIVED_GAS_LIST]
+    df = read_country_emissions(
+        list(dict.fromkeys(read_gases + _bases(derived, gwp))),
+        archive_path,
+        parquet_path,
+    )
+    dfs = [df.filter(c_gas.cast(pl.String).is_in(read_gases))]
+    if derived:
+        dfs.append(derive(df, derived, country_keys, gwp))
+    return pl.concat(dfs)
+
+
+def check_co2e(
+    df: Frame,
+    keys: List[str],
+    gas: Gas = CO2E_100YR,
+    gwp: Optional[Dict[Gas, GwpTable]] = None,
+    rel_tol: float = 0.01,
+    abs_tol: float = 1.0,
+) -> pl.DataFrame:
+    """
+    The records where the published emissions of a CO2 equivalent gas disagree
+    with the emissions derived from the base gases.
+
+    df: the records of the base gases and of the published gas.
+    Returns, for each disagreeing key, the published and derived emissions and
+    their absolute and relative differences, the largest differences first.
+    Missing values mean that the key is absent on one side.
+    """
+    lf = df.lazy()
+    published = (
+        lf.filter(c_gas == gas)
+        .group_by(keys)
+        .agg(c_emissions_quantity.sum().alias(PUBLISHED_EMISSIONS))
+    )
+    derived = derive(lf, [gas], keys, gwp).select(
+        *keys, c_emissions_quantity.alias(DERIVED_EMISSIONS)
+    )
+    res = (
+        published.join(derived, on=keys, how="full", coalesce=True)
+        .with_columns(
+            (C(DERIVED_EMISSIONS) - C(PUBLISHED_EMISSIONS)).alias(ABS_GAP),
+        )
+        .with_columns(
+            (C(ABS_GAP) / C(PUBLISHED_EMISSIONS).abs()).alias(REL_GAP),
+        )
+        .filter(
+            C(PUBLISHED_EMISSIONS).is_null()
+            | C(DERIVED_EMISSIONS).is_null()
+            | ((C(ABS_GAP).abs() > abs_tol) & (C(REL_GAP).abs() > rel_tol))
+        )
+        .sort(by=C(ABS_GAP).abs(), descending=True, nulls_last=True)
+        .collect()
+    )
+    _logger.debug(f"{res.height} disagreements for {gas}")
+    return res
+
+
+def check_source_co2e(
+    year: Union[int, List[int], None] = None,
+    p: Union[Path, str, None] = None,
+    gwp: Optional[Dict[Gas, GwpTable]] = None,
+    rel_tol: float = 0.01,
+    abs_tol: float = 1.0,
+) -> pl.DataFrame:
+    """
+    The sources where the published co2e_100yr emissions disagree with the
+    emissions derived from the other gases (see `check_co2e`).
+    """
+    cols = source_keys + [GAS, EMISSIONS_QUANTITY]
+    df = read_source_emissions(GAS_LIST, year, p, columns=cols)
+    return check_co2e(df, source_keys, CO2E_100YR, gwp, rel_tol, abs_tol)
+
+
+def check_country_co2e(
+    archive_path: Union[Path, bool, None] = None,
+    parquet_path: Optional[Path] = None,
+    gwp: Optional[Dict[Gas, GwpTable]] = None,
+    rel_tol: float = 0.01,
+    abs_tol: float = 1.0,
+) -> pl.DataFrame:
+    """
+    The country emissions where the published co2e_100yr emissions disagree with
+    the emissions derived from the other gases (see `check_co2e`).
+    """
+    df = read_country_emissions(GAS_LIST, archive_path, parquet_path)
+    return check_co2e(df, country_keys, CO2E_100YR, gwp, rel_tol, abs_tol)
+
+
+def _bases(derived: List[Gas], gwp: Optional[Dict[Gas, GwpTable]]) -> List[Gas]:
+    """The base gases needed by the derived gases."""
+    tables = {**default_gwp, **(gwp or {})}
+    return [g for g in GAS_LIST if any(g in tables[d] for d in derived)]
@@ -16,32 +16,34 @@ c_subsector = C("subsector")
 
 # ***** GAS *****
 
-# TODO: currently supporting only CO2E_100YR.
 Gas = Literal[
     "co2",
     "ch4",
     "n2o",
     "co2e_100yr",
-    # "co2e_20yr"
+    "co2e_20yr",
 ]
 
 # Gas names:
 CO2: Gas = "co2"
-CH4 = "ch4"
-N2O = "n2o"
+CH4: Gas = "ch4"
+N2O: Gas = "n2o"
 CO2E_100YR: Gas = "co2e_100yr"
-CO2E_20YR = "co2e_20yr"
+CO2E_20YR: Gas = "co2e_20yr"
 
 
-# TODO: currently supporting only CO2E_100YR.
+# The gases published by Climate TRACE.
+# CO2E_20YR is not published: it is only derived from the other gases.
 GAS_LIST: List[Gas] = [
     CO2,
     CH4,
     N2O,
     CO2E_100YR,
-    # CO2E_20YR
 ]
 
+# The gases that can be derived from CO2, CH4 and N2O (see `ctrace.co2e`).
+DERIVED_GAS_LIST: List[Gas] = [CO2E_100YR, CO2E_20YR]
+
 
 ## ***** CONFIDENCE LEVELS *****
 VERY_HIGH = "very high"
@@ -54,6 +56,12 @@ CONFIDENCES = [VERY_HIGH, HIGH, MEDIUM, LOW, VERY_LOW]
 
 Confidence = Literal["very high", "high", "medium", "low", "very low"]
 
+## ***** COUNTRIES *****
+
+# The countries excluded from the dataset by the Climate TRACE documentation.
+# They used to be present in the releases until 2024-12.
+EXCLUDED_ISO3_COUNTRIES = ["XAD", "XCL", "XPI", "XSP"]
+
 
 # Extra columns for the confidence levels:
 # Gen code:
@@ -708,6 +716,31 @@ all_columns = [
     GEOMETRY_REF,
 ]
 
+# The low-use text columns of the source emissions.
+# They make up most of the columns but are rarely queried, so they are stored
+# in a separate companion file and only read when explicitly requested.
+text_columns = (
+    [
+        SOURCE_NAME,
+        EMISSIONS_FACTOR_UNITS,
+        CAPACITY_UNITS,
+        ACTIVITY_UNITS,
+    ]
+    + [f"other{i}" for i in range(1, 13)]
+    + [f"other{i}_def" for i in range(1, 13)]
+    + [GEOMETRY_REF]
+)
+
+# The columns of the sources that have a confidence level, in the conf_<column> columns.
+confidence_columns = [
+    SOURCE_TYPE,
+    CAPACITY,
+    CAPACITY_FACTOR,
+    ACTIVITY,
+    EMISSIONS_FACTOR,
+    EMISSIONS_QUANTITY,
+]
+
 c_source_id = C("source_id")
 c_iso3_country = C("iso3_country")
 c_original_inventory_sector = C("original_inventory_sector")
@@ -4,27 +4,51 @@ The data loading facilities for the ctrace package.
 The main functions are `read_country_emissions` and `read_source_emissions`.
 """
 
+import dataclasses
 import functools
+import json
 import logging
-import tempfile
 from pathlib import Path
-from typing import List, Optional, Tuple, TypeVar, Union
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    List,
+    Literal,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+    overload,
+)
 from zipfile import ZipFile
 
-import huggingface_hub  # type: ignore
-import huggingface_hub.file_download  # type: ignore
 import polars as pl
-import pooch  # type: ignore
 from polars import col as C
 
+from . import enums
 from .constants import *
-from .enums import *
+
+# The heavy dependencies (pyarrow, pooch, huggingface_hub) are only imported
+# when they are needed, to keep the import of the package fast.
+if TYPE_CHECKING:
+    import duckdb
+    import pooch  # type: ignore
+    import pyarrow.parquet
 
 _logger = logging.getLogger(__name__)
 
 # A union type for the polars dataframes
 Frame = TypeVar("Frame", pl.DataFrame, pl.LazyFrame)
 
+# A filter on the data, as a (column, operator, value) condition.
+# A list of filters means that all the conditions must hold. This is the
+# same convention as the `filters` argument of `pyarrow.parquet.read_table`.
+Filter = Tuple[str, str, Any]
+
+# The query engines of the read functions.
+Engine = Literal["polars", "duckdb"]
+
 
 # The archive files released by V3 of the Climate TRACE project
 # TODO: this is only CO2E_100YR, add the other gas later.
@@ -90,7 +114,9 @@ version = "v3-2024-ct5"
 years = list(range(2021, 2025))
 
 
-def _create_pooch(gas: Gas) -> pooch.Pooch:
+def _create_pooch(gas: Gas) -> "pooch.Pooch":
+    import pooch  # type: ignore
+
     # Some files are misnamed by the Climate TRACE project.
     # TODO: open a ticket to fix the names.
     urls = {}
@@ -101,9 +127,11 @@ def _create_pooch(gas: Gas) -> pooch.Pooch:
                 gas=gas, file=n2
             )
         )
+    from . import cache
+
     return pooch.create(
         # TODO: eventually allow versioning of the dataset
-        path=pooch.os_cache(f"climate_trace_{gas}"),
+        path=cache.kind_dir(cache.ARCHIVE) / gas,
         version="v3-2024",
         urls=urls,
         registry={n: None for n in _files[gas]},  # TODO
@@ -112,15 +140,62 @@ def _create_pooch(gas: Gas) -> pooch.Pooch:
 
 
 @functools.cache
-def _ct_dset(gas: Gas) -> pooch.Pooch:
+def _ct_dset(gas: Gas) -> "pooch.Pooch":
     return _create_pooch(gas)
 
 
+# The file names of the source emissions, relative to the root directory.
+# The core file holds the numerical and enumerated columns. The text file is a
+# companion holding the `text_columns`, aligned row by row with the core file.
+_source_fname = "{version}/climate_trace-sources_{version}_{year}_{gas}.parquet"
+_source_text_fname = (
+    "{version}/climate_trace-sources-text_{version}_{year}_{gas}.parquet"
+)
+
+
+@overload
 def read_source_emissions(
     gas: Union[Gas, List[Gas]],
     year: Union[int, List[int], None] = None,
-    p: Optional[Path] = None,
-) -> pl.LazyFrame:
+    p: Union[Path, str, None] = None,
+    columns: Optional[List[str]] = None,
+    remote: bool = False,
+    engine: Literal["polars"] = "polars",
+    con: Optional["duckdb.DuckDBPyConnection"] = None,
+    derived: bool = False,
+    gwp: Optional[Dict[Gas, Dict[Gas, float]]] = None,
+    approximate: Union[bool, float] = False,
+) -> pl.LazyFrame: ...
+
+
+@overload
+def read_source_emissions(
+    gas: Union[Gas, List[Gas]],
+    year: Union[int, List[int], None] = None,
+    p: Union[Path, str, None] = None,
+    columns: Optional[List[str]] = None,
+    remote: bool = False,
+    *,
+    engine: Literal["duckdb"],
+    con: Optional["duckdb.DuckDBPyConnection"] = None,
+    derived: bool = False,
+    gwp: Optional[Dict[Gas, Dict[Gas, float]]] = None,
+    approximate: Union[bool, float] = False,
+) -> "duckdb.DuckDBPyRelation": ...
+
+
+def read_source_emissions(
+    gas: Union[Gas, List[Gas]],
+    year: Union[int, List[int], None] = None,
+    p: Union[Path, str, None] = None,
+    columns: Optional[List[str]] = None,
+    remote: bool = False,
+    engine: Engine = "polars",
+    con: Optional["duckdb.DuckDBPyConnection"] = None,
+    derived: bool = False,
+    gwp: Optional[Dict[Gas, Dict[Gas, float]]] = None,
+    approximate: Union[bool, float] = False,
+) -> Union[pl.LazyFrame, "duckdb.DuckDBPyRelation"]:
     """
     Read all the source emissions data from the given path, assuming
     the source emissions have already been compacted into parquet files.
@@ -137,93 +212,328 @@ def read_source_emissions(
     The path points to the directory holding the parquet files.
     If None, the data is read from the default location.
 
+    The columns restrict the data to the given columns. The low-use text columns
+    (see `text_columns`) are stored in a separate file, which is only read if
+    some of these columns are requested. If None, all the columns are read,
+    including the text columns. Selecting the columns here rather than on the
+    returned frame avoids reading the text columns altogether.
+
+    If remote is True, the files are not downloaded: only the row groups and
+    columns needed by the query are fetched with HTTP range requests, and
+    kept in a local block cache (see `ctrace.remote`). This is much faster for
+    selective queries. The path is then the base URL of the files, or None for
+    the default location.
+
+    If engine is "duckdb", a DuckDB relation over the same files is returned
+    instead, with the enumerated columns as DuckDB ENUM types (see
+    `ctrace.duckdb_engine`). Only the files of the requested gases and years are
+    read. The queries are run on the given connection, or on a default in-memory
+    connection. Use `ctrace.duckdb_engine.connect` to set a memory limit.
+
+    If derived is True, the CO2 equivalent gases (co2e_100yr and co2e_20yr) are
+    computed from the base gases instead of being read, with the given GWP tables
+    or the default ones (see `ctrace.co2e`).
+
+    If approximate is True (or a sampling rate), the stratified samples written
+    next to the files are read instead (see `ctrace.sample`), with the columns
+    needed by `ctrace.sample.estimate` to estimate the counts, sums and means
+    with their error bounds.
     """
     ys = _check_year(year)
-    gases = _check_gas(gas)
-    fname = "{version}/climate_trace-sources_{version}_{year}_{gas}.parquet"
+    gases = _check_gas(gas, derived)
+    assert engine in ("polars", "duckdb"), engine
+    if approximate is not False:
+        assert engine == "polars", "The samples are only supported with Polars"
+        assert not remote and not derived, "The samples are only read locally"
+        from . import sample
+
+        rate = sample.sample_rates[0] if approximate is True else float(approximate)
+        return sample.read_sample(gases, ys, p, rate, columns)
+    if derived:
+        assert engine == "polars", "The derived gases are only supported with Polars"
+        from . import co2e
+
+        return co2e.read_sources(gases, ys, p, columns, remote, gwp)
+    if engine == "duckdb":
+        assert not remote, "The remote mode is not supported with DuckDB"
+        from . import duckdb_engine
+
+        files = []
+        for year_ in ys:
+            for gas_ in gases:
+                core_p = _source_path(_source_fname, year_, gas_, p)
+                core_cols = list(pl.read_parquet_schema(core_p).keys())
+                (sel_cols, sel_text_cols) = _source_columns(core_cols, columns)
+                text_p = (
+                    _source_path(_source_text_fname, year_, gas_, p)
+                    if sel_text_cols
+                    else None
+                )
+                files.append((core_p, text_p, sel_cols, sel_text_cols))
+        return duckdb_engine.source_relation(files, con)
+    dfs = [
+        _scan_source_file(year_, gas_, p, columns, remote)
+        for year_ in ys
+        for gas_ in gases
+    ]
+    return pl.concat(dfs)
+
+
+def _source_path(
+    fname: str,
+    year: int,
+    gas: Gas,
+    p: Union[Path, str, None],
+    dataset_version: Optional[str] = None,
+) -> Path:
+    name = fname.format(year=year, version=dataset_version or version, gas=gas)
     if p is None:
-        local_paths = [
-            huggingface_hub.file_download.hf_hub_download(
-                repo_id="tjhunter/climate-trace",
-                filename=fname.format(year=year_, version=version, gas=gas),
-                repo_type="dataset",
-            )
-            for year_ in ys
-            for gas in gases
-        ]
+        from . import cache
+
+        return cache.fetch_hub(name)
+    return Path(p) / name
+
+
+def _source_url(
+    fname: str,
+    year: int,
+    gas: Gas,
+    p: Union[Path, str, None],
+) -> str:
+    name = fname.format(year=year, version=version, gas=gas)
+    if p is None:
+        import huggingface_hub  # type: ignore
+
+        return huggingface_hub.hf_hub_url(
+            repo_id="tjhunter/climate-trace",
+            filename=name,
+            repo_type="dataset",
+        )
+    return f"{str(p).rstrip('/')}/{name}"
+
+
+def _scan_source_file(
+    year: int,
+    gas: Gas,
+    p: Union[Path, str, None],
+    columns: Optional[List[str]],
+    remote: bool = False,
+) -> pl.LazyFrame:
+    from . import remote as remote_
+
+    def scan(fname: str) -> pl.LazyFrame:
+        if remote:
+            return remote_.scan_remote_parquet(_source_url(fname, year, gas, p))
+        return pl.scan_parquet(_source_path(fname, year, gas, p))
+
+    if remote:
+        core_url = _source_url(_source_fname, year, gas, p)
+        core_cols = remote_.read_remote_parquet_schema(core_url)
     else:
-        local_paths = [
-            Path(p) / fname.format(gas=gas, year=year_, version=version)
-            for year_ in ys
-            for gas in gases
-        ]
-    return pl.concat(
-        [
-            pl.scan_parquet(local_p).pipe(recast_parquet, conf=True)
-            for local_p in local_paths
-        ]
-    )
+        core_p = _source_path(_source_fname, year, gas, p)
+        core_cols = list(pl.read_parquet_schema(core_p).keys())
+    (sel_cols, sel_text_cols) = _source_columns(core_cols, columns)
+    df = scan(_source_fname)
+    if sel_text_cols:
+        # Both files are written in the same order: they can be stitched by row position.
+        text_df = scan(_source_text_fname).select(sel_text_cols)
+        df = pl.concat([df, text_df], how="horizontal_extend")
+    df = df.pipe(recast_parquet, conf=True)
+    return df.select(sel_cols)
+
 
+def _source_columns(
+    core_cols: List[str], columns: Optional[List[str]]
+) -> Tuple[List[str], List[str]]:
+    """The selected columns, and the selected columns stored in the text file."""
+    # Older releases store all the columns in a single file.
+    text_cols = [c for c in text_columns if c not in core_cols]
+    if columns is None:
+        sel_cols = core_cols + text_cols
+    else:
+        sel_cols = list(columns)
+    sel_text_cols = [c for c in sel_cols if c in text_cols]
+    return (sel_cols, sel_text_cols)
 
-def load_source_compact(p: Optional[Path] = None) -> Tuple[pl.LazyFrame, List[Path]]:
+
+@dataclasses.dataclass(frozen=True)
+class WriterConfig:
+    """
+    The layout and the encodings of the source files (see `write_source_file`).
+
+    sort_by: the columns the records are sorted by. The row groups of a file can
+      only be skipped on the leading columns.
+    compression, compression_level: the codec of the pages, and its level (None
+      for the default level of the codec).
+    row_group_size: the maximum number of rows of a row group.
+    data_page_size: the target size of the data pages in bytes (None for the
+      default of pyarrow).
+    dictionary: if False, the float columns are not dictionary encoded. The other
+      columns always are.
+    byte_stream_split: if True, the float columns use the BYTE_STREAM_SPLIT
+      encoding instead of the dictionary encoding.
+
+    `ctrace.tuning.tune` recommends a configuration for a given dataset.
+    """
+
+    sort_by: Tuple[str, ...] = (SUBSECTOR,)
+    compression: str = "zstd"
+    compression_level: Optional[int] = None
+    row_group_size: int = 1_000_000
+    data_page_size: Optional[int] = None
+    dictionary: bool = True
+    byte_stream_split: bool = False
+
+    def to_json(self) -> str:
+        """The configuration as a JSON object."""
+        return json.dumps(dataclasses.asdict(self))
+
+    @classmethod
+    def from_json(cls, s: str) -> "WriterConfig":
+        """The configuration written by `to_json`."""
+        d = json.loads(s)
+        d["sort_by"] = tuple(d["sort_by"])
+        return cls(**d)
+
+
+def write_source_file(
+    df: pl.LazyFrame,
+    gas: Gas,
+    year: int,
+    p: Path,
+    sample_rates: Optional[List[float]] = None,
+    config: Optional[WriterConfig] = None,
+) -> Tuple[Path, Path]:
+    """
+    Writes the source emissions of one year and one gas in the layout expected by
+    `read_source_emissions`, and returns the paths to the written files.
+
+    The data is sorted by subsector, so that queries on a subsector can skip
+    most of the row groups. The low-use text columns (see `text_columns`) are
+    written to a companion file, aligned row by row with the main file. The
+    catalog of the file and the names of its sources are written next to it (see
+    `ctrace.dataset_catalog` and `ctrace.name_index`).
+
+    sample_rates: if given, the stratified samples of the file at these rates are
+      also written next to it, for the approximate queries (see `ctrace.sample`).
+    config: the layout and the encodings of the files (see `WriterConfig`). The
+      records are first sorted into a temporary file with fixed, fast settings,
+      which the configuration does not change.
+    """
+    config = config or WriterConfig()
+    core_p = Path(p) / _source_fname.format(version=version, year=year, gas=gas)
+    text_p = Path(p) / _source_text_fname.format(version=version, year=year, gas=gas)
+    core_p.parent.mkdir(parents=True, exist_ok=True)
+    from . import runtime
+
+    with runtime.scratch("write") as tmp_dir:
+        local_pq = tmp_dir / "temp.parquet"
+        _logger.debug(f"writing source file for year={year} gas={gas} {local_pq}")
+        (
+            df.pipe(recast_parquet, conf=True)
+            .sort(by=list(config.sort_by), maintain_order=True)
+            .sink_parquet(
+                local_pq,
+                compression="zstd",
+                maintain_order=True,
+                statistics=True,
+                compression_level=2,
+                row_group_size=300_000,
+                data_page_size=10_000_000,
+            )
+        )
+        # Polars creates very fragmented files. The final files are rewritten
+        # with pyarrow with fewer, larger row groups.
+        import pyarrow.parquet
+
+        pq_file = pyarrow.parquet.ParquetFile(local_pq)
+        names = pq_file.schema_arrow.names
+        core_cols = [c for c in names if c not in text_columns]
+        text_cols = [c for c in names if c in text_columns]
+        for cols, out_p in [(core_cols, core_p), (text_cols, text_p)]:
+            _logger.debug(f"final source file: {out_p}")
+            _rewrite_parquet(pq_file, cols, out_p, config)
+    from . import dataset_catalog
+
+    dataset_catalog.write_file_catalog(core_p, text_p, year, gas, p)
+    from . import name_index
+
+    name_index.write_file_names(core_p, text_p, year, gas, p)
+    if sample_rates:
+        from . import sample
+
+        sample.write_sample_files(core_p, year, gas, p, sample_rates)
+    return (core_p, text_p)
+
+
+def _rewrite_parquet(
+    pq_file: "pyarrow.parquet.ParquetFile",
+    columns: List[str],
+    out_p: Path,
+    config: WriterConfig,
+) -> None:
+    import pyarrow
+    import pyarrow.parquet
+
+    schema = pq_file.schema_arrow
+    schema = pyarrow.schema([schema.field(c) for c in columns])
+    float_cols = [f.name for f in schema if pyarrow.types.is_floating(f.type)]
+    # The dictionary encoding takes precedence over the byte stream split.
+    dict_cols = [
+        f.name
+        for f in schema
+        if f.name not in float_cols
+        or (config.dictionary and not config.byte_stream_split)
+    ]
+    with pyarrow.parquet.ParquetWriter(
+        out_p,
+        schema,
+        compression=config.compression,
+        compression_level=config.compression_level,
+        use_dictionary=dict_cols,
+        use_byte_stream_split=float_cols if config.byte_stream_split else False,
+        data_page_size=config.data_page_size,
+        write_statistics=True,
+    ) as writer:
+        # Batches are read in order, which keeps the two files aligned.
+        for batch in pq_file.iter_batches(
+            batch_size=config.row_group_size, columns=columns, use_threads=True
+        ):
+            writer.write_batch(batch, row_group_size=config.row_group_size)
+
+
+def load_source_compact(
+    p: Optional[Path] = None, scratch: Optional[Path] = None
+) -> Tuple[pl.LazyFrame, List[Path]]:
     """
     Reads the source emissions data from the given path and creates
     a compacted view in Polars.
+
+    The intermediate files are written to the scratch directory, or by default
+    to a new directory of this process, which is removed when the process exits
+    (see `ctrace.runtime`). Pass a directory to keep them.
     """
     # Polars still has some issues with memory, especially because we are
     # joining the confidence while scanning the data.
     # The current strategy is to read eagerly each subsector, write them
     # to parquet in temporary files and then reload the full dataframe lazily..
-    # TODO: replace by a proper temp directory
-    tmp_dir = Path(tempfile.gettempdir())
+    from . import runtime
+
+    tmp_dir = Path(scratch) if scratch is not None else runtime.scratch_dir("compact")
     data_files: List[Path] = []
     p = p or True
     for gas in GAS_LIST:
         for fname in _files[gas]:
             _logger.debug(f"Opening path {fname} {gas}")
             (zf, _) = _get_zip(p, gas, fname)
-            source_names_l = [n for n in zf.namelist() if n.endswith("sources.csv")]
-            # The zip files do not seem to have been created correctly and some
-            # entries are duplicated.
-            source_names = sorted(set(source_names_l))
-            _logger.debug(f"sources:{gas}: {fname} -> {source_names}")
-            for sname in source_names:
-                _logger.debug(f"opening {fname} / {sname}")
+            for sname in _archive_members(zf):
                 tmp_name = (
                     tmp_dir
                     / gas
                     / sname.replace(".csv", ".parquet").replace("DATA/", "")
                 )
-
-                c_name = sname.replace(
-                    "_emissions_sources.csv", "_emissions_sources_confidence.csv"
-                )
-                _logger.debug(f"opening {fname} / {sname} and {c_name}")
-                df = _load_source_conf(zf.open(sname), zf.open(c_name))
-                # Remove all the empty strings, this provides better statistics and
-                # removes unnecessary string compression.
-                df = df.with_columns(
-                    [
-                        pl.when(pl.col(pl.Utf8).str.len_bytes() == 0)
-                        .then(None)
-                        .otherwise(pl.col(pl.Utf8))
-                        .name.keep()
-                    ]
-                )
-                _logger.debug(f"writing {tmp_name}")
-                # Create directories if they do not exist
-                tmp_name.parent.mkdir(parents=True, exist_ok=True)
-                # Making large groups because they will be broken into smaller
-                # during the split by year.
-                df.write_parquet(
-                    tmp_name,
-                    compression="zstd",
-                    statistics=True,
-                    row_group_size=2_000_000,
-                    use_pyarrow=True,
-                )
+                _write_member(zf, sname, tmp_name)
                 data_files.append(tmp_name)
-                _logger.debug(f"wrote {tmp_name}")
     dfs: List[pl.LazyFrame] = []
     for tmp_name in data_files:
         _logger.debug(f"scan {tmp_name}")
@@ -234,6 +544,51 @@ def load_source_compact(p: Optional[Path] = None) -> Tuple[pl.LazyFrame, List[Pa
     return res_df, data_files
 
 
+def _archive_members(zf: ZipFile) -> List[str]:
+    """The sorted source files of an archive."""
+    source_names_l = [n for n in zf.namelist() if n.endswith("sources.csv")]
+    # The zip files do not seem to have been created correctly and some
+    # entries are duplicated.
+    source_names = sorted(set(source_names_l))
+    _logger.debug(f"sources: {zf.filename} -> {source_names}")
+    return source_names
+
+
+def _write_member(zf: ZipFile, sname: str, out_p: Path) -> None:
+    """
+    Writes the records of a source file of an archive, joined with their
+    confidence, to a parquet file.
+    """
+    c_name = sname.replace(
+        "_emissions_sources.csv", "_emissions_sources_confidence.csv"
+    )
+    _logger.debug(f"opening {zf.filename} / {sname} and {c_name}")
+    df = _load_source_conf(zf.open(sname), zf.open(c_name))
+    # Remove all the empty strings, this provides better statistics and
+    # removes unnecessary string compression.
+    df = df.with_columns(
+        [
+            pl.when(pl.col(pl.Utf8).str.len_bytes() == 0)
+            .then(None)
+            .otherwise(pl.col(pl.Utf8))
+            .name.keep()
+        ]
+    )
+    _logger.debug(f"writing {out_p}")
+    # Create directories if they do not exist
+    out_p.parent.mkdir(parents=True, exist_ok=True)
+    # Making large groups because they will be broken into smaller
+    # during the split by year.
+    df.write_parquet(
+        out_p,
+        compression="zstd",
+        statistics=True,
+        row_group_size=2_000_000,
+        use_pyarrow=True,
+    )
+    _logger.debug(f"wrote {out_p}")
+
+
 def _load_csv(
     filter,
     cols: Optional[List[str]] = None,
@@ -270,7 +625,9 @@ def _load_csv(
 
 def _get_zip(p: Union[Path, bool, None], gas: Gas, name: str) -> Tuple[ZipFile, Path]:
     if p == True:
-        local_p = _ct_dset(gas).fetch(name)
+        from . import cache
+
+        local_p = cache.fetch_archive(_ct_dset(gas), name)
     else:
         local_p = p / gas / name
     return (ZipFile(local_p), local_p)
@@ -294,44 +651,42 @@ def _load_source_conf(s_fp, c_fp) -> pl.DataFrame:
 
 def _load_source_confidence(fp) -> pl.DataFrame:
     dates = [START_TIME, END_TIME, CREATED_DATE, MODIFIED_DATE]
-    cf_cols = [
-        SOURCE_TYPE,
-        CAPACITY,
-        CAPACITY_FACTOR,
-        ACTIVITY,
-        EMISSIONS_FACTOR,
-        EMISSIONS_QUANTITY,
-    ]
+    cf_cols = confidence_columns
     # Even with Polars, loading large CSV files is memory intensive.
     _logger.debug(f"loading source conf {fp}")
     # TODO: make it lazy
+    # The enumerations are validated by the reader. The other low-cardinality
+    # columns are read as categoricals, and converted by distinct value.
+    init_schema: Dict[str, Any] = {
+        **dict.fromkeys(dates + cf_cols, pl.Categorical),
+        ISO3_COUNTRY: enums.iso3_enum,
+        SECTOR: enums.sector_enum,
+        SUBSECTOR: enums.subsector_enum,
+        GAS: enums.gas_enum,
+        SOURCE_ID: pl.UInt64,
+    }
     df = pl.read_csv(
         fp.read(),
         has_header=True,
         infer_schema_length=0,
         infer_schema=False,
+        schema_overrides=init_schema,
         try_parse_dates=False,
-        rechunk=False,
         low_memory=True,
         batch_size=100_000,
     ).shrink_to_fit()  # .lazy()
     _logger.debug(f"columns: {df.columns}")
-    sels = (
-        [_parse_date(col_name) for col_name in dates]
-        + [
-            c_iso3_country.cast(iso3_enum).alias(ISO3_COUNTRY),
-            c_source_id.cast(pl.UInt64).alias(SOURCE_ID),
-            c_sector.cast(sector_enum).alias(SECTOR),
-            c_subsector.cast(subsector_enum).alias(SUBSECTOR),
-            c_gas.cast(gas_enum).alias(GAS),
-        ]
-        + [
-            C(col_name)
-            .cast(confidence_level_enum, strict=False)
-            .alias("conf_" + col_name)
-            for col_name in cf_cols
-        ]
-    )
+    df = _parse_dates(df, dates)
+    sels = [
+        C(col_name)
+        for col_name in dates + [ISO3_COUNTRY, SOURCE_ID, SECTOR, SUBSECTOR, GAS]
+    ] + [
+        # Unknown confidence levels become nulls.
+        C(col_name)
+        .cast(enums.confidence_level_enum, strict=False)
+        .alias("conf_" + col_name)
+        for col_name in cf_cols
+    ]
     df = df.select(*sels).shrink_to_fit()
     _logger.debug("source conf: ")
     # For debugging
@@ -354,12 +709,17 @@ def _load_sources(fp) -> pl.DataFrame:
     # The following options are used to reduce the memory footprint.
     # TODO: make it lazy
     _logger.debug(f"loading source {fp}")
-    init_schema = {
+    # The enumerations are validated by the reader. The dates take few distinct
+    # values: they are read as categoricals and parsed by distinct value.
+    init_schema: Dict[str, Any] = {
+        **dict.fromkeys(dates, pl.Categorical),
         "source_id": pl.UInt64,
-        "iso3_country": pl.Categorical,
-        "gas": pl.Categorical,
-        "sector": pl.Categorical,
-        "subsector": pl.Categorical,
+        "iso3_country": enums.iso3_enum,
+        "gas": enums.gas_enum,
+        "sector": enums.sector_enum,
+        "subsector": enums.subsector_enum,
+        "temporal_granularity": enums.temporal_granularity_enum,
+        "original_inventory_sector": enums.original_inventory_sector_enum,
         "emissions_quantity": pl.Float64,
         "emissions_factor": pl.Float64,
         "capacity": pl.Float64,
@@ -376,7 +736,6 @@ def _load_sources(fp) -> pl.DataFrame:
         schema_overrides=init_schema,
         try_parse_dates=False,
         low_memory=True,
-        rechunk=False,
         batch_size=100_000,
     ).shrink_to_fit()
     num_other = 12
@@ -401,7 +760,7 @@ def _load_sources(fp) -> pl.DataFrame:
     for col_name in check_cols:
         if col_name not in df.columns:
             df = df.with_columns(
-                pl.lit(None).cast(pl.String, strict=False).alias(col_name)
+                pl.lit(None, init_schema.get(col_name, pl.String)).alias(col_name)
             )
     # Check that the columns match exactly
     # Some of the files have extra columns, we ignore them for now.
@@ -415,22 +774,8 @@ def _load_sources(fp) -> pl.DataFrame:
     df = df.select(*all_columns).shrink_to_fit()
     _logger.debug("loaded str")
     df = (
-        df.with_columns(
-            # Only start_time and end_time are required
-            *[_parse_date(col_name) for col_name in dates]
-        )
-        .with_columns(
-            c_iso3_country.cast(iso3_enum).alias(ISO3_COUNTRY),
-            c_gas.cast(gas_enum).alias(GAS),
-            c_temporal_granularity.cast(temporal_granularity_enum).alias(
-                TEMPORAL_GRANULARITY
-            ),
-            c_original_inventory_sector.cast(original_inventory_sector_enum).alias(
-                ORIGINAL_INVENTORY_SECTOR
-            ),
-            c_sector.cast(sector_enum).alias(SECTOR),
-            c_subsector.cast(subsector_enum).alias(SUBSECTOR),
-        )
+        # Only start_time and end_time are required
+        _parse_dates(df, dates)
         .with_columns(
             *[
                 C(col_name).cast(pl.Float64, strict=False).alias(col_name)
@@ -455,16 +800,16 @@ def recast_parquet(df: Frame, conf: bool) -> Frame:
     This information gets lost in the parquet format.
     """
     df = df.with_columns(
-        c_iso3_country.cast(iso3_enum).alias(ISO3_COUNTRY),
-        c_gas.cast(gas_enum, strict=False).alias(GAS),
+        c_iso3_country.cast(enums.iso3_enum).alias(ISO3_COUNTRY),
+        c_gas.cast(enums.gas_enum, strict=False).alias(GAS),
         # c_original_inventory_sector.cast(original_inventory_sector_enum).alias(
         #     ORIGINAL_INVENTORY_SECTOR
         # ),
-        c_temporal_granularity.cast(temporal_granularity_enum).alias(
+        c_temporal_granularity.cast(enums.temporal_granularity_enum).alias(
             TEMPORAL_GRANULARITY
         ),
-        c_subsector.cast(subsector_enum).alias(SUBSECTOR),
-        c_sector.cast(sector_enum).alias(SECTOR),
+        c_subsector.cast(enums.subsector_enum).alias(SUBSECTOR),
+        c_sector.cast(enums.sector_enum).alias(SECTOR),
     )
     if EMISSIONS_QUANTITY_UNITS in df.collect_schema().names():
         # There is no emissions quantity for the sources (it is all defined in metric tonnes).
@@ -476,18 +821,11 @@ def recast_parquet(df: Frame, conf: bool) -> Frame:
             )
         )
     if conf:
-        cf_cols = [
-            SOURCE_TYPE,
-            CAPACITY,
-            CAPACITY_FACTOR,
-            ACTIVITY,
-            EMISSIONS_FACTOR,
-            EMISSIONS_QUANTITY,
-        ]
+        cf_cols = confidence_columns
         df = df.with_columns(
             *[
                 C("conf_" + col_name)
-                .cast(confidence_level_enum, strict=False)
+                .cast(enums.confidence_level_enum, strict=False)
                 .alias("conf_" + col_name)
                 for col_name in cf_cols
             ]
@@ -495,17 +833,65 @@ def recast_parquet(df: Frame, conf: bool) -> Frame:
     return df
 
 
+@overload
 def read_country_emissions(
-    gas: Optional[Gas] = GAS_LIST,
+    gas: Union[Gas, List[Gas]] = GAS_LIST,
     archive_path: Union[Path, bool, None] = None,
     parquet_path: Optional[Path] = None,
-) -> pl.DataFrame:
-    """Read all the country emissions data from the given path."""
+    engine: Literal["polars"] = "polars",
+    con: Optional["duckdb.DuckDBPyConnection"] = None,
+    derived: bool = False,
+    gwp: Optional[Dict[Gas, Dict[Gas, float]]] = None,
+) -> pl.DataFrame: ...
+
+
+@overload
+def read_country_emissions(
+    gas: Union[Gas, List[Gas]] = GAS_LIST,
+    archive_path: Union[Path, bool, None] = None,
+    parquet_path: Optional[Path] = None,
+    *,
+    engine: Literal["duckdb"],
+    con: Optional["duckdb.DuckDBPyConnection"] = None,
+    derived: bool = False,
+    gwp: Optional[Dict[Gas, Dict[Gas, float]]] = None,
+) -> "duckdb.DuckDBPyRelation": ...
+
+
+def read_country_emissions(
+    gas: Union[Gas, List[Gas]] = GAS_LIST,
+    archive_path: Union[Path, bool, None] = None,
+    parquet_path: Optional[Path] = None,
+    engine: Engine = "polars",
+    con: Optional["duckdb.DuckDBPyConnection"] = None,
+    derived: bool = False,
+    gwp: Optional[Dict[Gas, Dict[Gas, float]]] = None,
+) -> Union[pl.DataFrame, "duckdb.DuckDBPyRelation"]:
+    """
+    Read all the country emissions data from the given path.
+
+    If engine is "duckdb", a DuckDB relation over the parquet file is returned
+    instead (see `read_source_emissions`). The archives are not supported by this
+    engine.
+
+    If derived is True, the CO2 equivalent gases are computed from the base gases
+    (see `read_source_emissions`).
+    """
     # with V3 there is enough data that a materialized view is useful.
     dfs = []
-    gases = _check_gas(gas)
+    gases = _check_gas(gas, derived)
+    assert engine in ("polars", "duckdb"), engine
+    if derived:
+        assert engine == "polars", "The derived gases are only supported with Polars"
+        from . import co2e
 
-    def _read_parquet(p: Path) -> pl.DataFrame:
+        return co2e.read_countries(gases, archive_path, parquet_path, gwp)
+
+    def _read_parquet(p: Path) -> Union[pl.DataFrame, "duckdb.DuckDBPyRelation"]:
+        if engine == "duckdb":
+            from . import duckdb_engine
+
+            return duckdb_engine.country_relation(p, gases, con)
         return (
             pl.read_parquet(p)
             .pipe(recast_parquet, conf=False)
@@ -515,6 +901,7 @@ def read_country_emissions(
     if parquet_path is not None:
         return _read_parquet(parquet_path)
     elif archive_path is not None:
+        assert engine == "polars", "The archives are only supported with Polars"
         for gas_ in gases:
             for fname in _files[gas_]:
                 (zf, local_p) = _get_zip(archive_path, gas_, fname)
@@ -532,12 +919,10 @@ def read_country_emissions(
                     dfs.append(df)
     else:
         # By default, load from from HF.
+        from . import cache
+
         fname = "climate-trace-countries-{version}.parquet"
-        local_path = huggingface_hub.file_download.hf_hub_download(
-            repo_id="tjhunter/climate-trace",
-            filename=fname.format(version=version),
-            repo_type="dataset",
-        )
+        local_path = cache.fetch_hub(fname.format(version=version))
         return _read_parquet(local_path)
 
     res_df = pl.concat(dfs)
@@ -547,7 +932,11 @@ def read_country_emissions(
 def _load_country_emissions(fp) -> pl.DataFrame:
     dates = [START_TIME, END_TIME, CREATED_DATE, MODIFIED_DATE]
     floats = [EMISSIONS_QUANTITY]
-    df = pl.read_csv(fp.read(), infer_schema_length=0)
+    df = pl.read_csv(
+        fp.read(),
+        infer_schema_length=0,
+        schema_overrides=dict.fromkeys(dates, pl.Categorical),
+    )
     all_columns = [
         "iso3_country",
         "start_time",
@@ -570,10 +959,8 @@ def _load_country_emissions(fp) -> pl.DataFrame:
         list(zip(sorted(df.columns), sorted(all_columns))),
     )
     df = df.select(*all_columns)
-    return df.with_columns(
-        # Only start_time and end_time are required
-        *[_parse_date(col_name) for col_name in dates]
-    ).with_columns(
+    # Only start_time and end_time are required
+    return _parse_dates(df, dates).with_columns(
         *[
             C(col_name).cast(pl.Float64, strict=False).alias(col_name)
             for col_name in floats
@@ -581,6 +968,74 @@ def _load_country_emissions(fp) -> pl.DataFrame:
     )
 
 
+def _filters_expr(filters: List[Filter]) -> pl.Expr:
+    """The polars expression for a list of filters."""
+    exprs = []
+    for col_name, op, value in filters:
+        c = C(col_name)
+        if op in ("=", "=="):
+            exprs.append(c == value)
+        elif op == "!=":
+            exprs.append(c != value)
+        elif op == "<":
+            exprs.append(c < value)
+        elif op == "<=":
+            exprs.append(c <= value)
+        elif op == ">":
+            exprs.append(c > value)
+        elif op == ">=":
+            exprs.append(c >= value)
+        elif op == "in":
+            exprs.append(c.is_in(list(value)))
+        elif op == "not in":
+            exprs.append(~c.is_in(list(value)))
+        else:
+            raise ValueError(f"Unknown operator {op} in filter {(col_name, op, value)}")
+    return pl.all_horizontal(exprs) if exprs else pl.lit(True)
+
+
+def _row_group_stats(
+    md: "pyarrow.parquet.RowGroupMetaData",
+) -> Dict[str, Tuple[Any, Any]]:
+    """The (min, max) statistics of the columns of a row group, when available."""
+    stats = {}
+    for i in range(md.num_columns):
+        col_md = md.column(i)
+        st = col_md.statistics
+        if st is not None and st.has_min_max:
+            stats[col_md.path_in_schema] = (st.min, st.max)
+    return stats
+
+
+def _row_group_may_match(
+    stats: Dict[str, Tuple[Any, Any]], filters: List[Filter]
+) -> bool:
+    """
+    False if the statistics of a row group prove that no row matches the filters.
+    """
+    for col_name, op, value in filters:
+        if col_name not in stats:
+            continue
+        (lo, hi) = stats[col_name]
+        try:
+            if op in ("=", "==") and (value < lo or value > hi):
+                return False
+            if op == "<" and not lo < value:
+                return False
+            if op == "<=" and not lo <= value:
+                return False
+            if op == ">" and not hi > value:
+                return False
+            if op == ">=" and not hi >= value:
+                return False
+            if op == "in" and all(v < lo or v > hi for v in value):
+                return False
+        except TypeError:
+            # Values that cannot be compared with the statistics.
+            continue
+    return True
+
+
 def _check_year(y: Union[int, List[int], None]) -> List[int]:
     if y is None or y == []:
         y = years
@@ -591,14 +1046,47 @@ def _check_year(y: Union[int, List[int], None]) -> List[int]:
     return y
 
 
-def _check_gas(g: Union[Gas, List[Gas]]) -> List[Gas]:
+def _check_gas(g: Union[Gas, List[Gas]], derived: bool = False) -> List[Gas]:
     if isinstance(g, str):
         g = [g]
+    valid = list(dict.fromkeys(GAS_LIST + DERIVED_GAS_LIST)) if derived else GAS_LIST
     for gas in g:
-        assert gas in GAS_LIST, f"Gas {gas} not a valid gas. Valid gases are {GAS_LIST}"
+        assert gas in valid, f"Gas {gas} not a valid gas. Valid gases are {valid}"
     return g
 
 
+def _collect_streaming(df: pl.LazyFrame) -> pl.DataFrame:
+    """Collects a query with the streaming engine, which bounds the memory."""
+    return df.collect(engine="streaming")
+
+
+def _parse_dates(df: pl.DataFrame, col_names: List[str]) -> pl.DataFrame:
+    """
+    Parses the date columns, read as categoricals.
+
+    The dates take few distinct values (the months of the data, and a few creation
+    dates): each distinct value is parsed once and mapped back to the rows. The
+    cost scales with the number of distinct values rather than with the number
+    of rows.
+    """
+    exprs = []
+    for col_name in col_names:
+        values = df[col_name].unique().drop_nulls()
+        if values.is_empty():
+            exprs.append(pl.lit(None, _date_dtype).alias(col_name))
+            continue
+        parsed = values.cast(pl.String).to_frame().select(_parse_date(col_name))
+        exprs.append(
+            C(col_name)
+            .replace_strict(values, parsed.to_series(), return_dtype=_date_dtype)
+            .alias(col_name)
+        )
+    return df.with_columns(exprs)
+
+
+_date_dtype = pl.Datetime(time_unit="ms", time_zone="UTC")
+
+
 def _parse_date(col_name: str) -> pl.Expr:
     return (
         pl.col(col_name)
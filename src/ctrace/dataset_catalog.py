@@ -0,0 +1,343 @@
+"""
+The catalog of the source emissions files.
+
+The writers of the source files (see `write_source_file`) produce a small JSON
+catalog next to each file, with the number of rows of the file and of each row
+group, the statistics of the row groups, the number of rows and the total
+emissions of each subsector, and the schema. `build_catalog` gathers them into
+a single catalog for a version of the dataset.
+
+The main function is `catalog`, which answers the counts, the existence checks
+and the query planning from this metadata alone, without reading the data.
+"""
+
+import datetime
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import polars as pl
+from polars import col as C
+
+from . import enums
+from .constants import *
+from .data import (
+    Filter,
+    _check_gas,
+    _check_year,
+    _row_group_may_match,
+    _row_group_stats,
+    _source_fname,
+    _source_path,
+    version,
+)
+
+_logger = logging.getLogger(__name__)
+
+# The catalog of each source file, and the catalog of the dataset.
+_file_catalog_fname = (
+    "{version}/climate_trace-sources-catalog_{version}_{year}_{gas}.json"
+)
+_catalog_fname = "{version}/climate_trace-catalog_{version}.json"
+
+# The columns with statistics in the catalog, for the query planning.
+stats_columns = [SECTOR, SUBSECTOR, ISO3_COUNTRY, SOURCE_ID, START_TIME, END_TIME]
+_datetime_columns = [START_TIME, END_TIME]
+
+# Output columns
+YEAR = "year"
+NUM_ROWS = "num_rows"
+NUM_ROW_GROUPS = "num_row_groups"
+SIZE_BYTES = "size_bytes"
+ROW_GROUP = "row_group"
+
+
+@dataclass
+class Catalog:
+    """
+    The catalog of a version of the dataset.
+
+    files: the number of rows, row groups and bytes of each (year, gas) file.
+    row_groups: the number of rows and bytes of each row group, with the minimum
+      and maximum of the `stats_columns` (in the <column>_min and <column>_max
+      columns).
+    subsectors: the number of rows and the total emissions of each
+      (year, gas, sector, subsector).
+    schema: the type of each column.
+    """
+
+    version: str
+    files: pl.DataFrame
+    row_groups: pl.DataFrame
+    subsectors: pl.DataFrame
+    schema: Dict[str, str]
+    _stats: List[Tuple[int, Gas, int, Dict[str, Tuple[Any, Any]]]] = field(
+        repr=False, default_factory=list
+    )
+
+    def count(
+        self,
+        gas: Union[Gas, List[Gas], None] = None,
+        year: Union[int, List[int], None] = None,
+        subsector: Union[str, List[str], None] = None,
+    ) -> int:
+        """The number of records, for the given gases, years and subsectors."""
+        df = _select(self.subsectors, gas, year, subsector)
+        return int(df[NUM_ROWS].sum())
+
+    def total_emissions(
+        self,
+        gas: Union[Gas, List[Gas], None] = None,
+        year: Union[int, List[int], None] = None,
+        subsector: Union[str, List[str], None] = None,
+    ) -> float:
+        """The total emissions, for the given gases, years and subsectors."""
+        df = _select(self.subsectors, gas, year, subsector)
+        return float(df[EMISSIONS_QUANTITY].sum())
+
+    def exists(
+        self,
+        gas: Union[Gas, List[Gas], None] = None,
+        year: Union[int, List[int], None] = None,
+        subsector: Union[str, List[str], None] = None,
+    ) -> bool:
+        """True if there is any record for the given gases, years and subsectors."""
+        return self.count(gas, year, subsector) > 0
+
+    def subsectors_by_year(self) -> pl.DataFrame:
+        """The sorted list of the subsectors with records, for each year."""
+        return (
+            self.subsectors.filter(C(NUM_ROWS) > 0)
+            .group_by(YEAR)
+            .agg(c_subsector.unique().sort())
+            .sort(by=YEAR)
+        )
+
+    def plan(
+        self,
+        gas: Union[Gas, List[Gas]],
+        year: Union[int, List[int], None] = None,
+        filters: Optional[List[Filter]] = None,
+    ) -> pl.DataFrame:
+        """
+        The row groups that may contain records matching the filters, with their
+        number of rows. The other row groups can be skipped by the readers.
+        """
+        gases = _check_gas(gas)
+        ys = _check_year(year)
+        filters = filters or []
+        keep = {
+            (year_, gas_, rg)
+            for (year_, gas_, rg, stats) in self._stats
+            if year_ in ys and gas_ in gases and _row_group_may_match(stats, filters)
+        }
+        return self.row_groups.filter(
+            pl.struct(YEAR, C(GAS).cast(pl.String), ROW_GROUP).is_in(
+                [{YEAR: y, GAS: g, ROW_GROUP: rg} for (y, g, rg) in sorted(keep)]
+            )
+        )
+
+
+def catalog(p: Optional[Path] = None, dataset_version: Optional[str] = None) -> Catalog:
+    """
+    The catalog of the source emissions.
+
+    p: the directory of the source files (see `read_source_emissions`). If the
+      catalog of the dataset was not built, the catalogs of the files are used.
+      If None, the catalog is downloaded.
+    """
+    dataset_version = dataset_version or version
+    name = _catalog_fname.format(version=dataset_version)
+    if p is None:
+        from . import cache
+
+        entries = json.loads(cache.fetch_hub(name).read_text())["files"]
+    elif (Path(p) / name).exists():
+        entries = json.loads((Path(p) / name).read_text())["files"]
+    else:
+        entries = _read_file_catalogs(Path(p), dataset_version)
+    return _catalog(dataset_version, entries)
+
+
+def write_file_catalog(
+    core_p: Path, text_p: Optional[Path], year: int, gas: Gas, p: Path
+) -> Path:
+    """Writes the catalog of a source file, and returns its path."""
+    import pyarrow.parquet
+
+    md = pyarrow.parquet.ParquetFile(core_p).metadata
+    row_groups = []
+    for i in range(md.num_row_groups):
+        rg_md = md.row_group(i)
+        stats = _row_group_stats(rg_md)
+        row_groups.append(
+            {
+                NUM_ROWS: rg_md.num_rows,
+                SIZE_BYTES: rg_md.total_byte_size,
+                "stats": {
+                    c: [_to_json(lo), _to_json(hi)]
+                    for c, (lo, hi) in stats.items()
+                    if c in stats_columns
+                },
+            }
+        )
+    subsectors = (
+        pl.scan_parquet(core_p)
+        .group_by(c_sector.cast(pl.String), c_subsector.cast(pl.String))
+        .agg(pl.len().alias(NUM_ROWS), c_emissions_quantity.sum())
+        .sort(by=[SECTOR, SUBSECTOR])
+        .collect()
+    )
+    schema = _schema(core_p)
+    if text_p is not None:
+        schema.update(_schema(text_p))
+    entry = {
+        "version": version,
+        YEAR: year,
+        GAS: gas,
+        "file": core_p.name,
+        "text_file": text_p.name if text_p is not None else None,
+        NUM_ROWS: md.num_rows,
+        SIZE_BYTES: os.path.getsize(core_p),
+        "schema": schema,
+        "row_groups": row_groups,
+        "subsectors": subsectors.to_dicts(),
+    }
+    out_p = Path(p) / _file_catalog_fname.format(version=version, year=year, gas=gas)
+    out_p.write_text(json.dumps(entry, indent=1))
+    return out_p
+
+
+def build_catalog(p: Path, dataset_version: Optional[str] = None) -> Path:
+    """
+    Gathers the catalogs of the source files of a version into the catalog of the
+    dataset, and returns its path.
+    """
+    dataset_version = dataset_version or version
+    entries = _read_file_catalogs(Path(p), dataset_version)
+    out_p = Path(p) / _catalog_fname.format(version=dataset_version)
+    out_p.write_text(json.dumps({"version": dataset_version, "files": entries}))
+    return out_p
+
+
+def _read_file_catalogs(p: Path, dataset_version: str) -> List[Dict[str, Any]]:
+    entries = []
+    for year_ in _check_year(None):
+        for gas_ in GAS_LIST:
+            name = _file_catalog_fname.format(
+                version=dataset_version, year=year_, gas=gas_
+            )
+            if (p / name).exists():
+                entries.append(json.loads((p / name).read_text()))
+            elif _source_path(_source_fname, year_, gas_, p, dataset_version).exists():
+                _logger.warning(f"no catalog for year={year_} gas={gas_} in {p}")
+    return entries
+
+
+def _catalog(dataset_version: str, entries: List[Dict[str, Any]]) -> Catalog:
+    files = []
+    row_groups = []
+    subsectors = []
+    stats_list = []
+    schema: Dict[str, str] = {}
+    for e in entries:
+        key = {YEAR: e[YEAR], GAS: e[GAS]}
+        files.append(
+            {
+                **key,
+                NUM_ROWS: e[NUM_ROWS],
+                NUM_ROW_GROUPS: len(e["row_groups"]),
+                SIZE_BYTES: e[SIZE_BYTES],
+            }
+        )
+        for i, rg in enumerate(e["row_groups"]):
+            stats = {
+                c: (_from_json(c, lo), _from_json(c, hi))
+                for c, (lo, hi) in rg["stats"].items()
+            }
+            stats_list.append((e[YEAR], e[GAS], i, stats))
+            row = {
+                **key,
+                ROW_GROUP: i,
+                NUM_ROWS: rg[NUM_ROWS],
+                SIZE_BYTES: rg[SIZE_BYTES],
+            }
+            for c in stats_columns:
+                (lo, hi) = stats.get(c, (None, None))
+                row[f"{c}_min"] = lo
+                row[f"{c}_max"] = hi
+            row_groups.append(row)
+        subsectors += [{**key, **s} for s in e["subsectors"]]
+        schema.update(e["schema"])
+    return Catalog(
+        version=dataset_version,
+        files=_cast_enums(pl.DataFrame(files, schema=_files_schema)),
+        row_groups=_cast_enums(pl.DataFrame(row_groups, infer_schema_length=None)),
+        subsectors=_cast_enums(pl.DataFrame(subsectors, schema=_subsectors_schema)),
+        schema=schema,
+        _stats=stats_list,
+    )
+
+
+_files_schema = {
+    YEAR: pl.Int64,
+    GAS: pl.String,
+    NUM_ROWS: pl.Int64,
+    NUM_ROW_GROUPS: pl.Int64,
+    SIZE_BYTES: pl.Int64,
+}
+_subsectors_schema = {
+    YEAR: pl.Int64,
+    GAS: pl.String,
+    SECTOR: pl.String,
+    SUBSECTOR: pl.String,
+    NUM_ROWS: pl.Int64,
+    EMISSIONS_QUANTITY: pl.Float64,
+}
+
+
+def _schema(p: Path) -> Dict[str, str]:
+    # The values of the enumerations are in `ctrace.enums`, not repeated here.
+    return {
+        n: "Enum" if isinstance(dt, pl.Enum) else str(dt)
+        for n, dt in pl.read_parquet_schema(p).items()
+    }
+
+
+def _select(
+    df: pl.DataFrame,
+    gas: Union[Gas, List[Gas], None],
+    year: Union[int, List[int], None],
+    subsector: Union[str, List[str], None],
+) -> pl.DataFrame:
+    if gas is not None:
+        df = df.filter(c_gas.cast(pl.String).is_in(_check_gas(gas)))
+    if year is not None:
+        df = df.filter(C(YEAR).is_in(_check_year(year)))
+    if subsector is not None:
+        subsectors = [subsector] if isinstance(subsector, str) else subsector
+        df = df.filter(c_subsector.cast(pl.String).is_in(subsectors))
+    return df
+
+
+def _cast_enums(df: pl.DataFrame) -> pl.DataFrame:
+    return df.with_columns(
+        [C(c).cast(e) for c, e in enums.column_enums().items() if c in df.columns]
+    )
+
+
+def _to_json(v: Any) -> Any:
+    if isinstance(v, datetime.datetime):
+        return v.isoformat()
+    if isinstance(v, bytes):
+        return v.decode("utf-8")
+    return v
+
+
+def _from_json(col_name: str, v: Any) -> Any:
+    if col_name in _datetime_columns and v is not None:
+        return datetime.datetime.fromisoformat(v)
+    return v
@@ -0,0 +1,217 @@
+"""
+Differences between two snapshots of the dataset.
+
+`ctrace` takes monthly snapshots of the Climate TRACE dataset. The functions
+`diff_sources` and `diff_countries` compare two snapshots and return only the
+records that were added, removed or changed, so that downstream data can be
+updated incrementally.
+"""
+
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional, Union
+
+import polars as pl
+from polars import col as C
+
+from . import enums
+from .constants import *
+from .data import (
+    _check_gas,
+    _check_year,
+    _collect_streaming,
+    _source_fname,
+    _source_path,
+)
+
+_logger = logging.getLogger(__name__)
+
+# Output columns
+CHANGE = "change"
+ADDED = "added"
+REMOVED = "removed"
+CHANGED = "changed"
+OLD_EMISSIONS = "old_emissions_quantity"
+NEW_EMISSIONS = "new_emissions_quantity"
+
+_row_hash = "_row_hash"
+_side = "_side"
+_key = "_key"
+_enum_types = (pl.Enum, pl.Categorical)
+
+# The keys identifying a record.
+source_keys = [SOURCE_ID, START_TIME, GAS]
+country_keys = [ISO3_COUNTRY, SECTOR, SUBSECTOR, START_TIME, GAS]
+
+
+@dataclass
+class SnapshotDiff:
+    """
+    The differences between two snapshots.
+
+    changes: the keys of the records that were added, removed or changed (in the
+      `change` column), with their old and new emissions.
+    summary: the number of changes of each type and the total change of
+      emissions, by gas and year.
+    """
+
+    changes: pl.DataFrame
+    summary: pl.DataFrame
+
+    def rows(self, df: pl.LazyFrame, change: Optional[str] = None) -> pl.LazyFrame:
+        """
+        The full records of the given snapshot that correspond to the changes.
+
+        Use the new snapshot for the added and changed records, and the old
+        snapshot for the removed records.
+        """
+        changes = self.changes
+        if change is not None:
+            changes = changes.filter(C(CHANGE) == change)
+        keys = [c for c in changes.columns if c in source_keys + country_keys]
+        return df.join(changes.lazy().select(keys), on=keys, how="semi")
+
+
+def diff_sources(
+    old_version: str,
+    new_version: str,
+    gas: Union[Gas, List[Gas]] = GAS_LIST,
+    year: Union[int, List[int], None] = None,
+    p: Optional[Path] = None,
+    new_p: Optional[Path] = None,
+) -> SnapshotDiff:
+    """
+    Compares the source emissions of two versions of the dataset.
+
+    The records are matched on (source_id, start_time, gas). A record is changed
+    if the hash of any of its other columns differs. The text columns are not
+    compared.
+
+    Each year and gas is compared separately: the records are hashed, sorted by key
+    and merged with the streaming engine of Polars.
+
+    p: the directory holding the old version (see `read_source_emissions`).
+    new_p: the directory holding the new version, if different from p.
+    """
+    ys = _check_year(year)
+    gases = _check_gas(gas)
+    new_p = new_p or p
+    changes = []
+    for year_ in ys:
+        for gas_ in gases:
+            _logger.debug(f"diff sources year={year_} gas={gas_}")
+            old_df = pl.scan_parquet(
+                _source_path(_source_fname, year_, gas_, p, old_version)
+            )
+            new_df = pl.scan_parquet(
+                _source_path(_source_fname, year_, gas_, new_p, new_version)
+            )
+            changes.append(_diff_frames(old_df, new_df, source_keys))
+    return _snapshot_diff(pl.concat(changes))
+
+
+def diff_countries(old_path: Path, new_path: Path) -> SnapshotDiff:
+    """
+    Compares the country emissions of two versions of the dataset, given as
+    parquet files (see `read_country_emissions`).
+
+    The records are matched on (iso3_country, sector, subsector, start_time, gas).
+    """
+    changes = _diff_frames(
+        pl.scan_parquet(old_path), pl.scan_parquet(new_path), country_keys
+    )
+    return _snapshot_diff(changes)
+
+
+def _snapshot_diff(changes: pl.DataFrame) -> SnapshotDiff:
+    changes = changes.with_columns(
+        [C(c).cast(e) for c, e in enums.column_enums().items() if c in changes.columns]
+    )
+    summary = (
+        changes.group_by(c_gas, c_start_time.dt.year().alias("year"), C(CHANGE))
+        .agg(
+            pl.len(),
+            (C(NEW_EMISSIONS).fill_null(0) - C(OLD_EMISSIONS).fill_null(0))
+            .sum()
+            .alias("emissions_delta"),
+        )
+        .sort(by=[GAS, "year", CHANGE])
+    )
+    return SnapshotDiff(changes=changes, summary=summary)
+
+
+def _hashed(df: pl.LazyFrame, keys: List[str], side: int) -> pl.LazyFrame:
+    """The keys, the emissions and the hash of the other columns, sorted by key."""
+    schema = df.collect_schema()
+    # The enumerations are compared by value: their codes may change across versions.
+    values = [
+        (C(n).cast(pl.String) if isinstance(dt, _enum_types) else C(n))
+        for (n, dt) in schema.items()
+        if n not in keys and n not in text_columns
+    ]
+    return (
+        df.select(
+            *[
+                C(k).cast(pl.String) if isinstance(schema[k], _enum_types) else C(k)
+                for k in keys
+            ],
+            c_emissions_quantity,
+            pl.struct(values).hash(seed=0).alias(_row_hash),
+            pl.lit(side, pl.Int8).alias(_side),
+        )
+        .with_columns(pl.struct(keys).alias(_key))
+        .sort(by=_key)
+    )
+
+
+def _diff_frames(
+    old_df: pl.LazyFrame, new_df: pl.LazyFrame, keys: List[str]
+) -> pl.DataFrame:
+    """
+    Merges the two sorted snapshots and compares each record with its neighbors:
+    a record with the same key on the other side is a match.
+    """
+    merged = _hashed(old_df, keys, 0).merge_sorted(_hashed(new_df, keys, 1), key=_key)
+    # The first and last records have no neighbor.
+    prev_match = (
+        (C(_key) == C(_key).shift(1)) & (C(_side) != C(_side).shift(1))
+    ).fill_null(False)
+    next_match = (
+        (C(_key) == C(_key).shift(-1)) & (C(_side) != C(_side).shift(-1))
+    ).fill_null(False)
+    other_hash = (
+        pl.when(prev_match)
+        .then(C(_row_hash).shift(1))
+        .when(next_match)
+        .then(C(_row_hash).shift(-1))
+    )
+    other_emissions = (
+        pl.when(prev_match)
+        .then(c_emissions_quantity.shift(1))
+        .when(next_match)
+        .then(c_emissions_quantity.shift(-1))
+    )
+    change = (
+        pl.when(~prev_match & ~next_match)
+        .then(pl.when(C(_side) == 0).then(pl.lit(REMOVED)).otherwise(pl.lit(ADDED)))
+        .when((C(_side) == 1) & (C(_row_hash) != other_hash))
+        .then(pl.lit(CHANGED))
+    )
+    is_old = C(_side) == 0
+    res = (
+        merged.with_columns(
+            change.alias(CHANGE),
+            pl.when(is_old)
+            .then(c_emissions_quantity)
+            .otherwise(other_emissions)
+            .alias(OLD_EMISSIONS),
+            pl.when(is_old)
+            .then(other_emissions)
+            .otherwise(c_emissions_quantity)
+            .alias(NEW_EMISSIONS),
+        )
+        .filter(C(CHANGE).is_not_null())
+        .select(*keys, CHANGE, OLD_EMISSIONS, NEW_EMISSIONS)
+    )
+    return _collect_streaming(res)
@@ -0,0 +1,159 @@
+"""
+The DuckDB engine for reading the data.
+
+DuckDB runs the queries out of core: the joins and aggregations that do not fit
+in memory spill to a temporary directory, within a memory limit. This engine is
+used with `engine="duckdb"` in `read_source_emissions` and
+`read_country_emissions`, which then return DuckDB relations over the same files.
+
+The enumerated columns are cast to DuckDB ENUM types, which are created on the
+connection with the same names and values as in `ctrace.enums`.
+
+This engine requires the duckdb package, which is not installed by default.
+"""
+
+import functools
+import logging
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from . import enums
+from .constants import *
+
+if TYPE_CHECKING:
+    import duckdb
+
+_logger = logging.getLogger(__name__)
+
+# The DuckDB type of each enumerated column.
+_column_types: Dict[str, str] = {
+    ISO3_COUNTRY: "iso3_enum",
+    GAS: "gas_enum",
+    TEMPORAL_GRANULARITY: "temporal_granularity_enum",
+    SECTOR: "sector_enum",
+    SUBSECTOR: "subsector_enum",
+}
+# The columns with values outside of their enumeration, which become nulls.
+# This is the same as the non-strict casts of `recast_parquet`.
+_lenient_columns = [GAS]
+
+
+def connect(
+    memory_limit: Optional[str] = None,
+    temp_directory: Optional[Path] = None,
+    threads: Optional[int] = None,
+) -> "duckdb.DuckDBPyConnection":
+    """
+    Creates an in-memory DuckDB connection, with the enumerated types of the dataset.
+
+    memory_limit: the memory limit of DuckDB, for example "8GB". Beyond this
+      limit, the queries spill to the temporary directory.
+    temp_directory: the directory for the spilled data.
+    """
+    import duckdb
+
+    con = duckdb.connect()
+    if memory_limit is not None:
+        con.execute(f"SET memory_limit = {_quote(memory_limit)}")
+    if temp_directory is not None:
+        con.execute(f"SET temp_directory = {_quote(str(temp_directory))}")
+    if threads is not None:
+        con.execute(f"SET threads = {int(threads)}")
+    for type_name in sorted(set(_column_types.values()) | {"confidence_level_enum"}):
+        values = ", ".join(_quote(v) for v in enums._enum_values[type_name])
+        con.execute(f"CREATE TYPE {type_name} AS ENUM ({values})")
+    return con
+
+
+@functools.cache
+def default_connection() -> "duckdb.DuckDBPyConnection":
+    """
+    The connection used when none is provided, with the settings of the runtime
+    configuration (see `ctrace.runtime`).
+    """
+    from . import runtime
+
+    return connect(**runtime.duckdb_settings())
+
+
+def source_relation(
+    files: List[Tuple[Path, Optional[Path], List[str], List[str]]],
+    con: Optional["duckdb.DuckDBPyConnection"] = None,
+) -> "duckdb.DuckDBPyRelation":
+    """
+    A relation over the source files.
+
+    files: for each file, the path of the core file, the path of the text file (or
+      None), the columns to read and the columns among them that are read from the
+      text file. See `read_source_emissions`.
+    """
+    con = con or default_connection()
+    queries = []
+    for core_p, text_p, cols, text_cols in files:
+        core_cols = [c for c in cols if c not in text_cols]
+        # The identifiers and the literals of the queries are all quoted.
+        select = _select_list(core_cols, conf=True)
+        query = f"SELECT {select} FROM {_scan(core_p)}"  # noqa: S608
+        if text_p is not None and text_cols:
+            # Both files are written in the same order: they can be stitched by
+            # row position.
+            text_select = _select_list(text_cols, conf=False)
+            text_query = f"SELECT {text_select} FROM {_scan(text_p)}"  # noqa: S608
+            query = (
+                f"SELECT {_column_list(cols)} "  # noqa: S608
+                f"FROM ({query}) POSITIONAL JOIN ({text_query})"
+            )
+        queries.append(query)
+    sql = " UNION ALL BY NAME ".join(f"({q})" for q in queries)
+    _logger.debug(f"source relation: {sql}")
+    return con.sql(sql)
+
+
+def country_relation(
+    p: Path,
+    gases: List[Gas],
+    con: Optional["duckdb.DuckDBPyConnection"] = None,
+) -> "duckdb.DuckDBPyRelation":
+    """A relation over the country emissions file, restricted to the given gases."""
+    con = con or default_connection()
+    describe = f"DESCRIBE SELECT * FROM {_scan(p)}"  # noqa: S608
+    names = [r[0] for r in con.sql(describe).fetchall()]
+    # The condition is on the stored strings, so that it is pushed to the parquet scan.
+    gas_list = ", ".join(_quote(g) for g in gases)
+    sql = (
+        f"SELECT {_select_list(names, conf=False)} FROM {_scan(p)} "  # noqa: S608
+        f"WHERE {_ident(GAS)} IN ({gas_list})"
+    )
+    return con.sql(sql)
+
+
+def _select_list(names: List[str], conf: bool) -> str:
+    conf_cols = ["conf_" + c for c in confidence_columns] if conf else []
+    exprs = []
+    for n in names:
+        if n in _column_types:
+            cast = "TRY_CAST" if n in _lenient_columns else "CAST"
+            exprs.append(f"{cast}({_ident(n)} AS {_column_types[n]}) AS {_ident(n)}")
+        elif n in conf_cols:
+            exprs.append(
+                f"TRY_CAST({_ident(n)} AS confidence_level_enum) AS {_ident(n)}"
+            )
+        else:
+            exprs.append(_ident(n))
+    return ", ".join(exprs)
+
+
+def _column_list(names: List[str]) -> str:
+    return ", ".join(_ident(n) for n in names)
+
+
+def _ident(n: str) -> str:
+    return '"' + n.replace('"', '""') + '"'
+
+
+def _scan(p: Path) -> str:
+    return f"read_parquet({_quote(str(p))})"
+
+
+def _quote(s: str) -> str:
+    return "'" + s.replace("'", "''") + "'"
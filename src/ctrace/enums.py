@@ -2,14 +2,23 @@
 Enumerations for the data
 """
 
+import sys
+from typing import Dict, List, Sequence
+
 import polars as pl
 
 from .constants import (
+    CO2E_20YR,
     CONFIDENCES,
+    GAS,
     GAS_LIST,
+    ISO3_COUNTRY,
     ORIGINAL_INVENTORY_SECTORS,
+    SECTOR,
     SECTORS,
+    SUBSECTOR,
     SUBSECTORS,
+    TEMPORAL_GRANULARITY,
 )
 
 # The list was generated with the following snippet:
@@ -278,12 +287,6 @@ _countries = (
     ]
 )
 
-iso3_enum = pl.Enum(_countries)
-
-gas_enum = pl.Enum(GAS_LIST)
-
-temporal_granularity_enum = pl.Enum(["annual", "other", "month", "week", "day", "hour"])
-
 # Inventory sectors
 INTERNATIONAL_AVIATION = "international-aviation"
 ROAD_TRANSPORTATION = "road-transportation"
@@ -299,14 +302,52 @@ INVENTORY_SECTORS = [
     DOMESTIC_SHIPPING,
     DOMESTIC_AVIATION,
 ]
-inventory_sector_enum = pl.Enum(INVENTORY_SECTORS)
 
-# Confidence levels
+TEMPORAL_GRANULARITIES = ["annual", "other", "month", "week", "day", "hour"]
+
+# The polars enumerations are only built on first access, to keep the import
+# of the package fast. They are then cached in the module.
+_enum_values: Dict[str, Sequence[str]] = {
+    "iso3_enum": _countries,
+    "gas_enum": [*GAS_LIST, CO2E_20YR],
+    "temporal_granularity_enum": TEMPORAL_GRANULARITIES,
+    "inventory_sector_enum": INVENTORY_SECTORS,
+    # Confidence levels
+    "confidence_level_enum": CONFIDENCES,
+    "subsector_enum": SUBSECTORS,
+    "sector_enum": SECTORS,
+    "original_inventory_sector_enum": ORIGINAL_INVENTORY_SECTORS,
+}
+
+iso3_enum: pl.Enum
+gas_enum: pl.Enum
+temporal_granularity_enum: pl.Enum
+inventory_sector_enum: pl.Enum
+confidence_level_enum: pl.Enum
+subsector_enum: pl.Enum
+sector_enum: pl.Enum
+original_inventory_sector_enum: pl.Enum
+
+
+def __getattr__(name: str) -> pl.Enum:
+    if name in _enum_values:
+        enum = pl.Enum(_enum_values[name])
+        globals()[name] = enum
+        return enum
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-confidence_level_enum = pl.Enum(CONFIDENCES)
 
-subsector_enum = pl.Enum(SUBSECTORS)
+def __dir__() -> List[str]:
+    return sorted(set(globals()) | set(_enum_values))
 
-sector_enum = pl.Enum(SECTORS)
 
-original_inventory_sector_enum = pl.Enum(ORIGINAL_INVENTORY_SECTORS)
+def column_enums() -> Dict[str, pl.Enum]:
+    """The enumeration of each enumerated column of the data."""
+    module = sys.modules[__name__]
+    return {
+        ISO3_COUNTRY: module.iso3_enum,
+        GAS: module.gas_enum,
+        TEMPORAL_GRANULARITY: module.temporal_granularity_enum,
+        SECTOR: module.sector_enum,
+        SUBSECTOR: module.subsector_enum,
+    }
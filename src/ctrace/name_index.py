@@ -0,0 +1,460 @@
+"""
+Search of the sources by name.
+
+Finding a source by name with a filter on `source_name` decodes the text
+column of every record of every file. The name index instead holds the distinct
+(source_id, source_name, iso3_country, subsector) of all the files, and the
+sorted tokens of the names, so that a search takes a few binary searches:
+
+    df = search_sources("drax power", p=p)
+    records = read_sources_by_id(df[SOURCE_ID].to_list(), CO2, 2023, p=p)
+
+The names are normalized (lower case, without accents and punctuation) and
+split into tokens. The searches are:
+
+- token: the names that contain all the tokens of the query.
+- prefix: the names with a token starting with each token of the query, for
+  the completion of partial names.
+- fuzzy: the names with a token similar to each token of the query, for the
+  misspelled names. The similarity of two tokens is one minus their edit
+  distance (with transpositions) relative to the longest token. The distances
+  to all the tokens of close lengths are computed at once with NumPy.
+
+The writers of the source files (see `write_source_file`) write the names of
+each file next to it, and `build_name_index` gathers them into the index.
+"""
+
+import functools
+import logging
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Literal, Optional, Tuple, Union
+
+import numpy as np
+import polars as pl
+from polars import col as C
+
+from . import enums
+from .constants import *
+from .data import (
+    Filter,
+    _check_gas,
+    _check_year,
+    _source_path,
+    read_source_emissions,
+    version,
+)
+from .stream import iter_source_batches
+
+_logger = logging.getLogger(__name__)
+
+# The names of each source file, and the index of the dataset.
+_file_names_fname = (
+    "{version}/climate_trace-sources-names_{version}_{year}_{gas}.parquet"
+)
+_names_fname = "{version}/climate_trace-names_{version}.parquet"
+_tokens_fname = "{version}/climate_trace-names-tokens_{version}.parquet"
+
+# The kinds of searches.
+Mode = Literal["token", "prefix", "fuzzy"]
+
+# Output columns
+NAME = "name"
+ENTRY = "entry"
+TOKEN = "token"  # noqa: S105
+SCORE = "score"
+
+_name_columns = [SOURCE_ID, SOURCE_NAME, ISO3_COUNTRY, SUBSECTOR]
+
+# The number of buckets of the character counts of the tokens.
+_num_buckets = 32
+
+
+@dataclass
+class NameIndex:
+    """
+    The index of the source names.
+
+    entries: the distinct (source_id, source_name, iso3_country, subsector),
+      with their normalized name. The row of an entry is its id.
+    tokens: the (token, entry) pairs of the tokens of the names, sorted by token.
+    """
+
+    entries: pl.DataFrame
+    tokens: pl.DataFrame
+    _vocabulary: Optional[pl.DataFrame] = field(repr=False, default=None)
+    # The rows in the vocabulary, the code points and the character counts of the
+    # tokens of each length.
+    _codes: Dict[int, Tuple[np.ndarray, np.ndarray, np.ndarray]] = field(
+        repr=False, default_factory=dict
+    )
+    _name_lengths: np.ndarray = field(repr=False, init=False)
+    _token_entries: np.ndarray = field(repr=False, init=False)
+
+    def __post_init__(self) -> None:
+        """Caches the arrays used by all the searches."""
+        self._name_lengths = self.entries[NAME].str.len_chars().to_numpy()
+        self._token_entries = self.tokens[ENTRY].to_numpy()
+
+    def search(
+        self,
+        query: str,
+        mode: Mode = "prefix",
+        iso3_country: Union[str, List[str], None] = None,
+        subsector: Union[str, List[str], None] = None,
+        limit: Optional[int] = 20,
+        min_similarity: float = 0.7,
+    ) -> pl.DataFrame:
+        """
+        The entries matching a query, best matches first.
+
+        mode: the kind of search (see the module documentation).
+        iso3_country, subsector: restrict the search to these countries and
+          subsectors.
+        limit: the maximum number of entries returned.
+        min_similarity: for the fuzzy search, the minimum similarity of the
+          tokens, between 0 and 1.
+
+        Returns the entries with a score: the fraction of the name matched by
+        the query for the token and prefix searches, the mean similarity of
+        the tokens of the query for the fuzzy search.
+        """
+        assert mode in ("token", "prefix", "fuzzy"), mode
+        q_tokens = _tokenize(query)
+        if not q_tokens:
+            return self._results(np.array([], np.uint32), np.array([]))
+        if mode == "fuzzy":
+            (rows, scores) = self._fuzzy_rows(q_tokens, min_similarity)
+        else:
+            rows = self._token_rows(q_tokens[0], mode == "prefix")
+            for t in q_tokens[1:]:
+                rows = np.intersect1d(rows, self._token_rows(t, mode == "prefix"))
+            q_len = len(" ".join(q_tokens))
+            lengths = self._name_lengths[rows]
+            scores = np.minimum(q_len / np.maximum(lengths, 1), 1.0)
+        res = self._results(rows, scores)
+        if iso3_country is not None:
+            res = res.filter(C(ISO3_COUNTRY).is_in(_as_list(iso3_country)))
+        if subsector is not None:
+            res = res.filter(C(SUBSECTOR).is_in(_as_list(subsector)))
+        return res.head(limit) if limit is not None else res
+
+    def _token_rows(self, token: str, prefix: bool) -> np.ndarray:
+        """The sorted unique entries with the token, or with a token prefixed by it."""
+        tokens = self.tokens[TOKEN]
+        lo = tokens.search_sorted(token, "left")
+        hi = tokens.search_sorted(token + "\U0010ffff" if prefix else token, "right")
+        return np.unique(self._token_entries[lo:hi])
+
+    def _fuzzy_rows(
+        self, q_tokens: List[str], min_similarity: float
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        vocab = self.vocabulary()
+        starts = vocab["_start"].to_numpy().astype(np.int64)
+        counts = vocab["_count"].to_numpy().astype(np.int64)
+        totals = np.zeros(self.entries.height)
+        for t in q_tokens:
+            # The edit distance is at least the difference of the lengths.
+            max_edits = int((1 - min_similarity) * len(t) / min_similarity)
+            # The best similarity of the tokens of each entry.
+            best = np.zeros(self.entries.height)
+            for length in range(max(1, len(t) - max_edits), len(t) + max_edits + 1):
+                (vocab_rows, codes, counts_) = self._length_codes(length)
+                max_distance = int((1 - min_similarity) * max(len(t), length))
+                # Each character of the longest token missing from the other one
+                # takes at least one edit.
+                common = np.minimum(counts_, _char_counts(t)).sum(axis=1)
+                close = max(len(t), length) - common <= max_distance
+                (vocab_rows, codes) = (vocab_rows[close], codes[close])
+                distances = _edit_distances(t, codes, max_distance)
+                scores = 1 - distances / max(len(t), length)
+                ok = scores >= min_similarity
+                (vocab_rows, scores) = (vocab_rows[ok], scores[ok])
+                # The rows of the matched tokens in the tokens table.
+                n = counts[vocab_rows]
+                offsets = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+                pos = np.repeat(starts[vocab_rows], n) + offsets
+                np.maximum.at(best, self._token_entries[pos], np.repeat(scores, n))
+            totals += best
+        scores = totals / len(q_tokens)
+        rows = np.nonzero(scores >= min_similarity)[0]
+        return (rows, scores[rows])
+
+    def vocabulary(self) -> pl.DataFrame:
+        """
+        The distinct tokens, with their lengths, and the first row and the number
+        of rows of each one in the tokens table.
+        """
+        if self._vocabulary is None:
+            self._vocabulary = (
+                self.tokens.group_by(TOKEN, maintain_order=True)
+                .agg(pl.len().alias("_count"))
+                .with_columns(
+                    C(TOKEN).str.len_chars().alias("_len"),
+                    (C("_count").cum_sum() - C("_count")).alias("_start"),
+                )
+            )
+        return self._vocabulary
+
+    def _length_codes(self, length: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        The rows of the tokens of a length in the vocabulary, their code points
+        as an array of shape (tokens, length), and their character counts (see
+        `_char_counts`).
+        """
+        if length not in self._codes:
+            vocab = self.vocabulary()
+            rows = np.nonzero(vocab["_len"].to_numpy() == length)[0]
+            chars = "".join(vocab[TOKEN].gather(rows).to_list())
+            codes = np.frombuffer(chars.encode("utf-32-le"), dtype=np.uint32)
+            codes = codes.reshape(len(rows), length)
+            buckets = np.repeat(np.arange(len(rows)), length) * _num_buckets
+            counts = np.bincount(
+                buckets + codes.ravel() % _num_buckets,
+                minlength=len(rows) * _num_buckets,
+            )
+            self._codes[length] = (
+                rows,
+                codes,
+                counts.reshape(len(rows), _num_buckets).astype(np.int32),
+            )
+        return self._codes[length]
+
+    def _results(self, rows: np.ndarray, scores: np.ndarray) -> pl.DataFrame:
+        res = (
+            self.entries[rows]
+            .select(_name_columns)
+            .with_columns(pl.Series(SCORE, scores, dtype=pl.Float64))
+        )
+        # The shortest names first among the equal scores.
+        return res.sort(
+            by=[SCORE, C(SOURCE_NAME).str.len_chars(), SOURCE_ID],
+            descending=[True, False, False],
+        )
+
+
+def write_file_names(
+    core_p: Path, text_p: Path, year: int, gas: Gas, p: Union[Path, str]
+) -> Path:
+    """Writes the distinct names of a source file, and returns their path."""
+    df = pl.concat(
+        [
+            pl.scan_parquet(core_p).select(SOURCE_ID, ISO3_COUNTRY, SUBSECTOR),
+            pl.scan_parquet(text_p).select(SOURCE_NAME),
+        ],
+        how="horizontal_extend",
+    )
+    out_p = _source_path(_file_names_fname, year, gas, p)
+    (
+        df.filter(c_source_name.is_not_null())
+        .unique()
+        .select(_name_columns)
+        .sort(by=_name_columns)
+        .collect()
+        .write_parquet(out_p, compression="zstd")
+    )
+    return out_p
+
+
+def build_name_index(
+    p: Union[Path, str], dataset_version: Optional[str] = None
+) -> List[Path]:
+    """
+    Gathers the names of the source files of a version into the name index, and
+    returns the paths of its files.
+    """
+    dataset_version = dataset_version or version
+    paths = [
+        path
+        for year_ in _check_year(None)
+        for gas_ in _check_gas(GAS_LIST)
+        if (
+            path := _source_path(
+                _file_names_fname, year_, gas_, p, dataset_version=dataset_version
+            )
+        ).exists()
+    ]
+    assert paths, f"No names found for version {dataset_version} in {p}"
+    entries = (
+        pl.concat(
+            [
+                pl.scan_parquet(path).with_columns(
+                    c_iso3_country.cast(pl.String), c_subsector.cast(pl.String)
+                )
+                for path in paths
+            ]
+        )
+        .unique()
+        .with_columns(_normalize(c_source_name).alias(NAME))
+        .sort(by=[NAME, SOURCE_ID, ISO3_COUNTRY, SUBSECTOR])
+        .collect()
+    )
+    tokens = (
+        entries.select(
+            C(NAME).str.split(" ").alias(TOKEN),
+            pl.int_range(pl.len(), dtype=pl.UInt32).alias(ENTRY),
+        )
+        .explode(TOKEN, empty_as_null=False)
+        .filter(C(TOKEN) != "")
+        .unique()
+        .sort(by=[TOKEN, ENTRY])
+    )
+    names_p = Path(p) / _names_fname.format(version=dataset_version)
+    tokens_p = Path(p) / _tokens_fname.format(version=dataset_version)
+    entries.write_parquet(names_p, compression="zstd")
+    tokens.write_parquet(tokens_p, compression="zstd")
+    _logger.debug(f"name index of {entries.height} entries, {tokens.height} tokens")
+    _load_index.cache_clear()
+    return [names_p, tokens_p]
+
+
+def name_index(p: Union[Path, str, None] = None) -> NameIndex:
+    """
+    The name index of the source files in the given directory, or the
+    published one if None. It is loaded once and kept in memory.
+    """
+    return _load_index(str(p) if p is not None else None)
+
+
+def search_sources(
+    query: str,
+    p: Union[Path, str, None] = None,
+    mode: Mode = "prefix",
+    iso3_country: Union[str, List[str], None] = None,
+    subsector: Union[str, List[str], None] = None,
+    limit: Optional[int] = 20,
+) -> pl.DataFrame:
+    """
+    The sources matching a query on their names, best matches first (see
+    `NameIndex.search`).
+    """
+    return name_index(p).search(query, mode, iso3_country, subsector, limit)
+
+
+def read_sources_by_id(
+    source_ids: List[int],
+    gas: Union[Gas, List[Gas]],
+    year: Union[int, List[int], None] = None,
+    p: Union[Path, str, None] = None,
+    columns: Optional[List[str]] = None,
+) -> pl.DataFrame:
+    """
+    The records of the given sources.
+
+    The subsectors of the sources are taken from the name index, so that only
+    the row groups of these subsectors are read (see
+    `ctrace.stream.iter_source_batches`).
+    """
+    ids = sorted(set(source_ids))
+    known = name_index(p).entries.filter(c_source_id.is_in(ids))
+    filters: List[Filter] = [(SOURCE_ID, "in", ids)]
+    if known[SOURCE_ID].n_unique() == len(ids):
+        # The sources without a name may be in any subsector.
+        subsectors = known[SUBSECTOR].cast(pl.String).unique().sort().to_list()
+        filters.append((SUBSECTOR, "in", subsectors))
+    dfs = list(
+        iter_source_batches(
+            gas,
+            year,
+            Path(p) if p is not None else None,
+            columns,
+            filters,
+            output="polars",
+        )
+    )
+    if not dfs:
+        return read_source_emissions(gas, year, p, columns).head(0).collect()
+    return pl.concat(dfs)
+
+
+@functools.lru_cache(maxsize=4)
+def _load_index(p: Optional[str]) -> NameIndex:
+    def path(fname: str) -> Path:
+        name = fname.format(version=version)
+        if p is None:
+            from . import cache
+
+            return cache.fetch_hub(name)
+        return Path(p) / name
+
+    enum_cols = enums.column_enums()
+    entries = pl.read_parquet(path(_names_fname)).with_columns(
+        c_iso3_country.cast(enum_cols[ISO3_COUNTRY]),
+        c_subsector.cast(enum_cols[SUBSECTOR]),
+    )
+    tokens = pl.read_parquet(path(_tokens_fname))
+    return NameIndex(entries=entries, tokens=tokens)
+
+
+def _normalize(name: pl.Expr) -> pl.Expr:
+    return (
+        name.str.normalize("NFKD")
+        .str.replace_all(r"\p{Mn}", "")
+        .str.to_lowercase()
+        .str.replace_all(r"[^\p{L}\p{N}]+", " ")
+        .str.strip_chars()
+    )
+
+
+def _tokenize(query: str) -> List[str]:
+    name = pl.select(_normalize(pl.lit(query, pl.String))).item()
+    return [t for t in name.split(" ") if t]
+
+
+def _char_counts(token: str) -> np.ndarray:
+    """
+    The number of characters of a token in each bucket of code points. The
+    characters in common with another token are at most the sum of the minimum
+    counts of each bucket.
+    """
+    return np.bincount(
+        [ord(c) % _num_buckets for c in token], minlength=_num_buckets
+    ).astype(np.int32)
+
+
+def _edit_distances(a: str, codes: np.ndarray, max_distance: int) -> np.ndarray:
+    """
+    The edit distances of a string to strings of the same length, given by the
+    array of their code points, where a transposition is one edit. The distances
+    above max_distance are returned as max_distance + 1.
+
+    The rows of the dynamic programming table are computed for all the strings
+    at once, and the insertions within a row are a running minimum. The strings
+    are dropped as soon as their distance is known to exceed max_distance.
+    """
+    (n, length) = codes.shape
+    res = np.full(n, max_distance + 1, dtype=np.int32)
+    q = np.array([ord(c) for c in a], dtype=np.uint32)
+    j = np.arange(length + 1, dtype=np.int32)
+    alive = np.arange(n)
+    prev = np.broadcast_to(j, (n, length + 1))
+    (prev2, prev_min) = (prev, np.zeros(n, dtype=np.int32))
+    for i in range(1, len(a) + 1):
+        cur = np.empty((len(alive), length + 1), dtype=np.int32)
+        cur[:, 0] = i
+        cur[:, 1:] = np.minimum(prev[:, 1:] + 1, prev[:, :-1] + (codes != q[i - 1]))
+        if i > 1 and length > 1:
+            swap = (codes[:, :-1] == q[i - 1]) & (codes[:, 1:] == q[i - 2])
+            cur[:, 2:] = np.where(
+                swap, np.minimum(cur[:, 2:], prev2[:, :-2] + 1), cur[:, 2:]
+            )
+        cur = np.minimum.accumulate(cur - j, axis=1) + j
+        # The next rows are at least the minimum of this row, or of the previous
+        # row plus one (a transposition).
+        cur_min = cur.min(axis=1)
+        keep = (cur_min <= max_distance) | (prev_min < max_distance)
+        if not keep.all():
+            (alive, codes, cur, prev) = (
+                alive[keep],
+                codes[keep],
+                cur[keep],
+                prev[keep],
+            )
+            cur_min = cur_min[keep]
+        (prev2, prev, prev_min) = (prev, cur, cur_min)
+    res[alive] = np.minimum(prev[:, length], max_distance + 1)
+    return res
+
+
+def _as_list(v: Union[str, List[str]]) -> List[str]:
+    return [v] if isinstance(v, str) else list(v)
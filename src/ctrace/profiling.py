@@ -0,0 +1,275 @@
+"""
+Profiling of the queries on the source emissions.
+
+When a query is slow, the profile tells which files it opened, how many row
+groups it read in each of them, and how many bytes and columns it decoded. The
+query runs on the streaming engine of Polars, like the queries of this package,
+and the row groups actually read are taken from the messages of the Parquet
+reader of Polars.
+
+The main function is `profile_source_query`, which runs a query on the source
+emissions like `read_source_emissions` and returns its result with a
+`QueryProfile`. The profile converts to a plain dictionary with `to_dict`, for
+structured logs.
+"""
+
+import contextlib
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+import polars as pl
+
+from .constants import *
+from .data import (
+    Filter,
+    _check_gas,
+    _check_year,
+    _collect_streaming,
+    _filters_expr,
+    _row_group_may_match,
+    _row_group_stats,
+    _source_columns,
+    _source_fname,
+    _source_path,
+    _source_text_fname,
+    read_source_emissions,
+)
+
+_logger = logging.getLogger(__name__)
+
+# The lines of the optimized plan describing a scan, and its projection and
+# pushed-down predicate.
+_scan_re = re.compile(r"Parquet SCAN \[(?P<path>[^\]]+)\]")
+_project_re = re.compile(r"PROJECT (?P<k>\d+)/(?P<n>\d+) COLUMNS")
+_selection_re = re.compile(r"SELECTION: (?P<predicate>.+)")
+# The message of the Parquet reader of Polars, in verbose mode.
+_row_groups_re = re.compile(r"reading (?P<read>\d+) / (?P<total>\d+) row groups")
+
+# Only one query at a time redirects the standard error.
+_stderr_lock = threading.Lock()
+
+
+@dataclass
+class FileScan:
+    """
+    The reads of a query in one file.
+
+    num_row_groups: the number of row groups of the file.
+    estimated_row_groups: the row groups that may match the filters, according to
+      their statistics, if the filters are pushed down to the scan. Otherwise, all
+      the row groups. This is an estimate: Polars may read more row groups, when
+      it cannot use the statistics (see `QueryProfile.row_groups_read`).
+    num_columns: the number of columns decoded by Polars, out of the columns
+      of the file (`file_columns`).
+    columns: the columns decoded, when they can be told from the plan and the
+      query, or else the columns requested from the file.
+    predicate: the predicate pushed down to the scan by Polars, if any.
+    bytes_read: the compressed size of `columns` in the estimated row groups.
+      This is an upper bound if `columns` holds more than `num_columns` columns.
+    """
+
+    path: str
+    num_row_groups: int
+    estimated_row_groups: List[int]
+    num_columns: int
+    file_columns: int
+    columns: List[str]
+    predicate: Optional[str]
+    bytes_read: int
+
+    @property
+    def estimated_row_groups_skipped(self) -> int:
+        """The number of row groups that their statistics allow to skip."""
+        return self.num_row_groups - len(self.estimated_row_groups)
+
+
+@dataclass
+class QueryProfile:
+    """
+    The profile of a query.
+
+    seconds: the time of the query on the streaming engine. Polars does not
+      time the operators of this engine.
+    files: the reads in each file of the plan.
+    row_groups_read: the (read, total) row groups reported by each Parquet reader
+      of Polars, in the order of the reports. Empty if this version of Polars
+      does not report them.
+    """
+
+    num_rows: int
+    seconds: float
+    files: List[FileScan]
+    row_groups_read: List[Tuple[int, int]] = field(default_factory=list)
+
+    @property
+    def bytes_read(self) -> int:
+        """The compressed size of the columns read in all the files."""
+        return sum(f.bytes_read for f in self.files)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """The profile as a dictionary of plain values, for the logs."""
+        d = asdict(self)
+        for f, f_d in zip(self.files, d["files"], strict=True):
+            f_d["estimated_row_groups_skipped"] = f.estimated_row_groups_skipped
+        d["bytes_read"] = self.bytes_read
+        return d
+
+
+def profile_source_query(
+    gas: Union[Gas, List[Gas]],
+    year: Union[int, List[int], None] = None,
+    p: Union[Path, str, None] = None,
+    columns: Optional[List[str]] = None,
+    filters: Optional[List[Filter]] = None,
+    query: Optional[Callable[[pl.LazyFrame], pl.LazyFrame]] = None,
+) -> Tuple[pl.DataFrame, QueryProfile]:
+    """
+    Runs a query on the source emissions, and profiles it.
+
+    gas, year, p, columns: the records to read (see `read_source_emissions`).
+    filters: conditions on the records (see `ctrace.stream.iter_source_batches`).
+    query: the rest of the query (aggregations, ...), applied to the filtered
+      records.
+
+    Returns the result of the query and its profile.
+    """
+    ys = _check_year(year)
+    gases = _check_gas(gas)
+    filters = filters or []
+    lf = read_source_emissions(gases, ys, p, columns)
+    if filters:
+        lf = lf.filter(_filters_expr(filters))
+    if query is not None:
+        lf = query(lf)
+    scans = _plan_scans(lf.explain())
+    out_cols = lf.collect_schema().names()
+    start = time.perf_counter()
+    with _captured_stderr() as log, pl.Config(verbose=True):
+        df = _collect_streaming(lf)
+    seconds = time.perf_counter() - start
+    files = []
+    for year_ in ys:
+        for gas_ in gases:
+            for fname in [_source_fname, _source_text_fname]:
+                path = _source_path(fname, year_, gas_, p)
+                if str(path) in scans:
+                    files.append(
+                        _file_scan(path, scans[str(path)], columns, filters, out_cols)
+                    )
+    profile = QueryProfile(
+        num_rows=df.height,
+        seconds=seconds,
+        files=files,
+        row_groups_read=[
+            (int(m["read"]), int(m["total"]))
+            for m in _row_groups_re.finditer("".join(log))
+        ],
+    )
+    _logger.debug(f"profile: {profile.to_dict()}")
+    return (df, profile)
+
+
+def _plan_scans(plan: str) -> Dict[str, Tuple[Optional[int], Optional[str]]]:
+    """The projected number of columns and the predicate of each scanned file."""
+    scans: Dict[str, Tuple[Optional[int], Optional[str]]] = {}
+    path = None
+    for line in plan.splitlines():
+        m = _scan_re.search(line)
+        if m is not None:
+            path = m["path"]
+            scans[path] = (None, None)
+            continue
+        if path is None:
+            continue
+        (k, predicate) = scans[path]
+        if (m := _project_re.search(line)) is not None:
+            scans[path] = (int(m["k"]), predicate)
+        elif (m := _selection_re.search(line)) is not None:
+            scans[path] = (k, m["predicate"].strip())
+        elif "ESTIMATED ROWS" not in line:
+            path = None
+    return scans
+
+
+def _file_scan(
+    path: Path,
+    scan: Tuple[Optional[int], Optional[str]],
+    columns: Optional[List[str]],
+    filters: List[Filter],
+    out_cols: List[str],
+) -> FileScan:
+    import pyarrow.parquet
+
+    (num_columns, predicate) = scan
+    md = pyarrow.parquet.ParquetFile(path).metadata
+    file_cols = [md.schema.column(i).name for i in range(md.num_columns)]
+    (sel_cols, _) = _source_columns(file_cols, columns)
+    filter_cols = [c for (c, _, _) in filters]
+    read_cols = [c for c in file_cols if c in sel_cols or c in filter_cols]
+    # Polars only tells the number of decoded columns. They are the columns of
+    # the output and of the filters, unless the query uses other columns.
+    needed_cols = [c for c in read_cols if c in out_cols or c in filter_cols]
+    if num_columns is not None and len(needed_cols) == num_columns:
+        read_cols = needed_cols
+    selected = []
+    bytes_read = 0
+    for i in range(md.num_row_groups):
+        rg_md = md.row_group(i)
+        if predicate is not None and not _row_group_may_match(
+            _row_group_stats(rg_md), filters
+        ):
+            continue
+        selected.append(i)
+        for j in range(rg_md.num_columns):
+            col_md = rg_md.column(j)
+            if col_md.path_in_schema in read_cols:
+                bytes_read += col_md.total_compressed_size
+    return FileScan(
+        path=str(path),
+        num_row_groups=md.num_row_groups,
+        estimated_row_groups=selected,
+        num_columns=len(file_cols) if num_columns is None else num_columns,
+        file_columns=len(file_cols),
+        columns=read_cols,
+        predicate=predicate,
+        bytes_read=bytes_read,
+    )
+
+
+@contextlib.contextmanager
+def _captured_stderr() -> Iterator[List[str]]:
+    """
+    Redirects the standard error of the process, which receives the messages of
+    Polars, to a temporary file. The captured text is appended to the yielded
+    list on exit, and written back to the standard error.
+
+    The redirection applies to the whole process, not only to the query: while
+    it runs, whatever the other threads write to the standard error (warnings,
+    log handlers, native libraries) is also captured, and only appears once the
+    query ends. It is not lost, but the profiled queries are best run when the
+    process is otherwise idle. The queries are profiled one at a time.
+    """
+    with _stderr_lock, tempfile.TemporaryFile() as f:
+        sys.stderr.flush()
+        captured: List[str] = []
+        saved_fd = os.dup(2)
+        os.dup2(f.fileno(), 2)
+        try:
+            yield captured
+        finally:
+            sys.stderr.flush()
+            os.dup2(saved_fd, 2)
+            os.close(saved_fd)
+            f.seek(0)
+            data = f.read()
+            captured.append(data.decode(errors="replace"))
+            while data:
+                data = data[os.write(2, data) :]
@@ -0,0 +1,181 @@
+"""
+Ranking of the largest emitters.
+
+The main function is `top_emitters`, which returns the largest emission records
+of each group without sorting or materializing the whole dataset.
+"""
+
+import heapq
+import itertools
+import logging
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import polars as pl
+import pyarrow.parquet
+from polars import col as C
+
+from . import enums
+from .constants import *
+from .data import (
+    Filter,
+    _check_gas,
+    _check_year,
+    _filters_expr,
+    _row_group_may_match,
+    _row_group_stats,
+    _source_fname,
+    _source_path,
+)
+
+_logger = logging.getLogger(__name__)
+
+RANK = "rank"
+
+
+def top_emitters(
+    gas: Union[Gas, List[Gas]],
+    year: Union[int, List[int], None] = None,
+    k: int = 100,
+    by: Optional[List[str]] = None,
+    columns: Optional[List[str]] = None,
+    filters: Optional[List[Filter]] = None,
+    p: Optional[Path] = None,
+) -> pl.DataFrame:
+    """
+    Returns the k largest emission records (by `emissions_quantity`) for each
+    group of the `by` columns. If `by` is empty or None, the k largest records
+    overall are returned.
+
+    The source files are streamed by row group, keeping at most k records per
+    group in memory. The row groups that cannot contain any record larger than the
+    current k-th record of their groups are skipped based on their statistics.
+
+    columns: extra columns to return for each record (by default, the source id and
+      the start time). The text columns are not available.
+    filters: conditions on the records, as a list of (column, operator, value).
+      They are also used to skip the row groups.
+
+    Returns a dataframe with the group columns, the requested columns, the emissions
+    and the rank within each group (starting at 1), sorted by group and rank.
+    """
+    assert k > 0, k
+    ys = _check_year(year)
+    gases = _check_gas(gas)
+    by = by or []
+    filters = filters or []
+    columns = columns or [SOURCE_ID, START_TIME]
+    bad_cols = [c for c in columns if c in text_columns]
+    assert not bad_cols, f"Text columns are not supported: {bad_cols}"
+    out_cols = list(dict.fromkeys(by + columns + [EMISSIONS_QUANTITY]))
+    read_cols = list(dict.fromkeys(out_cols + [f[0] for f in filters]))
+    value_idx = out_cols.index(EMISSIONS_QUANTITY)
+    heaps: Dict[tuple, List[Tuple[float, int, tuple]]] = {}
+    counter = itertools.count()
+    schema = None
+    (num_read, num_skipped) = (0, 0)
+    for year_ in ys:
+        for gas_ in gases:
+            local_p = _source_path(_source_fname, year_, gas_, p)
+            pq_file = pyarrow.parquet.ParquetFile(local_p)
+            for rg in range(pq_file.num_row_groups):
+                stats = _row_group_stats(pq_file.metadata.row_group(rg))
+                if not _row_group_may_match(stats, filters) or not _may_contribute(
+                    stats, by, heaps, k
+                ):
+                    num_skipped += 1
+                    continue
+                num_read += 1
+                df = _top_k_row_group(pq_file, rg, read_cols, out_cols, by, filters, k)
+                schema = schema or df.schema
+                for row in df.iter_rows():
+                    key = row[: len(by)]
+                    value = row[value_idx]
+                    item = (value, next(counter), row)
+                    heap = heaps.setdefault(key, [])
+                    if len(heap) < k:
+                        heapq.heappush(heap, item)
+                    elif value > heap[0][0]:
+                        heapq.heapreplace(heap, item)
+    _logger.debug(f"top_emitters: read {num_read} row groups, skipped {num_skipped}")
+    rows = [item[2] for heap in heaps.values() for item in heap]
+    if rows:
+        res = pl.DataFrame(rows, schema=schema, orient="row")
+    else:
+        res = pl.DataFrame(pl.from_arrow(pq_file.schema_arrow.empty_table()))
+        res = res.select(out_cols)
+    rank = C(EMISSIONS_QUANTITY).rank(method="ordinal", descending=True)
+    return (
+        res.pipe(_cast_enums)
+        .sort(by=by + [EMISSIONS_QUANTITY], descending=[False] * len(by) + [True])
+        .with_columns((rank.over(by) if by else rank).alias(RANK))
+    )
+
+
+def _top_k_row_group(
+    pq_file: pyarrow.parquet.ParquetFile,
+    rg: int,
+    read_cols: List[str],
+    out_cols: List[str],
+    by: List[str],
+    filters: List[Filter],
+    k: int,
+) -> pl.DataFrame:
+    """The top k records of each group within a row group."""
+    tb = pq_file.read_row_group(rg, columns=read_cols)
+    df = pl.from_arrow(tb)
+    assert isinstance(df, pl.DataFrame)
+    df = df.filter(_filters_expr(filters), c_emissions_quantity.is_not_null())
+    if by:
+        return (
+            df.group_by(by)
+            .agg(pl.all().top_k_by(EMISSIONS_QUANTITY, k))
+            .explode([c for c in out_cols if c not in by], empty_as_null=False)
+            .select(out_cols)
+        )
+    return df.top_k(k, by=EMISSIONS_QUANTITY).select(out_cols)
+
+
+def _may_contribute(
+    stats: Dict[str, Tuple[Any, Any]],
+    by: List[str],
+    heaps: Dict[tuple, List[Tuple[float, int, tuple]]],
+    k: int,
+) -> bool:
+    """
+    False if the statistics of a row group prove that none of its records can
+    enter the top k of its groups.
+    """
+    if EMISSIONS_QUANTITY not in stats:
+        return True
+    max_value = stats[EMISSIONS_QUANTITY][1]
+    # Enumerates the groups that may be in the row group, using the known values
+    # of the enumerated columns.
+    enum_values = enums.column_enums()
+    candidates: List[List[Any]] = []
+    for b in by:
+        if b not in stats:
+            return True
+        (lo, hi) = stats[b]
+        if lo == hi:
+            candidates.append([lo])
+        elif b in enum_values:
+            values = enum_values[b].categories
+            candidates.append([v for v in values if lo <= v <= hi])
+        else:
+            return True
+    for key in itertools.product(*candidates):
+        heap = heaps.get(tuple(key))
+        if heap is None or len(heap) < k or heap[0][0] < max_value:
+            return True
+    return False
+
+
+def _cast_enums(df: pl.DataFrame) -> pl.DataFrame:
+    return df.with_columns(
+        [
+            C(c).cast(pl.String).cast(e)
+            for c, e in enums.column_enums().items()
+            if c in df.columns
+        ]
+    )
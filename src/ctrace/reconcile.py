@@ -0,0 +1,167 @@
+"""
+Consistency checks between the source emissions and the country emissions.
+
+The main function is `reconcile`, which aggregates the source emissions to the
+level of the country emissions and reports the differences between both.
+"""
+
+import concurrent.futures
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+import polars as pl
+from polars import col as C
+
+from .constants import *
+from .data import (
+    _check_gas,
+    _check_year,
+    _collect_streaming,
+    read_country_emissions,
+    read_source_emissions,
+)
+
+_logger = logging.getLogger(__name__)
+
+# Output columns
+MONTH = "month"
+SOURCE_EMISSIONS = "source_emissions"
+COUNTRY_EMISSIONS = "country_emissions"
+ABS_GAP = "abs_gap"
+REL_GAP = "rel_gap"
+
+_keys = [ISO3_COUNTRY, SECTOR, SUBSECTOR, GAS, MONTH]
+
+
+@dataclass
+class Reconciliation:
+    """
+    The result of the reconciliation between sources and countries.
+
+    gaps: for each (iso3_country, sector, subsector, gas, month), the total
+      emissions from the sources and from the countries, and their absolute and
+      relative differences. Missing values mean that the key is absent on one side.
+    missing_co2e: the (year, sector, subsector) with emissions for some gases but
+      without co2e_100yr emissions.
+    excluded: the number of source records of the excluded countries, by year,
+      gas and iso3_country.
+    """
+
+    gaps: pl.DataFrame
+    missing_co2e: pl.DataFrame
+    excluded: pl.DataFrame
+
+    def mismatches(self, rel_tol: float = 0.01, abs_tol: float = 1.0) -> pl.DataFrame:
+        """The gaps larger than the given tolerances, or present on one side only."""
+        return self.gaps.filter(
+            C(SOURCE_EMISSIONS).is_null()
+            | C(COUNTRY_EMISSIONS).is_null()
+            | ((C(ABS_GAP).abs() > abs_tol) & (C(REL_GAP).abs() > rel_tol))
+        ).sort(by=ABS_GAP, descending=True, nulls_last=True)
+
+
+def reconcile(
+    gas: Union[Gas, List[Gas]] = GAS_LIST,
+    year: Union[int, List[int], None] = None,
+    p: Optional[Path] = None,
+    country_path: Optional[Path] = None,
+    max_workers: Optional[int] = None,
+) -> Reconciliation:
+    """
+    Compares the source emissions with the country emissions.
+
+    The source emissions are aggregated by (iso3_country, sector, subsector, gas,
+    month), each year and gas in parallel and with the streaming engine,
+    so that the memory stays bounded even when checking all the years.
+
+    p: the directory of the source files (see `read_source_emissions`).
+    country_path: the parquet file of the country emissions (see
+      `read_country_emissions`).
+    """
+    ys = _check_year(year)
+    gases = _check_gas(gas)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(_aggregate_sources, gas_, year_, p)
+            for year_ in ys
+            for gas_ in gases
+        ]
+        aggs = [fut.result() for fut in futures]
+    sdf = pl.concat([agg for (agg, _) in aggs])
+    excluded = pl.concat([exc for (_, exc) in aggs])
+    cdf = (
+        read_country_emissions(gases, parquet_path=country_path)
+        .filter(c_start_time.dt.year().is_in(ys))
+        .group_by(
+            c_iso3_country,
+            c_sector,
+            c_subsector,
+            c_gas,
+            c_start_time.dt.truncate("1mo").alias(MONTH),
+        )
+        .agg(c_emissions_quantity.sum().alias(COUNTRY_EMISSIONS))
+    )
+    gaps = (
+        sdf.join(cdf, on=_keys, how="full", coalesce=True)
+        .with_columns(
+            (C(SOURCE_EMISSIONS) - C(COUNTRY_EMISSIONS)).alias(ABS_GAP),
+        )
+        .with_columns(
+            (C(ABS_GAP) / C(COUNTRY_EMISSIONS).abs()).alias(REL_GAP),
+        )
+        .sort(by=_keys)
+    )
+    return Reconciliation(
+        gaps=gaps,
+        missing_co2e=_missing_co2e(sdf, gases),
+        excluded=excluded,
+    )
+
+
+def _aggregate_sources(
+    gas: Gas, year: int, p: Optional[Path]
+) -> Tuple[pl.DataFrame, pl.DataFrame]:
+    _logger.debug(f"aggregating sources for year={year} gas={gas}")
+    lf = read_source_emissions(
+        gas,
+        year,
+        p,
+        columns=[ISO3_COUNTRY, SECTOR, SUBSECTOR, GAS, START_TIME, EMISSIONS_QUANTITY],
+    )
+    agg = lf.group_by(
+        c_iso3_country,
+        c_sector,
+        c_subsector,
+        c_gas,
+        c_start_time.dt.truncate("1mo").alias(MONTH),
+    ).agg(c_emissions_quantity.sum().alias(SOURCE_EMISSIONS))
+    excluded = (
+        lf.filter(c_iso3_country.cast(pl.String).is_in(EXCLUDED_ISO3_COUNTRIES))
+        .group_by(c_iso3_country, c_gas)
+        .agg(pl.len())
+        .with_columns(pl.lit(year).alias("year"))
+    )
+    return (_collect_streaming(agg), _collect_streaming(excluded))
+
+
+def _missing_co2e(sdf: pl.DataFrame, gases: List[Gas]) -> pl.DataFrame:
+    by_gas = (
+        sdf.group_by(C(MONTH).dt.year().alias("year"), c_sector, c_subsector, c_gas)
+        .agg(C(SOURCE_EMISSIONS).sum())
+        .with_columns(c_gas.cast(pl.String))
+        .pivot(on=GAS, index=["year", SECTOR, SUBSECTOR], values=SOURCE_EMISSIONS)
+    )
+    if CO2E_100YR not in gases:
+        _logger.warning("co2e_100yr not requested, skipping the co2e check")
+        return by_gas.limit(0)
+    others = [g for g in gases if g != CO2E_100YR and g in by_gas.columns]
+    if not others:
+        # No base gas to compare with.
+        return by_gas.limit(0)
+    if CO2E_100YR not in by_gas.columns:
+        by_gas = by_gas.with_columns(pl.lit(None, pl.Float64).alias(CO2E_100YR))
+    return by_gas.filter(
+        C(CO2E_100YR).is_null() & pl.any_horizontal([C(g) != 0 for g in others])
+    ).sort(by=["year", SECTOR, SUBSECTOR])
@@ -0,0 +1,376 @@
+"""
+Assignment of the sources to user-supplied regions.
+
+The regions (states, grid zones, ...) are given as polygons in longitude /
+latitude. A `RegionIndex` is built once over the polygons: a regular grid that
+records, for each cell, the region that covers the whole cell, or the regions
+whose boundary crosses the cell. The points are then located by batches with
+NumPy: most points fall in a covered cell and need no test, and the others are
+only tested against the edges of the candidate regions in the same band of
+latitude.
+
+The main functions are `RegionIndex.locate`, for arrays of coordinates, and
+`assign_regions`, which assigns the sources of the dataset to the regions.
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import polars as pl
+from polars import col as C
+
+from .constants import *
+from .data import _check_gas, _check_year, read_source_emissions
+
+_logger = logging.getLogger(__name__)
+
+# A ring of (lon, lat) points. It may or may not repeat the first point at the end.
+Ring = Sequence[Tuple[float, float]]
+
+# Output columns
+REGION_ID = "region_id"
+
+
+class RegionIndex:
+    """
+    A spatial index over polygons, to locate points in the polygons.
+
+    regions: for each region ID, the rings of its polygons, in (lon, lat). The
+      inside of a region follows the even-odd rule over all its rings: the holes
+      and the parts of multi-polygons can be listed as additional rings.
+    cell_size: the size of the cells of the index, in degrees. Smaller cells
+      spend more memory on the index and leave fewer points to test.
+
+    The regions should not overlap. A point in several regions is assigned to
+    one of them.
+    """
+
+    def __init__(self, regions: Dict[str, List[Ring]], cell_size: float = 1.0):
+        assert regions, "no region"
+        assert cell_size > 0, cell_size
+        self.region_ids = list(regions)
+        self.cell_size = cell_size
+        # The (x1, y1, x2, y2) of the edges of each region.
+        self._edges = [_ring_edges(regions[r]) for r in self.region_ids]
+        all_edges = np.concatenate(self._edges)
+        self._lon0 = float(np.floor(min(all_edges[:, 0].min(), all_edges[:, 2].min())))
+        self._lat0 = float(np.floor(min(all_edges[:, 1].min(), all_edges[:, 3].min())))
+        lon1 = max(all_edges[:, 0].max(), all_edges[:, 2].max())
+        lat1 = max(all_edges[:, 1].max(), all_edges[:, 3].max())
+        self._n_lon = int(np.floor((lon1 - self._lon0) / cell_size)) + 1
+        self._n_lat = int(np.floor((lat1 - self._lat0) / cell_size)) + 1
+        # The region covering each cell, or -1.
+        self._inside = np.full(self._n_lat * self._n_lon, -1, dtype=np.int32)
+        # The (cell, region) pairs of the cells crossed by the boundary of a
+        # region, sorted by cell.
+        b_cells: List[np.ndarray] = []
+        b_regions: List[np.ndarray] = []
+        # For each region, the edges of each row of cells: the edges of the row i
+        # are row_edges[starts[i]:starts[i + 1]].
+        self._row_edges: List[Tuple[np.ndarray, np.ndarray]] = []
+        for r, edges in enumerate(self._edges):
+            ((edge_idx, edge_rows), edge_cells) = self._edge_cells(edges)
+            order = np.argsort(edge_rows, kind="stable")
+            starts = np.searchsorted(edge_rows[order], np.arange(self._n_lat + 1))
+            self._row_edges.append((edge_idx[order], starts))
+            cells = np.unique(edge_cells)
+            b_cells.append(cells)
+            b_regions.append(np.full(len(cells), r, dtype=np.int32))
+            self._fill_inside(r, edges, cells)
+        cells_ = np.concatenate(b_cells)
+        order = np.argsort(cells_, kind="stable")
+        self._b_cells = cells_[order]
+        self._b_regions = np.concatenate(b_regions)[order]
+        # The assignments of the sources (see `assign_regions`).
+        self._assignments: Optional[pl.DataFrame] = None
+        _logger.debug(
+            f"region index: {len(self.region_ids)} regions, {len(all_edges)} edges,"
+            f" {self._n_lat}x{self._n_lon} cells, {len(self._b_cells)} boundary cells"
+        )
+
+    @classmethod
+    def from_geojson(
+        cls,
+        geojson: Union[Dict[str, Any], Path, str],
+        id_property: str,
+        cell_size: float = 1.0,
+    ) -> "RegionIndex":
+        """
+        Builds the index from a GeoJSON FeatureCollection of Polygon and
+        MultiPolygon features (as a dictionary or a path).
+
+        id_property: the property of the features with the region IDs.
+        """
+        data = geojson
+        if not isinstance(data, dict):
+            data = json.loads(Path(data).read_text())
+        regions: Dict[str, List[Ring]] = {}
+        for feature in data["features"]:
+            geom = feature["geometry"]
+            region_id = str(feature["properties"][id_property])
+            if geom["type"] == "Polygon":
+                rings = geom["coordinates"]
+            elif geom["type"] == "MultiPolygon":
+                rings = [ring for poly in geom["coordinates"] for ring in poly]
+            else:
+                raise ValueError(f"Unsupported geometry {geom['type']} for {region_id}")
+            regions.setdefault(region_id, []).extend(rings)
+        return cls(regions, cell_size)
+
+    def fingerprint(self) -> str:
+        """A hash of the regions, which identifies the assignments of the index."""
+        h = hashlib.sha256()
+        for region_id, edges in zip(self.region_ids, self._edges, strict=True):
+            h.update(region_id.encode("utf-8"))
+            h.update(edges.tobytes())
+        return h.hexdigest()
+
+    def locate(
+        self,
+        lat: np.ndarray,
+        lon: np.ndarray,
+        chunk_size: int = 100_000,
+        max_workers: Optional[int] = None,
+    ) -> np.ndarray:
+        """
+        The index in `region_ids` of the region of each point, or -1 for the points
+        outside of all the regions (or without coordinates).
+
+        The points are located by chunks of `chunk_size`, in parallel with
+        `max_workers` threads (by default one per core).
+        """
+        assert chunk_size > 0, chunk_size
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        assert lat.shape == lon.shape, (lat.shape, lon.shape)
+        chunks = [
+            (lat[start : start + chunk_size], lon[start : start + chunk_size])
+            for start in range(0, len(lat), chunk_size)
+        ]
+        if len(chunks) <= 1:
+            res = [self._locate(y, x) for (y, x) in chunks]
+        else:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers or os.cpu_count()
+            ) as executor:
+                res = list(executor.map(lambda c: self._locate(*c), chunks))
+        return np.concatenate(res) if res else np.zeros(0, dtype=np.int32)
+
+    def _locate(self, y: np.ndarray, x: np.ndarray) -> np.ndarray:
+        out = np.full(len(y), -1, dtype=np.int32)
+        with np.errstate(invalid="ignore"):
+            i = np.floor((y - self._lat0) / self.cell_size)
+            j = np.floor((x - self._lon0) / self.cell_size)
+            valid = (i >= 0) & (i < self._n_lat) & (j >= 0) & (j < self._n_lon)
+        pts = np.flatnonzero(valid)
+        cells = i[pts].astype(np.int64) * self._n_lon + j[pts].astype(np.int64)
+        out[pts] = self._inside[cells]
+        # The points in the cells that are not covered by a region are tested
+        # against the regions whose boundary crosses their cell.
+        todo = out[pts] == -1
+        (pts, cells) = (pts[todo], cells[todo])
+        if len(pts) == 0:
+            return out
+        lo = np.searchsorted(self._b_cells, cells, side="left")
+        hi = np.searchsorted(self._b_cells, cells, side="right")
+        (owner, pair) = _expand(lo, hi - 1)
+        cand_pts = pts[owner]
+        cand_regions = self._b_regions[pair]
+        order = np.argsort(cand_regions, kind="stable")
+        (cand_pts, cand_regions) = (cand_pts[order], cand_regions[order])
+        (regions, starts) = np.unique(cand_regions, return_index=True)
+        ends = _group_ends(starts, len(cand_regions))
+        for r, start, end in zip(regions, starts, ends, strict=True):
+            p = cand_pts[start:end]
+            p = p[out[p] == -1]
+            if len(p) == 0:
+                continue
+            inside = self._contains(int(r), y[p], x[p])
+            out[p[inside]] = r
+        return out
+
+    def _edge_cells(
+        self, edges: np.ndarray
+    ) -> Tuple[Tuple[np.ndarray, np.ndarray], np.ndarray]:
+        """The rows of each edge, and the cells of the bounding boxes of the edges."""
+        i0 = self._row(np.minimum(edges[:, 1], edges[:, 3]))
+        i1 = self._row(np.maximum(edges[:, 1], edges[:, 3]))
+        j0 = self._col(np.minimum(edges[:, 0], edges[:, 2]))
+        j1 = self._col(np.maximum(edges[:, 0], edges[:, 2]))
+        (edge_idx, edge_rows) = _expand(i0, i1)
+        (pair, cols) = _expand(j0[edge_idx], j1[edge_idx])
+        cells = edge_rows[pair] * self._n_lon + cols
+        return ((edge_idx, edge_rows), cells)
+
+    def _fill_inside(self, r: int, edges: np.ndarray, boundary: np.ndarray) -> None:
+        """Marks the cells of the region that its boundary does not cross."""
+        (i0, i1) = (
+            self._row(edges[:, [1, 3]].min()),
+            self._row(edges[:, [1, 3]].max()),
+        )
+        (j0, j1) = (
+            self._col(edges[:, [0, 2]].min()),
+            self._col(edges[:, [0, 2]].max()),
+        )
+        (ii, jj) = np.meshgrid(
+            np.arange(int(i0), int(i1) + 1), np.arange(int(j0), int(j1) + 1)
+        )
+        cells = (ii * self._n_lon + jj).ravel()
+        cells = cells[~np.isin(cells, boundary) & (self._inside[cells] == -1)]
+        if len(cells) == 0:
+            return
+        # The boundary does not cross these cells: each one is either entirely
+        # inside or entirely outside of the region, like its center.
+        y = self._lat0 + (cells // self._n_lon + 0.5) * self.cell_size
+        x = self._lon0 + (cells % self._n_lon + 0.5) * self.cell_size
+        self._inside[cells[self._contains(r, y, x)]] = r
+
+    def _contains(
+        self, r: int, y: np.ndarray, x: np.ndarray, max_elements: int = 1_000_000
+    ) -> np.ndarray:
+        """Even-odd test of the points in the region, by rows of cells."""
+        res = np.zeros(len(y), dtype=bool)
+        if len(y) == 0:
+            return res
+        (row_edges, starts) = self._row_edges[r]
+        edges = self._edges[r]
+        rows = self._row(y)
+        order = np.argsort(rows, kind="stable")
+        (uniq, row_starts) = np.unique(rows[order], return_index=True)
+        row_ends = _group_ends(row_starts, len(order))
+        for row, start, end in zip(uniq, row_starts, row_ends, strict=True):
+            e = edges[row_edges[starts[row] : starts[row + 1]]]
+            if len(e) == 0:
+                continue
+            (x1, y1, x2, y2) = (e[:, 0], e[:, 1], e[:, 2], e[:, 3])
+            step = max(1, max_elements // len(e))
+            for s in range(start, end, step):
+                p = order[s : min(s + step, end)]
+                py = y[p][:, None]
+                px = x[p][:, None]
+                # Crossings of the edges by the ray from the point towards +x.
+                spans = (y1 > py) != (y2 > py)
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    x_cross = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+                crossings = np.count_nonzero(spans & (px < x_cross), axis=1)
+                res[p] = crossings % 2 == 1
+        return res
+
+    def _row(self, y: Union[np.ndarray, float]) -> np.ndarray:
+        i = np.floor((np.asarray(y) - self._lat0) / self.cell_size).astype(np.int64)
+        return np.clip(i, 0, self._n_lat - 1)
+
+    def _col(self, x: Union[np.ndarray, float]) -> np.ndarray:
+        j = np.floor((np.asarray(x) - self._lon0) / self.cell_size).astype(np.int64)
+        return np.clip(j, 0, self._n_lon - 1)
+
+
+def assign_regions(
+    index: RegionIndex,
+    gas: Union[Gas, List[Gas]],
+    year: Union[int, List[int], None] = None,
+    p: Optional[Path] = None,
+    chunk_size: int = 100_000,
+    max_workers: Optional[int] = None,
+    cache_dir: Optional[Path] = None,
+) -> pl.DataFrame:
+    """
+    The region of each source of the given gases and years.
+
+    Returns a dataframe with the source IDs and the region IDs (null outside of
+    all the regions), which can be joined to the frames of `read_source_emissions`
+    on the source ID.
+
+    The assignment of each source is cached in the index, and in `cache_dir` if
+    provided: the later calls only locate the sources that were not seen yet.
+    The sources are assumed to keep the same coordinates across years and gases.
+    """
+    sources = (
+        read_source_emissions(
+            _check_gas(gas), _check_year(year), p, columns=[SOURCE_ID, LAT, LON]
+        )
+        .unique(SOURCE_ID, keep="any")
+        .collect()
+    )
+    known = _cached_assignments(index, cache_dir)
+    new = sources.join(known, on=SOURCE_ID, how="anti")
+    if new.height > 0:
+        _logger.debug(f"locating {new.height} new sources")
+        idx = index.locate(
+            new[LAT].to_numpy(), new[LON].to_numpy(), chunk_size, max_workers
+        )
+        region_ids = np.array(index.region_ids + [None], dtype=object)
+        located = pl.DataFrame(
+            [
+                new[SOURCE_ID],
+                pl.Series(REGION_ID, region_ids[idx].tolist(), dtype=pl.String),
+            ]
+        )
+        known = pl.concat([known, located])
+        _set_cached_assignments(index, cache_dir, known)
+    enum = pl.Enum(index.region_ids)
+    return (
+        known.join(sources.select(SOURCE_ID), on=SOURCE_ID, how="semi")
+        .with_columns(C(REGION_ID).cast(enum))
+        .sort(by=SOURCE_ID)
+    )
+
+
+def _cached_assignments(index: RegionIndex, cache_dir: Optional[Path]) -> pl.DataFrame:
+    if index._assignments is not None:
+        return index._assignments
+    if cache_dir is not None and _cache_path(index, cache_dir).exists():
+        return pl.read_parquet(_cache_path(index, cache_dir))
+    return pl.DataFrame(
+        schema={SOURCE_ID: pl.UInt64, REGION_ID: pl.String},
+    )
+
+
+def _set_cached_assignments(
+    index: RegionIndex, cache_dir: Optional[Path], known: pl.DataFrame
+) -> None:
+    index._assignments = known
+    if cache_dir is not None:
+        cache_p = _cache_path(index, cache_dir)
+        cache_p.parent.mkdir(parents=True, exist_ok=True)
+        tmp_p = cache_p.with_name(f"{cache_p.name}.{os.getpid()}.tmp")
+        known.write_parquet(tmp_p)
+        os.replace(tmp_p, cache_p)
+
+
+def _cache_path(index: RegionIndex, cache_dir: Path) -> Path:
+    return Path(cache_dir) / f"regions-{index.fingerprint()[:16]}.parquet"
+
+
+def _ring_edges(rings: List[Ring]) -> np.ndarray:
+    """The (x1, y1, x2, y2) edges of the rings, closing the rings if needed."""
+    edges = []
+    for ring in rings:
+        pts = np.asarray(ring, dtype=np.float64)[:, :2]
+        assert len(pts) >= 3, f"ring with {len(pts)} points"
+        if not np.array_equal(pts[0], pts[-1]):
+            pts = np.vstack([pts, pts[:1]])
+        edges.append(np.hstack([pts[:-1], pts[1:]]))
+    return np.concatenate(edges)
+
+
+def _group_ends(starts: np.ndarray, n: int) -> np.ndarray:
+    """The ends of the groups of n sorted values, from their starts."""
+    return np.append(starts[1:], n)[: len(starts)]
+
+
+def _expand(lo: np.ndarray, hi: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    For each i, the integers from lo[i] to hi[i] (included), as the (i, value)
+    pairs.
+    """
+    counts = np.maximum(hi - lo + 1, 0)
+    owner = np.repeat(np.arange(len(lo)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return (owner, lo[owner] + offsets)
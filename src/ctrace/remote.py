@@ -0,0 +1,326 @@
+"""
+Reading remote parquet files with HTTP range requests.
+
+Instead of downloading whole files before running a query, the files are read
+by blocks: first the footer, and then only the row groups and columns needed by
+the query. The blocks are kept in a local cache, so that repeated queries do not
+fetch the same data twice.
+
+The main function is `scan_remote_parquet`.
+"""
+
+import hashlib
+import io
+import logging
+import os
+import threading
+import urllib.request
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+import polars as pl
+
+if TYPE_CHECKING:
+    import pyarrow.fs
+
+_logger = logging.getLogger(__name__)
+
+# The size of the blocks fetched and cached.
+# Large enough to read a parquet footer in one request.
+default_block_size = 1 << 20
+
+
+def default_cache_dir() -> Path:
+    """The default directory of the block cache (see `ctrace.cache`)."""
+    from . import cache
+
+    return cache.kind_dir(cache.BLOCKS)
+
+
+class RangeFile(io.RawIOBase):
+    """
+    A read-only, seekable file over HTTP that fetches blocks with range requests,
+    and keeps them in a local cache directory.
+
+    Servers that do not support range requests return the whole file, which is then
+    cached entirely.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        cache_dir: Optional[Path] = None,
+        block_size: int = default_block_size,
+    ):
+        super().__init__()
+        self.url = url
+        self.block_size = block_size
+        # The blocks of different sizes do not overlap.
+        key = hashlib.sha256(f"{block_size}:{url}".encode()).hexdigest()
+        self._dir = Path(cache_dir or default_cache_dir()) / key
+        self._dir.mkdir(parents=True, exist_ok=True)
+        # Used by the cache manager to know the dataset version of the blocks.
+        url_p = self._dir / "url"
+        if url_p.exists():
+            os.utime(url_p)
+        else:
+            _atomic_write(url_p, url.encode("utf-8"))
+        self._pos = 0
+        self._lock = threading.Lock()
+        self._size = self._fetch_size()
+        # Statistics, for debugging.
+        self.num_requests = 0
+        self.bytes_fetched = 0
+
+    def _fetch_size(self) -> int:
+        size_p = self._dir / "size"
+        if size_p.exists():
+            return int(size_p.read_text())
+        req = urllib.request.Request(self.url, method="HEAD")  # noqa: S310
+        with urllib.request.urlopen(req) as resp:  # noqa: S310
+            size = int(resp.headers["Content-Length"])
+        _atomic_write(size_p, str(size).encode("utf-8"))
+        return size
+
+    @property
+    def size(self) -> int:
+        """The size of the remote file."""
+        return self._size
+
+    def readable(self) -> bool:
+        """Always True."""
+        return True
+
+    def seekable(self) -> bool:
+        """Always True: the reads at any position are range requests."""
+        return True
+
+    def tell(self) -> int:
+        """The current position."""
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        """Moves the current position, without fetching anything."""
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self._size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        return self._pos
+
+    def readinto(self, b) -> int:  # type: ignore[no-untyped-def]
+        """Reads into a buffer at the current position."""
+        data = self.read_at(self._pos, len(b))
+        b[: len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def read(self, size: int = -1) -> bytes:
+        """Reads `size` bytes at the current position (by default, up to the end)."""
+        if size is None or size < 0:
+            size = self._size - self._pos
+        data = self.read_at(self._pos, size)
+        self._pos += len(data)
+        return data
+
+    def readall(self) -> bytes:
+        """Reads up to the end of the file."""
+        return self.read(-1)
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        """Reads `size` bytes at the given offset, fetching the missing blocks."""
+        end = min(offset + size, self._size)
+        if offset >= end:
+            return b""
+        first = offset // self.block_size
+        last = (end - 1) // self.block_size
+        with self._lock:
+            blocks = self._blocks(first, last)
+        data = b"".join(blocks[i] for i in range(first, last + 1))
+        start = offset - first * self.block_size
+        return data[start : start + (end - offset)]
+
+    def _block_path(self, i: int) -> Path:
+        return self._dir / f"{i}.block"
+
+    def _blocks(self, first: int, last: int) -> Dict[int, bytes]:
+        blocks: Dict[int, bytes] = {}
+        missing: List[int] = []
+        for i in range(first, last + 1):
+            block_p = self._block_path(i)
+            if block_p.exists():
+                blocks[i] = block_p.read_bytes()
+            else:
+                missing.append(i)
+        # Contiguous missing blocks are fetched with a single request.
+        for lo, hi in _runs(missing):
+            blocks.update(self._fetch(lo, hi))
+        return blocks
+
+    def _fetch(self, lo: int, hi: int) -> Dict[int, bytes]:
+        start = lo * self.block_size
+        end = min((hi + 1) * self.block_size, self._size) - 1
+        _logger.debug(f"fetching {self.url} bytes={start}-{end}")
+        req = urllib.request.Request(  # noqa: S310
+            self.url, headers={"Range": f"bytes={start}-{end}"}
+        )
+        with urllib.request.urlopen(req) as resp:  # noqa: S310
+            data = resp.read()
+            status = resp.status
+        self.num_requests += 1
+        self.bytes_fetched += len(data)
+        if status != 206:
+            # No support for range requests: the whole file was returned.
+            _logger.debug(f"no range support for {self.url}, caching all the file")
+            (lo, start) = (0, 0)
+            hi = (len(data) - 1) // self.block_size
+        blocks = {}
+        for i in range(lo, hi + 1):
+            off = i * self.block_size - start
+            block = data[off : off + self.block_size]
+            _atomic_write(self._block_path(i), block)
+            blocks[i] = block
+        return blocks
+
+
+def _runs(idxs: List[int]) -> List[Tuple[int, int]]:
+    """The (first, last) of the runs of consecutive integers."""
+    runs: List[Tuple[int, int]] = []
+    for i in idxs:
+        if runs and runs[-1][1] == i - 1:
+            runs[-1] = (runs[-1][0], i)
+        else:
+            runs.append((i, i))
+    return runs
+
+
+def _atomic_write(p: Path, data: bytes) -> None:
+    # Concurrent readers never see a partially written file.
+    tmp_p = p.with_name(f"{p.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    # The directory may have been evicted from the cache in the meantime.
+    p.parent.mkdir(parents=True, exist_ok=True)
+    tmp_p.write_bytes(data)
+    os.replace(tmp_p, p)
+
+
+def _filesystem(
+    cache_dir: Optional[Path], block_size: int
+) -> "pyarrow.fs.PyFileSystem":
+    import pyarrow
+    import pyarrow.fs
+
+    class _RangeFileSystemHandler(pyarrow.fs.FileSystemHandler):
+        """A read-only pyarrow filesystem over HTTP(S) URLs."""
+
+        def __init__(self) -> None:
+            self._files: Dict[str, RangeFile] = {}
+
+        def _file(self, path: str) -> RangeFile:
+            if path not in self._files:
+                self._files[path] = RangeFile(path, cache_dir, block_size)
+            return self._files[path]
+
+        def get_type_name(self) -> str:
+            return "ctrace-http"
+
+        def equals(self, other) -> bool:  # type: ignore[no-untyped-def]
+            return self is other
+
+        def get_file_info(self, paths):  # type: ignore[no-untyped-def]
+            return [
+                pyarrow.fs.FileInfo(
+                    p, pyarrow.fs.FileType.File, size=self._file(p).size
+                )
+                for p in paths
+            ]
+
+        def normalize_path(self, path: str) -> str:
+            return path
+
+        def open_input_file(self, path: str):  # type: ignore[no-untyped-def]
+            f = RangeFile(path, cache_dir, block_size)
+            return pyarrow.PythonFile(f, mode="r")
+
+        def open_input_stream(self, path: str):  # type: ignore[no-untyped-def]
+            return self.open_input_file(path)
+
+        def get_file_info_selector(self, selector):  # type: ignore[no-untyped-def]
+            raise _read_only_error()
+
+        def create_dir(self, path, recursive):  # type: ignore[no-untyped-def]
+            raise _read_only_error()
+
+        def delete_dir(self, path):  # type: ignore[no-untyped-def]
+            raise _read_only_error()
+
+        def delete_dir_contents(  # type: ignore[no-untyped-def]
+            self, path, missing_dir_ok=False
+        ):
+            raise _read_only_error()
+
+        def delete_root_dir_contents(self):  # type: ignore[no-untyped-def]
+            raise _read_only_error()
+
+        def delete_file(self, path):  # type: ignore[no-untyped-def]
+            raise _read_only_error()
+
+        def move(self, src, dest):  # type: ignore[no-untyped-def]
+            raise _read_only_error()
+
+        def copy_file(self, src, dest):  # type: ignore[no-untyped-def]
+            raise _read_only_error()
+
+        def open_output_stream(self, path, metadata):  # type: ignore[no-untyped-def]
+            raise _read_only_error()
+
+        def open_append_stream(self, path, metadata):  # type: ignore[no-untyped-def]
+            raise _read_only_error()
+
+    return pyarrow.fs.PyFileSystem(_RangeFileSystemHandler())
+
+
+def _read_only_error() -> OSError:
+    return OSError("read-only HTTP filesystem: only single files can be read")
+
+
+def scan_remote_parquet(
+    url: str,
+    cache_dir: Optional[Path] = None,
+    block_size: int = default_block_size,
+) -> pl.LazyFrame:
+    """
+    Lazily scans a remote parquet file, fetching only the blocks needed by
+    the query.
+
+    The filters and the column selections of the query are pushed down to the
+    parquet reader, which uses the footer statistics to skip the row groups and
+    columns that are not needed.
+
+    The server must support HTTP range requests, otherwise the whole file is
+    downloaded on first access.
+    """
+    import pyarrow.dataset
+
+    fs = _filesystem(cache_dir, block_size)
+    # Pre-buffering reads the python file from background threads, which may
+    # still be running when the interpreter exits. The block cache already
+    # coalesces the reads.
+    options = pyarrow.dataset.ParquetFragmentScanOptions(pre_buffer=False)
+    fmt = pyarrow.dataset.ParquetFileFormat(default_fragment_scan_options=options)
+    ds = pyarrow.dataset.dataset(url, filesystem=fs, format=fmt)
+    return pl.scan_pyarrow_dataset(ds)
+
+
+def read_remote_parquet_schema(
+    url: str,
+    cache_dir: Optional[Path] = None,
+    block_size: int = default_block_size,
+) -> List[str]:
+    """The column names of a remote parquet file, read from its footer."""
+    import pyarrow.parquet
+
+    f = RangeFile(url, cache_dir, block_size)
+    return pyarrow.parquet.ParquetFile(f).schema_arrow.names
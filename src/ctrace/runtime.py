@@ -0,0 +1,259 @@
+"""
+The resources used by ctrace: threads, memory and scratch space.
+
+A single `RuntimeConfig` sets the number of threads, the memory limit and the
+scratch directory of Polars, DuckDB and pyarrow. It is read from the environment
+variables `CTRACE_THREADS`, `CTRACE_MEMORY_LIMIT` (for example "8GB") and
+`CTRACE_SCRATCH_DIR`, or set with `configure`:
+
+    import ctrace.runtime
+    ctrace.runtime.configure(threads=8, memory_limit="16GB", scratch_dir="/scratch")
+
+The environment variables are applied when `ctrace` is imported, before Polars
+and pyarrow are (otherwise Polars and pyarrow keep their defaults until
+`configure` is called): the number of threads of Polars is fixed when Polars is
+imported, and pyarrow reads it from `OMP_NUM_THREADS` (which also bounds the
+other OpenMP libraries) when it is imported. `configure` must then be called
+before any use of the data. Polars has no memory limit: only DuckDB is bounded by
+`memory_limit`.
+
+Each process gets its own directory under the scratch directory, which holds the
+intermediate files and the data spilled by Polars and DuckDB. Several jobs can
+then share a host (and a scratch directory) without clobbering each other's
+files. The directory is removed when the process exits, and the directories left
+by the processes that died on the same host are removed by the next process.
+
+This module does not import Polars, so that it can be configured first.
+"""
+
+import atexit
+import contextlib
+import dataclasses
+import logging
+import os
+import secrets
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+_logger = logging.getLogger(__name__)
+
+# The environment variables of the configuration.
+THREADS_ENV = "CTRACE_THREADS"
+MEMORY_LIMIT_ENV = "CTRACE_MEMORY_LIMIT"
+SCRATCH_DIR_ENV = "CTRACE_SCRATCH_DIR"
+
+# The directories of the processes are named <prefix><host>-<pid>-<random>.
+_process_dir_prefix = "run-"
+
+
+@dataclasses.dataclass(frozen=True)
+class RuntimeConfig:
+    """
+    threads: the number of threads of Polars, DuckDB and pyarrow (None for one
+      per core).
+    memory_limit: the memory limit of DuckDB, for example "8GB" (None for the
+      default of DuckDB).
+    scratch_dir: the root of the scratch directories (None for a directory in the
+      temporary directory of the system).
+    """
+
+    threads: Optional[int] = None
+    memory_limit: Optional[str] = None
+    scratch_dir: Optional[Path] = None
+
+    @classmethod
+    def from_env(cls) -> "RuntimeConfig":
+        """The configuration set by the environment variables."""
+        threads = os.environ.get(THREADS_ENV)
+        scratch = os.environ.get(SCRATCH_DIR_ENV)
+        return cls(
+            threads=int(threads) if threads else None,
+            memory_limit=os.environ.get(MEMORY_LIMIT_ENV) or None,
+            scratch_dir=Path(scratch) if scratch else None,
+        )
+
+
+_config: Optional[RuntimeConfig] = None
+# The name of the scratch directory of this process, and the directory once it
+# is created.
+_process_name: Optional[str] = None
+_process_dir: Optional[Path] = None
+_lock = threading.Lock()
+
+
+def config() -> RuntimeConfig:
+    """The current configuration."""
+    return _config or RuntimeConfig.from_env()
+
+
+def configure(
+    threads: Optional[int] = None,
+    memory_limit: Optional[str] = None,
+    scratch_dir: Union[Path, str, None] = None,
+) -> RuntimeConfig:
+    """
+    Sets the configuration, and applies it to Polars, DuckDB and pyarrow.
+
+    The arguments left to None are taken from the environment variables.
+    """
+    global _config, _process_dir
+    assert threads is None or threads > 0, threads
+    env = RuntimeConfig.from_env()
+    new_config = RuntimeConfig(
+        threads=threads or env.threads,
+        memory_limit=memory_limit or env.memory_limit,
+        scratch_dir=Path(scratch_dir) if scratch_dir else env.scratch_dir,
+    )
+    with _lock:
+        if _process_dir is not None and new_config.scratch_dir != config().scratch_dir:
+            # The next scratch directories go to the new root.
+            _remove_dir(_process_dir)
+            _process_dir = None
+        _config = new_config
+    _apply(new_config)
+    _logger.debug(f"runtime configuration: {new_config}")
+    return new_config
+
+
+def scratch_root() -> Path:
+    """The root of the scratch directories."""
+    return config().scratch_dir or Path(tempfile.gettempdir()) / "ctrace-scratch"
+
+
+def process_dir() -> Path:
+    """The scratch directory of this process, removed when the process exits."""
+    global _process_dir
+    with _lock:
+        p = _process_dir_path()
+        if not p.exists():
+            p.parent.mkdir(parents=True, exist_ok=True)
+            prune_scratch()
+            p.mkdir(mode=0o700, exist_ok=True)
+        if p != _process_dir:
+            atexit.register(_remove_dir, p)
+            _process_dir = p
+        return p
+
+
+def _process_dir_path() -> Path:
+    """The path of the scratch directory of this process, which may not exist yet."""
+    global _process_name
+    prefix = f"{_process_dir_prefix}{socket.gethostname()}-{os.getpid()}-"
+    # The forked processes get their own directory.
+    if _process_name is None or not _process_name.startswith(prefix):
+        _process_name = prefix + secrets.token_hex(4)
+    return scratch_root() / _process_name
+
+
+def scratch_dir(name: str) -> Path:
+    """
+    A new, empty directory in the scratch directory of this process.
+
+    It is removed when the process exits. Use `scratch` to remove it earlier.
+    """
+    return Path(tempfile.mkdtemp(prefix=f"{name}-", dir=process_dir()))
+
+
+@contextlib.contextmanager
+def scratch(name: str) -> Iterator[Path]:
+    """A new scratch directory (see `scratch_dir`), removed on exit."""
+    p = scratch_dir(name)
+    try:
+        yield p
+    finally:
+        _remove_dir(p)
+
+
+def prune_scratch() -> int:
+    """
+    Removes the scratch directories of the processes of this host that do not
+    run anymore, and returns their number.
+    """
+    root = scratch_root()
+    if not root.exists():
+        return 0
+    prefix = f"{_process_dir_prefix}{socket.gethostname()}-"
+    num_removed = 0
+    for p in root.iterdir():
+        if not p.name.startswith(prefix):
+            continue
+        pid = p.name[len(prefix) :].split("-", 1)[0]
+        if pid.isdigit() and not _is_running(int(pid)):
+            _logger.debug(f"removing the stale scratch directory {p}")
+            _remove_dir(p)
+            num_removed += 1
+    return num_removed
+
+
+def duckdb_settings() -> dict:
+    """The settings of the DuckDB connections (see `ctrace.duckdb_engine.connect`)."""
+    c = config()
+    return {
+        "memory_limit": c.memory_limit,
+        "temp_directory": process_dir() / "duckdb",
+        "threads": c.threads,
+    }
+
+
+def _apply_env() -> None:
+    """
+    Applies the configuration of the environment variables, on the import of the
+    package. Nothing is imported or created: Polars creates its directory in
+    the scratch directory of the process when it first spills.
+    """
+    c = RuntimeConfig.from_env()
+    if c.threads is not None:
+        _set_threads(c.threads)
+    if "POLARS_TEMP_DIR" not in os.environ:
+        p = _process_dir_path()
+        os.environ["POLARS_TEMP_DIR"] = str(p / "polars")
+        atexit.register(_remove_dir, p)
+
+
+def _apply(c: RuntimeConfig) -> None:
+    if c.threads is not None:
+        _set_threads(c.threads)
+    # Polars reads it when it first spills.
+    os.environ["POLARS_TEMP_DIR"] = str(process_dir() / "polars")
+    if "ctrace.duckdb_engine" in sys.modules:
+        # The default connection is created again with the new settings.
+        sys.modules["ctrace.duckdb_engine"].default_connection.cache_clear()
+
+
+def _set_threads(threads: int) -> None:
+    if "polars" in sys.modules:
+        import polars as pl
+
+        if pl.thread_pool_size() != threads:
+            _logger.warning(
+                f"Polars already runs {pl.thread_pool_size()} threads: the runtime "
+                "configuration must be set before Polars is imported."
+            )
+    else:
+        os.environ["POLARS_MAX_THREADS"] = str(threads)
+    if "pyarrow" in sys.modules:
+        import pyarrow
+
+        pyarrow.set_cpu_count(threads)
+    else:
+        os.environ.setdefault("OMP_NUM_THREADS", str(threads))
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists, but belongs to another user.
+        return True
+    return True
+
+
+def _remove_dir(p: Path) -> None:
+    shutil.rmtree(p, ignore_errors=True)
@@ -0,0 +1,253 @@
+"""
+Stratified samples of the source emissions, for approximate queries.
+
+The writers of the source files (see `write_source_file`) can produce samples of
+each file next to it, for example at 1% and 10% of the records. The samples are
+stratified by (subsector, iso3_country): each stratum keeps a fixed fraction of
+its records, drawn without replacement, and at least `min_stratum_size` of them.
+The records of the samples store the size of their stratum and of its sample,
+from which the inclusion weights and the variances are computed.
+
+The samples are read with `read_source_emissions(..., approximate=True)`, and the
+counts, sums and means are estimated with their error bounds with `estimate`.
+"""
+
+import logging
+import statistics
+from pathlib import Path
+from typing import List, Optional, Union
+
+import polars as pl
+from polars import col as C
+
+from . import enums
+from .constants import *
+from .data import (
+    _check_gas,
+    _check_year,
+    _collect_streaming,
+    _source_path,
+    recast_parquet,
+)
+
+_logger = logging.getLogger(__name__)
+
+# The sample files, relative to the root directory. The rate is in percents.
+_sample_fname = (
+    "{version}/climate_trace-sources-sample-{rate}pct_{version}_{year}_{gas}.parquet"
+)
+
+# The default sampling rates.
+sample_rates = [0.01, 0.1]
+
+# The minimum number of records sampled in each stratum (if it has enough
+# records), so that the variance of each stratum can be estimated.
+min_stratum_size = 2
+
+# The columns of the samples, in addition to the columns of the source files.
+STRATUM = "stratum"
+STRATUM_SIZE = "stratum_size"
+SAMPLE_SIZE = "sample_size"
+SAMPLE_WEIGHT = "sample_weight"
+sample_columns = [STRATUM, STRATUM_SIZE, SAMPLE_SIZE, SAMPLE_WEIGHT]
+
+# Output columns
+COUNT = "count"
+SUM = "sum"
+MEAN = "mean"
+# The half width of the confidence interval of each estimate.
+ERROR_SUFFIX = "_error"
+
+
+def write_sample_files(
+    core_p: Path,
+    year: int,
+    gas: Gas,
+    p: Path,
+    rates: List[float] = sample_rates,
+    seed: int = 0,
+) -> List[Path]:
+    """
+    Writes the stratified samples of a source file, and returns their paths.
+
+    The samples hold the columns of the core file (without the text columns) and
+    the `sample_columns`. The sampled records only depend on the records of the
+    stratum and on the seed.
+
+    Each stratum keeps the records with the smallest hashes. The file is streamed
+    twice, to count the records of the strata and then to keep a few more records
+    than needed on their hashes: only the samples are held in memory.
+    """
+    df = pl.scan_parquet(core_p).pipe(recast_parquet, conf=True)
+    # The stratum of a record, from the codes of its subsector and country.
+    num_countries = len(enums.iso3_enum.categories) + 1
+    stratum = c_subsector.to_physical().cast(pl.UInt32) * num_countries + (
+        c_iso3_country.to_physical().cast(pl.UInt32).fill_null(num_countries - 1)
+    )
+    df = df.with_columns(
+        stratum.alias(STRATUM),
+        # A random order of the records of each stratum.
+        pl.struct(SOURCE_ID, START_TIME).hash(seed).alias("_hash"),
+    )
+    strata = _collect_streaming(
+        df.group_by(STRATUM).agg(pl.len().cast(pl.UInt32).alias(STRATUM_SIZE))
+    )
+    paths = []
+    for rate in rates:
+        assert 0 < rate <= 1, rate
+        size = pl.min_horizontal(
+            C(STRATUM_SIZE),
+            pl.max_horizontal(
+                (C(STRATUM_SIZE) * rate).ceil().cast(pl.UInt32),
+                pl.lit(min_stratum_size, pl.UInt32),
+            ),
+        )
+        # The fraction of the records kept as candidates, with a margin of a few
+        # standard deviations so that the sample is nearly always complete.
+        margin = (C(SAMPLE_SIZE) + 4 * C(SAMPLE_SIZE).sqrt() + 10) / C(STRATUM_SIZE)
+        targets = strata.with_columns(size.alias(SAMPLE_SIZE)).with_columns(
+            margin.alias("_fraction")
+        )
+        candidates = _collect_streaming(
+            df.join(targets.lazy(), on=STRATUM).filter(
+                C("_hash").cast(pl.Float64) < C("_fraction") * 2.0**64
+            )
+        )
+        sample_df = (
+            candidates.filter(
+                C("_hash").rank("ordinal").over(STRATUM) <= C(SAMPLE_SIZE)
+            )
+            .with_columns(pl.len().over(STRATUM).cast(pl.UInt32).alias(SAMPLE_SIZE))
+            .with_columns((C(STRATUM_SIZE) / C(SAMPLE_SIZE)).alias(SAMPLE_WEIGHT))
+            .sort(by=[SUBSECTOR, STRATUM, "_hash"])
+            .select(
+                pl.exclude(sample_columns + ["_hash", "_fraction"]), *sample_columns
+            )
+        )
+        out_p = _sample_path(year, gas, p, rate)
+        _logger.debug(f"writing sample of {sample_df.height} records to {out_p}")
+        sample_df.write_parquet(out_p, compression="zstd", statistics=True)
+        paths.append(out_p)
+    return paths
+
+
+def read_sample(
+    gas: Union[Gas, List[Gas]],
+    year: Union[int, List[int], None] = None,
+    p: Union[Path, str, None] = None,
+    rate: float = sample_rates[0],
+    columns: Optional[List[str]] = None,
+) -> pl.LazyFrame:
+    """
+    The sampled source emissions, with the `sample_columns`.
+
+    The arguments are the same as for `read_source_emissions`. The text columns
+    are not sampled.
+    """
+    ys = _check_year(year)
+    gases = _check_gas(gas)
+    if columns is not None:
+        for c in columns:
+            assert c not in text_columns, f"Text column {c} not in the samples"
+        columns = list(dict.fromkeys(list(columns) + sample_columns))
+    dfs = []
+    for year_ in ys:
+        for gas_ in gases:
+            df = pl.scan_parquet(_sample_path(year_, gas_, p, rate))
+            df = df.pipe(recast_parquet, conf=True)
+            dfs.append(df if columns is None else df.select(columns))
+    return pl.concat(dfs)
+
+
+def estimate(
+    df: Union[pl.DataFrame, pl.LazyFrame],
+    by: Optional[List[str]] = None,
+    value: str = EMISSIONS_QUANTITY,
+    confidence: float = 0.95,
+) -> pl.DataFrame:
+    """
+    Estimates the number of records, the sum and the mean of a column from a
+    stratified sample (see `read_sample`).
+
+    df: the sampled records, possibly filtered, with the `sample_columns`.
+    by: the columns of the groups. If None, one estimate for all the records.
+    value: the column to sum.
+    confidence: the probability of the true value to be within the error bounds.
+
+    Returns, for each group, the COUNT, SUM and MEAN estimates and their error
+    bounds (the columns with ERROR_SUFFIX), from the normal approximation. The
+    strata that are entirely sampled contribute no error. The records without a
+    value are ignored.
+    """
+    assert 0 < confidence < 1, confidence
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+    keys = list(by) if by else ["_all"]
+    w = C(STRATUM_SIZE) / C(SAMPLE_SIZE)
+    strata = (
+        df.lazy()
+        .filter(C(value).is_not_null())
+        .with_columns(pl.lit(0).alias("_all"))
+        .group_by(keys + [STRATUM])
+        .agg(
+            C(value).sum().alias("_s1"),
+            (C(value) * C(value)).sum().alias("_s2"),
+            pl.len().cast(pl.Float64).alias("_m"),
+            C(SAMPLE_SIZE).first().cast(pl.Float64),
+            C(STRATUM_SIZE).first().cast(pl.Float64),
+        )
+        .with_columns(
+            # The ratio estimate of the mean of each group.
+            ((w * C("_s1")).sum().over(keys) / (w * C("_m")).sum().over(keys)).alias(
+                "_r"
+            )
+        )
+        .with_columns(
+            # The residuals of the mean, for its linearized variance.
+            (C("_s1") - C("_r") * C("_m")).alias("_u1"),
+            (C("_s2") - 2 * C("_r") * C("_s1") + C("_r") * C("_r") * C("_m")).alias(
+                "_u2"
+            ),
+        )
+    )
+    res = (
+        strata.group_by(keys)
+        .agg(
+            (w * C("_m")).sum().alias(COUNT),
+            _variance("_m", "_m").sum().alias("_count_var"),
+            (w * C("_s1")).sum().alias(SUM),
+            _variance("_s1", "_s2").sum().alias("_sum_var"),
+            C("_r").first().alias(MEAN),
+            _variance("_u1", "_u2").sum().alias("_mean_var"),
+        )
+        .with_columns(
+            (z * C("_count_var").sqrt()).alias(COUNT + ERROR_SUFFIX),
+            (z * C("_sum_var").sqrt()).alias(SUM + ERROR_SUFFIX),
+            (z * C("_mean_var").sqrt() / C(COUNT)).alias(MEAN + ERROR_SUFFIX),
+        )
+        .select(
+            *(by or []),
+            *[c for s in [COUNT, SUM, MEAN] for c in [s, s + ERROR_SUFFIX]],
+        )
+        .collect()
+    )
+    return res.sort(by=by) if by else res
+
+
+def _variance(s1: str, s2: str) -> pl.Expr:
+    """
+    The variance of the estimated total of a stratum, from the sum and the sum of
+    squares of the values over its sample (zero outside of the group).
+    """
+    n = C(SAMPLE_SIZE)
+    big_n = C(STRATUM_SIZE)
+    s_var = (C(s2) - C(s1) * C(s1) / n) / (n - 1)
+    return (
+        pl.when(n > 1)
+        .then(big_n * big_n * (1 - n / big_n) / n * s_var.clip(lower_bound=0))
+        .otherwise(0.0)
+    )
+
+
+def _sample_path(year: int, gas: Gas, p: Union[Path, str, None], rate: float) -> Path:
+    fname = _sample_fname.replace("{rate}", f"{rate * 100:g}")
+    return _source_path(fname, year, gas, p)
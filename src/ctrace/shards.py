@@ -0,0 +1,414 @@
+"""
+Sharded ingestion of the source emissions, across several workers.
+
+The ingestion of the archives (see `load_source_compact`) is split into shards,
+one for each (gas, archive, member) source file of the archives. The shards are
+independent: several workers, on one or several nodes, can process them in
+parallel as long as they share a filesystem.
+
+The steps are:
+
+1. `create_job` writes the job spec: the list of the shards, in a deterministic
+   order and with deterministic ids.
+2. `run_worker` claims the pending shards one at a time, and writes the records
+   of each shard to a partial parquet file. Any number of workers can run at the
+   same time, and can be started again after a failure.
+3. `merge_shards` gathers the partial files into the source files partitioned
+   by gas and year (see `write_source_file`), their catalog (see
+   `ctrace.dataset_catalog.build_catalog`) and the name index (see
+   `ctrace.name_index.build_name_index`).
+
+The job directory holds the state of the job, so that no other coordination is
+needed between the workers:
+
+    job.json                    the job spec
+    claims/<shard id>           the shards being processed, and by whom
+    parts/<gas>/<shard id>.parquet
+    done/<shard id>             the shards processed
+    failed/<shard id>           the shards that failed, with the error
+
+A shard is claimed by creating its claim file, which only one worker can do.
+The claim of a worker that died is taken over after `lease_seconds`, or as soon
+as its process is gone if it ran on the same host. All the files are written to
+a temporary name first and then renamed, so that the partial files are either
+complete or absent. A shard processed twice writes the same partial file.
+
+The steps can also be run from the command line, for example with one worker
+per node:
+
+    python -m ctrace.shards create <job dir>
+    python -m ctrace.shards work <job dir>
+    python -m ctrace.shards status <job dir>
+    python -m ctrace.shards merge <job dir> <output dir>
+"""
+
+import argparse
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+import socket
+import sys
+import time
+import traceback
+import uuid
+from pathlib import Path
+from typing import List, Optional, Union
+
+import polars as pl
+from polars import col as C
+
+from . import runtime
+from .constants import *
+from .data import (
+    WriterConfig,
+    _archive_members,
+    _check_gas,
+    _files,
+    _get_zip,
+    _write_member,
+    recast_parquet,
+    version,
+    write_source_file,
+    years,
+)
+
+_logger = logging.getLogger(__name__)
+
+_job_fname = "job.json"
+_claims_dir = "claims"
+_parts_dir = "parts"
+_done_dir = "done"
+_failed_dir = "failed"
+
+# The states of the shards.
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+FAILED = "failed"
+
+# Output columns
+SHARD_ID = "shard_id"
+ARCHIVE = "archive"
+MEMBER = "member"
+STATE = "state"
+WORKER = "worker"
+
+
+@dataclasses.dataclass(frozen=True)
+class Shard:
+    """A source file of an archive, the unit of work of the ingestion."""
+
+    gas: Gas
+    archive: str
+    member: str
+
+    @property
+    def id(self) -> str:
+        """A short hash of the gas, archive and member, stable across runs."""
+        key = f"{self.gas}/{self.archive}/{self.member}"
+        return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def create_job(
+    job_dir: Union[Path, str],
+    p: Union[Path, str, None] = None,
+    gas: Union[Gas, List[Gas]] = GAS_LIST,
+    archives: Optional[List[str]] = None,
+) -> List[Shard]:
+    """
+    Writes the spec of an ingestion job, and returns its shards.
+
+    p: the directory of the archives, as <p>/<gas>/<archive> (by default, the
+      archives are downloaded to the cache).
+    archives: the names of the archives (by default, all the archives of the
+      dataset).
+
+    The spec only depends on the content of the archives. Creating a job again
+    in the same directory keeps the progress of the shards.
+    """
+    job_dir = Path(job_dir)
+    shards: List[Shard] = []
+    for gas_ in _check_gas(gas):
+        for archive in archives if archives is not None else list(_files[gas_]):
+            (zf, _) = _get_zip(Path(p) if p else True, gas_, archive)
+            with zf:
+                shards.extend(Shard(gas_, archive, m) for m in _archive_members(zf))
+    job_dir.mkdir(parents=True, exist_ok=True)
+    spec = {"version": version, "shards": [dataclasses.asdict(s) for s in shards]}
+    _write_atomic(job_dir / _job_fname, json.dumps(spec, indent=1).encode())
+    _logger.info(f"created job {job_dir} with {len(shards)} shards")
+    return shards
+
+
+def read_job(job_dir: Union[Path, str]) -> List[Shard]:
+    """The shards of a job, in the order of the spec."""
+    spec = json.loads((Path(job_dir) / _job_fname).read_text())
+    assert spec["version"] == version, (spec["version"], version)
+    return [Shard(**d) for d in spec["shards"]]
+
+
+def run_worker(
+    job_dir: Union[Path, str],
+    p: Union[Path, str, None] = None,
+    worker_id: Optional[str] = None,
+    lease_seconds: float = 3 * 3600,
+    retry_failed: bool = False,
+) -> List[str]:
+    """
+    Processes the pending shards of a job until there are none left, and returns
+    the ids of the shards processed by this worker.
+
+    p: the directory of the archives on this node (see `create_job`).
+    worker_id: the name of the worker in the claims (by default, from the host
+      and the process).
+    lease_seconds: the time after which the claim of another worker is
+      considered abandoned. It must be longer than the processing of a shard.
+    retry_failed: if True, the failed shards are processed again.
+
+    The shards that fail are marked as failed and skipped, the worker moves on
+    to the next shard.
+    """
+    job_dir = Path(job_dir)
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    for d in [_claims_dir, _done_dir, _failed_dir]:
+        (job_dir / d).mkdir(parents=True, exist_ok=True)
+    processed: List[str] = []
+    for shard in read_job(job_dir):
+        if (job_dir / _done_dir / shard.id).exists():
+            continue
+        if (job_dir / _failed_dir / shard.id).exists() and not retry_failed:
+            continue
+        if not _claim(job_dir, shard, worker_id, lease_seconds):
+            continue
+        claim_p = job_dir / _claims_dir / shard.id
+        try:
+            if (job_dir / _done_dir / shard.id).exists():
+                # Completed by another worker since the first check.
+                continue
+            _logger.info(f"worker {worker_id}: processing shard {shard}")
+            _process_shard(job_dir, shard, p, worker_id)
+            _write_atomic(job_dir / _done_dir / shard.id, worker_id.encode())
+            (job_dir / _failed_dir / shard.id).unlink(missing_ok=True)
+            processed.append(shard.id)
+        except Exception:
+            _logger.exception(f"worker {worker_id}: shard {shard} failed")
+            error = f"worker: {worker_id}\n{traceback.format_exc()}"
+            _write_atomic(job_dir / _failed_dir / shard.id, error.encode())
+        finally:
+            claim_p.unlink(missing_ok=True)
+    _logger.info(f"worker {worker_id}: processed {len(processed)} shards")
+    return processed
+
+
+def job_status(job_dir: Union[Path, str]) -> pl.DataFrame:
+    """The state of each shard of a job, and the worker that claimed it."""
+    job_dir = Path(job_dir)
+    rows = []
+    for shard in read_job(job_dir):
+        state = PENDING
+        worker = None
+        for d, s in [(_done_dir, DONE), (_failed_dir, FAILED), (_claims_dir, CLAIMED)]:
+            f = job_dir / d / shard.id
+            if f.exists():
+                state = s
+                content = _read_text(f)
+                worker = content.split()[1] if s == FAILED else content
+                break
+        rows.append(
+            {
+                SHARD_ID: shard.id,
+                GAS: shard.gas,
+                ARCHIVE: shard.archive,
+                MEMBER: shard.member,
+                STATE: state,
+                WORKER: worker,
+            }
+        )
+    status_columns = [SHARD_ID, GAS, ARCHIVE, MEMBER, STATE, WORKER]
+    return pl.DataFrame(rows, schema=dict.fromkeys(status_columns, pl.String))
+
+
+def merge_shards(
+    job_dir: Union[Path, str],
+    p: Union[Path, str],
+    sample_rates: Optional[List[float]] = None,
+    config: Optional[WriterConfig] = None,
+) -> List[Path]:
+    """
+    Writes the source files of a completed job, the catalog of the dataset and
+    the name index.
+
+    p: the root directory of the source files (see `read_source_emissions`).
+    sample_rates, config: see `write_source_file`.
+
+    The partial files are read in the order of the spec, so that the output does
+    not depend on which workers processed the shards. Returns the paths of the
+    source files.
+    """
+    job_dir = Path(job_dir)
+    shards = read_job(job_dir)
+    missing = [s.id for s in shards if not (job_dir / _done_dir / s.id).exists()]
+    assert not missing, f"Shards not processed: {missing}"
+    paths: List[Path] = []
+    for gas in dict.fromkeys(s.gas for s in shards):
+        parts = [_part_path(job_dir, s) for s in shards if s.gas == gas]
+        df = pl.concat(
+            [pl.scan_parquet(f).pipe(recast_parquet, conf=True) for f in parts]
+        )
+        year_counts = dict(
+            df.group_by(c_start_time.dt.year().alias("year"))
+            .agg(pl.len())
+            .collect()
+            .iter_rows()
+        )
+        for year in years:
+            if not year_counts.get(year):
+                continue
+            _logger.debug(f"merging {len(parts)} shards for gas={gas} year={year}")
+            year_df = df.filter(c_start_time.dt.year() == year)
+            paths.extend(
+                write_source_file(year_df, gas, year, Path(p), sample_rates, config)
+            )
+    from . import dataset_catalog, name_index
+
+    dataset_catalog.build_catalog(Path(p))
+    name_index.build_name_index(Path(p))
+    return paths
+
+
+def _claim(job_dir: Path, shard: Shard, worker_id: str, lease_seconds: float) -> bool:
+    """Creates the claim of a shard, taking over an abandoned claim."""
+    claim_p = job_dir / _claims_dir / shard.id
+    for _ in range(2):
+        try:
+            fd = os.open(claim_p, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not _is_abandoned(claim_p, lease_seconds):
+                return False
+            # The claim is moved away before it is replaced, so that only one
+            # worker takes it over. The claim may have been replaced by a new
+            # one in the meantime, which is then put back.
+            stale = _read_text(claim_p)
+            moved_p = claim_p.with_name(f"{claim_p.name}.{uuid.uuid4().hex}")
+            try:
+                os.rename(claim_p, moved_p)
+            except FileNotFoundError:
+                continue
+            if _read_text(moved_p) != stale:
+                try:
+                    os.link(moved_p, claim_p)
+                except FileExistsError:
+                    pass
+                moved_p.unlink()
+                return False
+            _logger.info(f"taking over the abandoned claim of {shard.id} by {stale}")
+            moved_p.unlink()
+            continue
+        with os.fdopen(fd, "w") as f:
+            f.write(worker_id)
+        return True
+    return False
+
+
+def _is_abandoned(claim_p: Path, lease_seconds: float) -> bool:
+    try:
+        age = time.time() - claim_p.stat().st_mtime
+    except FileNotFoundError:
+        return True
+    if age > lease_seconds:
+        return True
+    # The claims of the dead processes of this host are abandoned right away.
+    (host, _, pid) = _read_text(claim_p).rpartition("-")
+    return (
+        host == socket.gethostname()
+        and pid.isdigit()
+        and not runtime._is_running(int(pid))
+    )
+
+
+def _process_shard(
+    job_dir: Path, shard: Shard, p: Union[Path, str, None], worker_id: str
+) -> Path:
+    out_p = _part_path(job_dir, shard)
+    tmp_p = out_p.with_name(f".{out_p.name}.{worker_id}.tmp")
+    (zf, _) = _get_zip(Path(p) if p else True, shard.gas, shard.archive)
+    with zf:
+        _write_member(zf, shard.member, tmp_p)
+    os.replace(tmp_p, out_p)
+    return out_p
+
+
+def _part_path(job_dir: Path, shard: Shard) -> Path:
+    return job_dir / _parts_dir / shard.gas / f"{shard.id}.parquet"
+
+
+def _write_atomic(out_p: Path, data: bytes) -> None:
+    tmp_p = out_p.with_name(f".{out_p.name}.{uuid.uuid4().hex}.tmp")
+    tmp_p.write_bytes(data)
+    os.replace(tmp_p, out_p)
+
+
+def _read_text(p: Path) -> str:
+    try:
+        return p.read_text()
+    except FileNotFoundError:
+        return ""
+
+
+def _main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m ctrace.shards",
+        description="Runs the ingestion of the archives across several workers.",
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+    create_p = sub.add_parser("create", help="writes the spec of a job")
+    create_p.add_argument("job_dir")
+    create_p.add_argument("--archives", default=None, help="the archive directory")
+    create_p.add_argument("--gas", action="append", default=None)
+    create_p.add_argument("--archive", action="append", default=None)
+    work_p = sub.add_parser("work", help="processes the pending shards of a job")
+    work_p.add_argument("job_dir")
+    work_p.add_argument("--archives", default=None, help="the archive directory")
+    work_p.add_argument("--worker-id", default=None)
+    work_p.add_argument("--lease-seconds", type=float, default=3 * 3600)
+    work_p.add_argument("--retry-failed", action="store_true")
+    status_p = sub.add_parser("status", help="lists the state of the shards")
+    status_p.add_argument("job_dir")
+    merge_p = sub.add_parser("merge", help="writes the source files of a job")
+    merge_p.add_argument("job_dir")
+    merge_p.add_argument("out_dir")
+    merge_p.add_argument("--config", default=None, help="a writer configuration")
+    args = parser.parse_args(argv)
+    if args.command == "create":
+        shards = create_job(
+            args.job_dir, args.archives, args.gas or GAS_LIST, args.archive
+        )
+        print(f"created {len(shards)} shards")
+    elif args.command == "work":
+        processed = run_worker(
+            args.job_dir,
+            args.archives,
+            args.worker_id,
+            args.lease_seconds,
+            args.retry_failed,
+        )
+        print(f"processed {len(processed)} shards")
+    elif args.command == "status":
+        df = job_status(args.job_dir)
+        with pl.Config(tbl_rows=-1, fmt_str_lengths=60):
+            print(df.group_by(STATE).agg(pl.len()).sort(by=STATE))
+            print(df.filter(C(STATE) != DONE))
+        return 0 if (df[STATE] == DONE).all() else 1
+    else:
+        config = None
+        if args.config:
+            config = WriterConfig.from_json(Path(args.config).read_text())
+        paths = merge_shards(args.job_dir, args.out_dir, config=config)
+        print(f"wrote {len(paths)} files")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main(sys.argv[1:]))
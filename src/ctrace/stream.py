@@ -0,0 +1,174 @@
+"""
+Streaming of the source emissions in batches of bounded size.
+
+The main function is `iter_source_batches`, which yields Arrow record batches
+(or Polars dataframes) without materializing the whole dataset. The memory use
+stays bounded by the size of a batch, whatever the number of years and gases.
+"""
+
+import logging
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterator, List, Literal, Optional, Union
+
+import polars as pl
+from polars import col as C
+
+from . import enums
+from .constants import *
+from .data import (
+    Filter,
+    _check_gas,
+    _check_year,
+    _filters_expr,
+    _row_group_may_match,
+    _row_group_stats,
+    _source_columns,
+    _source_fname,
+    _source_path,
+    _source_text_fname,
+)
+
+if TYPE_CHECKING:
+    import pyarrow
+
+_logger = logging.getLogger(__name__)
+
+Output = Literal["arrow", "polars"]
+
+
+def iter_source_batches(
+    gas: Union[Gas, List[Gas]],
+    year: Union[int, List[int], None] = None,
+    p: Optional[Path] = None,
+    columns: Optional[List[str]] = None,
+    filters: Optional[List[Filter]] = None,
+    max_rows: int = 100_000,
+    max_bytes: Optional[int] = None,
+    output: Output = "arrow",
+) -> Iterator[Union["pyarrow.RecordBatch", pl.DataFrame]]:
+    """
+    Yields the source emissions in batches of at most `max_rows` rows and, if
+    provided, of at most about `max_bytes` bytes.
+
+    The files are read one row group at a time. The row groups that cannot match
+    the filters are skipped based on their statistics, and only the requested
+    columns are read (see `read_source_emissions`).
+
+    filters: conditions on the records, as a list of (column, operator, value).
+    output: "arrow" for pyarrow record batches, "polars" for polars dataframes.
+      The record batches are converted from polars without copying the data.
+
+    The batches have the same types as the frames of `read_source_emissions`.
+    """
+    assert max_rows > 0, max_rows
+    assert max_bytes is None or max_bytes > 0, max_bytes
+    assert output in ("arrow", "polars"), output
+    ys = _check_year(year)
+    gases = _check_gas(gas)
+    filters = filters or []
+    for year_ in ys:
+        for gas_ in gases:
+            dfs = _iter_file(year_, gas_, p, columns, filters, max_rows)
+            for df in _rebatch(dfs, max_rows, max_bytes):
+                if output == "arrow":
+                    yield from df.to_arrow().to_batches()
+                else:
+                    yield df
+
+
+def _iter_file(
+    year: int,
+    gas: Gas,
+    p: Optional[Path],
+    columns: Optional[List[str]],
+    filters: List[Filter],
+    batch_size: int,
+) -> Iterator[pl.DataFrame]:
+    """The filtered and recast batches of one file."""
+    import pyarrow.parquet
+
+    core_file = pyarrow.parquet.ParquetFile(_source_path(_source_fname, year, gas, p))
+    (sel_cols, sel_text_cols) = _source_columns(core_file.schema_arrow.names, columns)
+    filter_cols = [f[0] for f in filters]
+    read_cols = list(dict.fromkeys(sel_cols + filter_cols))
+    core_cols = [c for c in read_cols if c not in sel_text_cols]
+    text_file = None
+    if sel_text_cols:
+        text_p = _source_path(_source_text_fname, year, gas, p)
+        text_file = pyarrow.parquet.ParquetFile(text_p)
+    (num_read, num_skipped) = (0, 0)
+    for rg in range(core_file.num_row_groups):
+        stats = _row_group_stats(core_file.metadata.row_group(rg))
+        if not _row_group_may_match(stats, filters):
+            num_skipped += 1
+            continue
+        num_read += 1
+        batches = core_file.iter_batches(
+            batch_size=batch_size, row_groups=[rg], columns=core_cols
+        )
+        text_batches = (
+            text_file.iter_batches(
+                batch_size=batch_size, row_groups=[rg], columns=sel_text_cols
+            )
+            if text_file is not None
+            else None
+        )
+        for batch in batches:
+            df = _from_arrow(batch)
+            if text_batches is not None:
+                # Both files are written with the same row groups.
+                text_df = _from_arrow(next(text_batches))
+                assert text_df.height == df.height, (text_df.height, df.height)
+                df = df.hstack(text_df)
+            df = df.filter(_filters_expr(filters))
+            if df.height > 0:
+                yield _recast(df).select(sel_cols)
+    _logger.debug(
+        f"streaming year={year} gas={gas}: read {num_read} row groups,"
+        f" skipped {num_skipped}"
+    )
+
+
+def _rebatch(
+    dfs: Iterator[pl.DataFrame], max_rows: int, max_bytes: Optional[int]
+) -> Iterator[pl.DataFrame]:
+    """Splits the large frames and merges the small frames, up to the limits."""
+    pending: List[pl.DataFrame] = []
+    num_pending = 0
+    for df in dfs:
+        limit = max_rows
+        if max_bytes is not None:
+            row_bytes = max(1, int(df.estimated_size()) // max(1, df.height))
+            limit = max(1, min(limit, max_bytes // row_bytes))
+        for offset in range(0, df.height, limit):
+            chunk = df.slice(offset, limit)
+            if num_pending + chunk.height > limit and pending:
+                yield pl.concat(pending, rechunk=True)
+                (pending, num_pending) = ([], 0)
+            pending.append(chunk)
+            num_pending += chunk.height
+    if pending:
+        yield pl.concat(pending, rechunk=True)
+
+
+def _from_arrow(batch: "pyarrow.RecordBatch") -> pl.DataFrame:
+    df = pl.from_arrow(batch)
+    assert isinstance(df, pl.DataFrame)
+    return df
+
+
+def _recast(df: pl.DataFrame) -> pl.DataFrame:
+    """Casts the columns to the enumerations, as done by `recast_parquet`."""
+    conf_cols = ["conf_" + c for c in confidence_columns]
+    return df.with_columns(
+        [
+            C(c).cast(e, strict=c != GAS)
+            for c, e in enums.column_enums().items()
+            if c in df.columns
+        ]
+        + [
+            C(c).cast(enums.confidence_level_enum, strict=False)
+            for c in conf_cols
+            if c in df.columns
+        ]
+    )
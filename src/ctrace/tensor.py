@@ -0,0 +1,204 @@
+"""
+Dense in-memory representation of the country emissions.
+
+The country emissions are small enough to fit in a dense NumPy array indexed by
+(iso3_country, subsector, gas, month), with the codes of the enumerations as
+indexes. A lookup is then a single array access, instead of a filter and a
+group_by on a dataframe.
+
+The main function is `country_tensor`, which returns a `CountryTensor`.
+"""
+
+import logging
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import polars as pl
+from polars import col as C
+
+from . import enums
+from .constants import *
+from .data import read_country_emissions
+
+_logger = logging.getLogger(__name__)
+
+# The axes of the tensor.
+MONTH = "month"
+axes = [ISO3_COUNTRY, SUBSECTOR, GAS, MONTH]
+
+# The value of an axis: a single name, a list of names, or None for all the names.
+# The months are given as datetimes or as "YYYY-MM" strings.
+Selection = Union[str, Sequence[str], np.datetime64, None]
+
+
+@dataclass
+class CountryTensor:
+    """
+    The country emissions as a dense array.
+
+    values: the emissions, with the shape (iso3_country, subsector, gas, month),
+      and NaN for the missing emissions. The indexes of the first three axes are
+      the codes of `iso3_enum`, `subsector_enum` and `gas_enum`.
+    months: the first day of each month of the last axis.
+    """
+
+    values: np.ndarray
+    months: np.ndarray
+    _codes: Dict[str, Dict[str, int]] = field(repr=False, default_factory=dict)
+
+    def __post_init__(self) -> None:
+        """Checks the shape of the values, and indexes the names of the axes."""
+        assert self.values.ndim == 4, self.values.shape
+        assert self.values.shape[3] == len(self.months), (
+            self.values.shape,
+            self.months,
+        )
+        self._codes = {
+            a: {str(name): i for i, name in enumerate(self.names(a))} for a in axes
+        }
+
+    def names(self, axis: str) -> List[str]:
+        """The names of the indexes of an axis, the months as "YYYY-MM"."""
+        if axis == MONTH:
+            return [str(m)[:7] for m in self.months]
+        return _enum(axis).categories.to_list()
+
+    def index(self, axis: str, name: Union[str, np.datetime64]) -> int:
+        """The index of a name along an axis."""
+        if axis == MONTH:
+            name = str(np.datetime64(name, "M"))  # type: ignore[call-overload]
+        return self._codes[axis][str(name)]
+
+    def get(
+        self,
+        iso3_country: str,
+        subsector: str,
+        gas: Gas,
+        month: Union[str, np.datetime64],
+    ) -> float:
+        """The emissions of a single cell, or NaN."""
+        return float(
+            self.values[
+                self._codes[ISO3_COUNTRY][iso3_country],
+                self._codes[SUBSECTOR][subsector],
+                self._codes[GAS][gas],
+                self.index(MONTH, month),
+            ]
+        )
+
+    def select(
+        self,
+        iso3_country: Selection = None,
+        subsector: Selection = None,
+        gas: Selection = None,
+        month: Selection = None,
+    ) -> Tuple[np.ndarray, List[str]]:
+        """
+        A slice of the tensor, and the names of its remaining axes.
+
+        The axes selected with a single name are dropped. Without any list of
+        names, the slice is a view of the tensor, without any copy.
+        """
+        sel = {ISO3_COUNTRY: iso3_country, SUBSECTOR: subsector, GAS: gas, MONTH: month}
+        basic: List[Union[int, slice]] = []
+        lists: List[Tuple[int, np.ndarray]] = []
+        for a in axes:
+            s = sel[a]
+            if s is None:
+                basic.append(slice(None))
+            elif isinstance(s, (str, np.datetime64)):
+                basic.append(self.index(a, s))
+            else:
+                lists.append((len(basic), np.array([self.index(a, n) for n in s])))
+                basic.append(slice(None))
+        arr = self.values[tuple(basic)]
+        kept = [a for a, b in zip(axes, basic, strict=True) if isinstance(b, slice)]
+        for pos, idx in lists:
+            # The positions move left for each axis dropped before them.
+            pos -= sum(1 for b in basic[:pos] if not isinstance(b, slice))
+            arr = np.take(arr, idx, axis=pos)
+        return (arr, kept)
+
+    def sum(
+        self,
+        over: List[str],
+        iso3_country: Selection = None,
+        subsector: Selection = None,
+        gas: Selection = None,
+        month: Selection = None,
+    ) -> Union[np.ndarray, float]:
+        """
+        The sum of a slice of the tensor over some of its axes.
+
+        The missing values are ignored, and the sums of only missing values are NaN.
+        """
+        (arr, kept) = self.select(iso3_country, subsector, gas, month)
+        for a in over:
+            assert a in kept, f"Axis {a} not in the remaining axes {kept}"
+        pos = tuple(kept.index(a) for a in over)
+        res = np.nansum(arr, axis=pos)
+        missing = np.isnan(arr).all(axis=pos)
+        if np.ndim(res) == 0:
+            return float("nan") if missing else float(res)
+        res[missing] = np.nan
+        return res
+
+    def to_frame(self) -> pl.DataFrame:
+        """The non-missing cells, as a dataframe with one row per cell."""
+        idx = np.nonzero(~np.isnan(self.values))
+        cols = [
+            pl.Series(a, np.array(self.names(a))[i], dtype=_enum(a))
+            for a, i in zip(axes[:3], idx[:3], strict=True)
+        ]
+        month_s = pl.Series(MONTH, self.months[idx[3]].astype("datetime64[ms]")).cast(
+            pl.Datetime("ms", "UTC")
+        )
+        return pl.DataFrame(
+            cols + [month_s, pl.Series(EMISSIONS_QUANTITY, self.values[idx])]
+        )
+
+
+def country_tensor(
+    df: Optional[pl.DataFrame] = None,
+    gas: Union[Gas, List[Gas]] = GAS_LIST,
+    parquet_path: Optional[Path] = None,
+) -> CountryTensor:
+    """
+    Builds the tensor of the country emissions.
+
+    df: the country emissions (see `read_country_emissions`). If None, they are
+      read for the given gases from the given parquet file (or the default one).
+
+    The emissions are summed by calendar month of their start time.
+    """
+    if df is None:
+        df = read_country_emissions(gas, parquet_path=parquet_path)
+    df = df.filter(c_emissions_quantity.is_not_null()).select(
+        *[C(a).cast(_enum(a)).to_physical().alias(a) for a in axes[:3]],
+        c_start_time.dt.truncate("1mo").dt.replace_time_zone(None).alias(MONTH),
+        c_emissions_quantity,
+    )
+    month_values = df[MONTH].to_numpy().astype("datetime64[M]")
+    months = np.unique(month_values)
+    shape = tuple(len(_enum(a).categories) for a in axes[:3]) + (len(months),)
+    flat = np.ravel_multi_index(
+        (
+            df[ISO3_COUNTRY].to_numpy(),
+            df[SUBSECTOR].to_numpy(),
+            df[GAS].to_numpy(),
+            np.searchsorted(months, month_values),
+        ),
+        shape,
+    )
+    size = int(np.prod(shape))
+    sums = np.bincount(flat, weights=df[EMISSIONS_QUANTITY].to_numpy(), minlength=size)
+    counts = np.bincount(flat, minlength=size)
+    values = np.where(counts > 0, sums, np.nan).reshape(shape)
+    _logger.debug(f"country tensor of shape {shape}, {np.count_nonzero(counts)} cells")
+    return CountryTensor(values=values, months=months)
+
+
+def _enum(axis: str) -> pl.Enum:
+    return enums.column_enums()[axis]
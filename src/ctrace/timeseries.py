@@ -0,0 +1,174 @@
+"""
+Per-source time series of the source emissions.
+
+The source files hold one record per source and month, which is the right
+layout to aggregate over many sources. The analyses of single sources (trends,
+seasonality, plots) need instead all the months of a source together, which
+takes a group_by over the whole files.
+
+The time series files hold one row per (source_id, gas), with the monthly values
+of `timeseries_columns` as fixed-length array columns. All the arrays of a file
+are aligned on the same month axis, which covers all the months of the years of
+the file. The months without a value are NaN. The values of a set of sources
+are then a contiguous 2D NumPy array (see `timeseries_values`):
+
+    df = read_source_timeseries(CO2, p).filter(c_subsector == "electricity-generation")
+    values = timeseries_values(df.collect())  # shape (sources, months)
+    months = timeseries_months(CO2, p)
+
+The files are written from the source files with `write_timeseries_file`.
+"""
+
+import json
+import logging
+from pathlib import Path
+from typing import List, Optional, Union
+
+import numpy as np
+import polars as pl
+from polars import col as C
+
+from . import enums
+from .constants import *
+from .data import (
+    _check_gas,
+    _check_year,
+    _source_path,
+    read_source_emissions,
+)
+
+_logger = logging.getLogger(__name__)
+
+# The time series files, relative to the root directory. They hold all the
+# years of a gas.
+_timeseries_fname = "{version}/climate_trace-sources-timeseries_{version}_{gas}.parquet"
+
+# The key of the month axis in the metadata of the files.
+_months_key = "ctrace.months"
+
+# The monthly values stored as arrays.
+timeseries_columns = [EMISSIONS_QUANTITY, ACTIVITY, CAPACITY_FACTOR]
+
+# The columns describing each source.
+_key_columns = [SOURCE_ID, GAS, ISO3_COUNTRY, SECTOR, SUBSECTOR]
+
+
+def write_timeseries_file(
+    gas: Gas,
+    year: Union[int, List[int], None] = None,
+    p: Union[Path, str, None] = None,
+    out_p: Union[Path, str, None] = None,
+    row_group_size: int = 50_000,
+) -> Path:
+    """
+    Writes the time series of the sources of a gas, and returns the path of the
+    file.
+
+    year, p: the source files to read (see `read_source_emissions`).
+    out_p: the root directory of the time series file (by default, p).
+
+    The records of a source in the same month are merged: the emissions and
+    the activity are summed, and the capacity factors are averaged, over the
+    records with a value. The country,
+    sector and subsector of a source are those of its first record.
+    """
+    [gas] = _check_gas(gas)
+    ys = sorted(_check_year(year))
+    out_p = out_p if out_p is not None else p
+    assert out_p is not None, "The output directory is required"
+    months = np.arange(
+        np.datetime64(f"{ys[0]}-01", "M"), np.datetime64(f"{ys[-1] + 1}-01", "M")
+    )
+    df = (
+        read_source_emissions(
+            gas, ys, p, columns=[*_key_columns, START_TIME, *timeseries_columns]
+        )
+        .filter(c_start_time.dt.year().is_in(ys))
+        .group_by(
+            SOURCE_ID,
+            GAS,
+            c_start_time.dt.truncate("1mo").dt.replace_time_zone(None).alias("_month"),
+        )
+        .agg(
+            c_iso3_country.first(),
+            c_sector.first(),
+            c_subsector.first(),
+            # A month without any value stays missing, instead of a sum of zero.
+            *[
+                pl.when(C(c).count() > 0).then(C(c).sum()).alias(c)
+                for c in [EMISSIONS_QUANTITY, ACTIVITY]
+            ],
+            c_capacity_factor.mean(),
+        )
+        .collect()
+    )
+    # The row of each source, in the order of the file: by subsector so that the
+    # queries on a subsector can skip most of the row groups.
+    sources = (
+        df.group_by(SOURCE_ID, GAS)
+        .agg(c_iso3_country.first(), c_sector.first(), c_subsector.first())
+        .sort(by=[SUBSECTOR, SOURCE_ID])
+        .with_row_index("_row")
+    )
+    df = df.join(sources.select(SOURCE_ID, GAS, "_row"), on=[SOURCE_ID, GAS])
+    rows = df["_row"].to_numpy()
+    month_idx = np.searchsorted(months, df["_month"].to_numpy().astype("datetime64[M]"))
+    arrays = []
+    for c in timeseries_columns:
+        values = np.full((sources.height, len(months)), np.nan)
+        values[rows, month_idx] = df[c].fill_null(np.nan).to_numpy()
+        arrays.append(pl.Series(c, values))
+    res = sources.select(_key_columns).with_columns(arrays)
+    path = _source_path(_timeseries_fname, 0, gas, out_p)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    _logger.debug(f"writing time series of {res.height} sources to {path}")
+    res.write_parquet(
+        path,
+        compression="zstd",
+        statistics=True,
+        row_group_size=row_group_size,
+        metadata={_months_key: json.dumps([str(m) for m in months])},
+    )
+    return path
+
+
+def read_source_timeseries(
+    gas: Union[Gas, List[Gas]],
+    p: Union[Path, str, None] = None,
+    columns: Optional[List[str]] = None,
+) -> pl.LazyFrame:
+    """
+    The time series of the sources, with one row per (source_id, gas).
+
+    columns: the columns to read (by default, all of them).
+
+    The files of several gases must share the same month axis.
+    """
+    gases = _check_gas(gas)
+    if len(gases) > 1:
+        months = [timeseries_months(g, p) for g in gases]
+        for m in months[1:]:
+            assert np.array_equal(m, months[0]), "Different month axes"
+    dfs = []
+    for gas_ in gases:
+        df = pl.scan_parquet(_source_path(_timeseries_fname, 0, gas_, p))
+        df = df.with_columns(
+            [C(c).cast(enums.column_enums()[c]) for c in _key_columns if c != SOURCE_ID]
+        )
+        dfs.append(df if columns is None else df.select(columns))
+    return pl.concat(dfs)
+
+
+def timeseries_months(gas: Gas, p: Union[Path, str, None] = None) -> np.ndarray:
+    """The month axis of the time series of a gas, as datetime64[M]."""
+    path = _source_path(_timeseries_fname, 0, gas, p)
+    months = json.loads(pl.read_parquet_metadata(path)[_months_key])
+    return np.array(months, dtype="datetime64[M]")
+
+
+def timeseries_values(df: pl.DataFrame, column: str = EMISSIONS_QUANTITY) -> np.ndarray:
+    """
+    The monthly values of the sources of a time series dataframe, as an array of
+    shape (sources, months).
+    """
+    return df[column].to_numpy()
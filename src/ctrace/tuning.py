@@ -0,0 +1,232 @@
+"""
+Tuning of the layout and the encodings of the source files.
+
+The settings of the writer (see `WriterConfig`) trade the size of the files, the
+time to write them and the latency of the queries. `tune` writes a sample of the
+real data with candidate settings, measures the size of the files, the write
+time and the latency of a set of reference queries, and recommends the best
+settings.
+
+The tuner can also be run from the command line on the existing files:
+
+    python -m ctrace.tuning --gas co2 --year 2023 --path <dir> --out config.json
+"""
+
+import argparse
+import dataclasses
+import logging
+import shutil
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import polars as pl
+from polars import col as C
+
+from . import runtime
+from .constants import *
+from .data import (
+    WriterConfig,
+    _check_gas,
+    _check_year,
+    _collect_streaming,
+    read_source_emissions,
+    write_source_file,
+)
+
+_logger = logging.getLogger(__name__)
+
+# A reference query, applied to the records of a source file.
+Query = Callable[[pl.LazyFrame], pl.LazyFrame]
+
+# The values tried for each setting of the writer. The row group sizes should be
+# compared on a sample with at least as many rows.
+candidates: Dict[str, List[Any]] = {
+    "compression_level": [1, 3, 6, 9],
+    "row_group_size": [100_000, 300_000, 1_000_000],
+    "data_page_size": [None, 1 << 20, 8 << 20],
+    "dictionary": [True, False],
+    "byte_stream_split": [False, True],
+    "sort_by": [
+        (SUBSECTOR,),
+        (SUBSECTOR, ISO3_COUNTRY),
+        (SUBSECTOR, SOURCE_ID),
+        (ISO3_COUNTRY, SUBSECTOR),
+    ],
+}
+
+# Output columns
+CANDIDATE = "candidate"
+SIZE_BYTES = "size_bytes"
+WRITE_SECONDS = "write_seconds"
+SCAN_SECONDS = "scan_seconds"
+SCORE = "score"
+
+_row = "_row"
+
+
+def reference_queries(df: pl.DataFrame) -> Dict[str, Query]:
+    """
+    The typical queries on the source emissions: aggregates over the whole file,
+    over the most common subsector and country, a lookup of a single source, and
+    a full scan of the numerical columns.
+    """
+    subsector = df[SUBSECTOR].drop_nulls().mode().sort()[0]
+    country = df[ISO3_COUNTRY].drop_nulls().mode().sort()[0]
+    source_id = df[SOURCE_ID].drop_nulls()[0]
+    return {
+        "total": lambda lf: lf.group_by(SUBSECTOR).agg(c_emissions_quantity.sum()),
+        "subsector": lambda lf: lf.filter(c_subsector == subsector)
+        .group_by(ISO3_COUNTRY)
+        .agg(c_emissions_quantity.sum()),
+        "country": lambda lf: lf.filter(c_iso3_country == country)
+        .group_by(START_TIME)
+        .agg(c_emissions_quantity.sum()),
+        "source": lambda lf: lf.filter(c_source_id == source_id).select(
+            START_TIME, EMISSIONS_QUANTITY
+        ),
+        "full": lambda lf: lf.select(pl.exclude(text_columns)),
+    }
+
+
+def tune(
+    df: Union[pl.DataFrame, pl.LazyFrame],
+    gas: Gas,
+    year: int,
+    sample_rows: int = 2_000_000,
+    queries: Optional[Dict[str, Query]] = None,
+    settings: Optional[Dict[str, List[Any]]] = None,
+    base: Optional[WriterConfig] = None,
+    bandwidth: float = 100e6,
+    write_weight: float = 0.0,
+    min_gain: float = 0.02,
+    repeat: int = 3,
+    seed: int = 0,
+) -> Tuple[WriterConfig, pl.DataFrame]:
+    """
+    Recommends the settings of the writer for a dataset.
+
+    df: the source emissions of one gas and one year, as passed to
+      `write_source_file`. A random sample of about `sample_rows` records, drawn
+      while streaming the records, is tuned on.
+    queries: the reference queries (see `reference_queries` for the default).
+    settings: the values tried for each setting (see `candidates`).
+    base: the initial settings (the current defaults by default).
+    bandwidth: the speed of the reads from the storage, in bytes per second.
+    write_weight: the weight of the write time in the score.
+    min_gain: the relative improvement of the score needed to change a setting,
+      which filters out the noise of the measures.
+    repeat: the number of runs of each query. The fastest one is kept.
+
+    The score of a configuration is the latency of the queries on local files,
+    plus the time to read the files at the given bandwidth, plus the weighted
+    write time. The settings are tuned one at a time, each one starting from the
+    best values found for the previous ones. The write time includes the first
+    pass of `write_source_file`, which sorts the records into a temporary file
+    with fixed encodings: apart from the sort, it adds the same cost to all the
+    candidates.
+
+    Returns the recommended configuration, and the measures of all the candidates
+    sorted by score.
+    """
+    [gas] = _check_gas(gas)
+    [year] = _check_year(year)
+    sample_df = _sample_records(df.lazy(), sample_rows, seed)
+    queries = queries or reference_queries(sample_df)
+    settings = settings or candidates
+    best = base or WriterConfig()
+    rows: List[Dict[str, Any]] = []
+    scores: Dict[WriterConfig, float] = {}
+
+    def measure(config: WriterConfig, name: str) -> float:
+        if config in scores:
+            return scores[config]
+        out_p = tmp_dir / str(len(scores))
+        start = time.perf_counter()
+        paths = write_source_file(sample_df.lazy(), gas, year, out_p, config=config)
+        write_seconds = time.perf_counter() - start
+        size = sum(p_.stat().st_size for p_ in paths)
+        lf = read_source_emissions(gas, year, out_p)
+        query_seconds = {}
+        for q_name, q in queries.items():
+            runs = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                q(lf).collect()
+                runs.append(time.perf_counter() - start)
+            query_seconds[q_name] = min(runs)
+        shutil.rmtree(out_p)
+        scan_seconds = sum(query_seconds.values())
+        score = scan_seconds + size / bandwidth + write_weight * write_seconds
+        _logger.debug(f"{name}: score {score:.3f} size {size} scan {scan_seconds:.3f}")
+        scores[config] = score
+        rows.append(
+            {
+                CANDIDATE: name,
+                **dataclasses.asdict(config),
+                SIZE_BYTES: size,
+                WRITE_SECONDS: write_seconds,
+                SCAN_SECONDS: scan_seconds,
+                **{f"scan_{q_name}": s for (q_name, s) in query_seconds.items()},
+                SCORE: score,
+            }
+        )
+        return score
+
+    with runtime.scratch("tuning") as tmp_dir:
+        best_score = measure(best, "base")
+        for setting, values in settings.items():
+            for v in values:
+                config = dataclasses.replace(best, **{setting: v})
+                v_name = ",".join(v) if isinstance(v, tuple) else v
+                score = measure(config, f"{setting}={v_name}")
+                if score < best_score * (1 - min_gain):
+                    (best, best_score) = (config, score)
+    _logger.info(f"recommended writer configuration: {best.to_json()}")
+    report = (
+        pl.DataFrame(rows).with_columns(pl.col("sort_by").list.join(",")).sort(by=SCORE)
+    )
+    return (best, report)
+
+
+def _sample_records(lf: pl.LazyFrame, sample_rows: int, seed: int) -> pl.DataFrame:
+    """
+    A random sample of about `sample_rows` records. The records are kept on a
+    hash of their position, so that only the sample is held in memory.
+    """
+    num_rows = _collect_streaming(lf.select(pl.len())).item()
+    if num_rows > sample_rows:
+        buckets = 1 << 32
+        threshold = int(sample_rows / num_rows * buckets)
+        lf = (
+            lf.with_row_index(_row)
+            .filter(C(_row).hash(seed) % buckets < threshold)
+            .drop(_row)
+        )
+    return _collect_streaming(lf)
+
+
+def _main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m ctrace.tuning",
+        description="Recommends the settings of the writer of the source files.",
+    )
+    parser.add_argument("--gas", default=CO2)
+    parser.add_argument("--year", type=int, required=True)
+    parser.add_argument("--path", default=None, help="the directory of the files")
+    parser.add_argument("--sample-rows", type=int, default=2_000_000)
+    parser.add_argument("--out", default=None, help="writes the configuration")
+    args = parser.parse_args(argv)
+    df = read_source_emissions(args.gas, args.year, args.path)
+    (config, report) = tune(df, args.gas, args.year, sample_rows=args.sample_rows)
+    with pl.Config(tbl_rows=-1, tbl_cols=-1):
+        print(report.select(CANDIDATE, SIZE_BYTES, WRITE_SECONDS, SCAN_SECONDS, SCORE))
+    print(config.to_json())
+    if args.out:
+        Path(args.out).write_text(config.to_json())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main(sys.argv[1:]))
@@ -0,0 +1,268 @@
+"""
+Propagation of the uncertainty of the source emissions to aggregates.
+
+The source emissions come with qualitative confidence levels (the `conf_*` columns).
+This module turns these levels into distributions of the emissions and
+propagates them to aggregates (by country, sector, ...), either analytically
+or by Monte Carlo sampling.
+
+The main functions are `propagate` and `monte_carlo`.
+"""
+
+import collections
+import concurrent.futures
+import logging
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Deque, Dict, List, Literal, Optional, Tuple, Union
+
+import numpy as np
+import polars as pl
+import pyarrow.parquet
+from polars import col as C
+
+from .constants import *
+from .data import (
+    Frame,
+    _check_gas,
+    _check_year,
+    _source_fname,
+    _source_path,
+)
+
+_logger = logging.getLogger(__name__)
+
+# Output columns
+EMISSIONS_STD = "emissions_std"
+EMISSIONS_MEAN = "emissions_mean"
+EMISSIONS_Q05 = "emissions_q05"
+EMISSIONS_Q95 = "emissions_q95"
+
+Distribution = Literal["normal", "lognormal"]
+
+# Relative standard deviation for each confidence level.
+# A very high confidence is around 1% standard deviation and a very low
+# confidence is around 30%, with a geometric progression in between.
+default_margins: Dict[str, float] = {
+    VERY_HIGH: 0.01,
+    HIGH: 0.03,
+    MEDIUM: 0.07,
+    LOW: 0.15,
+    VERY_LOW: 0.3,
+}
+
+
+@dataclass(frozen=True)
+class UncertaintyModel:
+    """
+    Maps the qualitative confidence levels to distributions of the emissions.
+
+    margins: the relative standard deviation for each confidence level.
+    default: the confidence level assumed when none is provided. By default,
+      we err on the side of caution and assume a very low confidence.
+    distribution: "normal" keeps the sign and can produce values of the
+      opposite sign for large margins, "lognormal" preserves the sign of each
+      emission. Both have the same mean and standard deviation.
+    column: the confidence column.
+    """
+
+    margins: Dict[str, float] = field(default_factory=lambda: dict(default_margins))
+    default: str = VERY_LOW
+    distribution: Distribution = "normal"
+    column: str = "conf_" + EMISSIONS_QUANTITY
+
+    def relative_std(self) -> pl.Expr:
+        """The relative standard deviation of each row."""
+        return C(self.column).replace_strict(
+            self.margins,
+            return_dtype=pl.Float64,
+            default=self.margins[self.default],
+        )
+
+
+def propagate(
+    df: Frame,
+    by: List[str],
+    model: Optional[UncertaintyModel] = None,
+    correlated: bool = False,
+) -> Frame:
+    """
+    Analytically propagates the uncertainty of the emissions to aggregates.
+
+    The emissions are aggregated by the `by` columns, and the standard deviation of
+    each aggregate is returned in the `emissions_std` column.
+
+    If `correlated` is False, the errors of the sources are assumed to be
+    independent: the variances add up. If True, the errors are assumed to be
+    fully correlated: the standard deviations add up. This is an upper bound of
+    the uncertainty.
+
+    This works on any frame with the emissions and the confidence columns.
+    """
+    model = model or UncertaintyModel()
+    std = model.relative_std() * c_emissions_quantity.abs()
+    agg_std = std.sum() if correlated else std.pow(2).sum().sqrt()
+    return df.group_by(by).agg(
+        c_emissions_quantity.sum(),
+        agg_std.alias(EMISSIONS_STD),
+        pl.len().alias("count"),
+    )
+
+
+def monte_carlo(
+    gas: Union[Gas, List[Gas]],
+    year: Union[int, List[int], None] = None,
+    by: Optional[List[str]] = None,
+    model: Optional[UncertaintyModel] = None,
+    p: Optional[Path] = None,
+    n_samples: int = 1000,
+    seed: int = 0,
+    max_elements: int = 10_000_000,
+    max_workers: Optional[int] = None,
+) -> pl.DataFrame:
+    """
+    Propagates the uncertainty of the source emissions to aggregates by
+    Monte Carlo sampling.
+
+    The emissions of each source are drawn independently from the distribution
+    given by the model, and summed by the `by` columns (by default, by country and
+    subsector).
+
+    The source files are streamed by row group and sampled in batches of at most
+    `max_elements` draws, so that the memory stays bounded regardless of the
+    number of sources. The row groups are processed in parallel, by default
+    with one thread per core, and at most two row groups per thread are sampled
+    ahead of the merge of their results. The results are reproducible for a given
+    seed.
+
+    Returns a dataframe with, for each group, the total emissions, and the mean,
+    standard deviation, 5% and 95% quantiles of the sampled totals.
+    """
+    model = model or UncertaintyModel()
+    by = by or [ISO3_COUNTRY, SUBSECTOR]
+    ys = _check_year(year)
+    gases = _check_gas(gas)
+    tasks: List[Tuple[Path, int]] = []
+    for year_ in ys:
+        for gas_ in gases:
+            local_p = _source_path(_source_fname, year_, gas_, p)
+            num_rgs = pyarrow.parquet.ParquetFile(local_p).num_row_groups
+            tasks.extend((local_p, i) for i in range(num_rgs))
+    _logger.debug(f"monte carlo over {len(tasks)} row groups")
+    seeds = np.random.SeedSequence(seed).spawn(len(tasks))
+    totals: Dict[tuple, float] = {}
+    samples: Dict[tuple, np.ndarray] = {}
+
+    def merge(fut: concurrent.futures.Future) -> None:
+        (keys, rg_totals, rg_samples) = fut.result()
+        for key, total, sample in zip(keys, rg_totals, rg_samples, strict=True):
+            if key in samples:
+                totals[key] += total
+                samples[key] += sample
+            else:
+                totals[key] = total
+                samples[key] = sample
+
+    num_workers = max_workers or os.cpu_count() or 1
+    pending: Deque[concurrent.futures.Future] = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for (local_p, i), seed_ in zip(tasks, seeds, strict=True):
+            pending.append(
+                executor.submit(
+                    _sample_row_group,
+                    local_p,
+                    i,
+                    by,
+                    model,
+                    n_samples,
+                    seed_,
+                    max_elements,
+                )
+            )
+            # Merged in order, so that the sums do not depend on the scheduling.
+            if len(pending) >= 2 * num_workers:
+                merge(pending.popleft())
+        while pending:
+            merge(pending.popleft())
+    keys = list(samples.keys())
+    arr = np.stack([samples[k] for k in keys]) if keys else np.zeros((0, n_samples))
+    res = pl.DataFrame(
+        [pl.Series(b, [k[i] for k in keys], dtype=pl.String) for i, b in enumerate(by)]
+        + [
+            pl.Series(EMISSIONS_QUANTITY, [totals[k] for k in keys], pl.Float64),
+            pl.Series(EMISSIONS_MEAN, arr.mean(axis=1), pl.Float64),
+            pl.Series(EMISSIONS_STD, arr.std(axis=1), pl.Float64),
+            pl.Series(EMISSIONS_Q05, np.quantile(arr, 0.05, axis=1), pl.Float64),
+            pl.Series(EMISSIONS_Q95, np.quantile(arr, 0.95, axis=1), pl.Float64),
+        ]
+    )
+    return res.sort(by=by)
+
+
+def _sample_row_group(
+    local_p: Path,
+    rg: int,
+    by: List[str],
+    model: UncertaintyModel,
+    n_samples: int,
+    seed: np.random.SeedSequence,
+    max_elements: int,
+) -> Tuple[List[tuple], np.ndarray, np.ndarray]:
+    cols = list(dict.fromkeys(by + [EMISSIONS_QUANTITY, model.column]))
+    tb = pyarrow.parquet.ParquetFile(local_p).read_row_group(rg, columns=cols)
+    rg_df = pl.from_arrow(tb)
+    assert isinstance(rg_df, pl.DataFrame)
+    df = (
+        rg_df.lazy()
+        .filter(c_emissions_quantity.is_not_null())
+        .select(
+            *[C(b).cast(pl.String) for b in by],
+            c_emissions_quantity,
+            model.relative_std().alias("rel_std"),
+        )
+        .collect()
+    )
+    assert isinstance(df, pl.DataFrame)
+    groups = df.select(by).with_row_index("row").group_by(by).agg(C("row").min())
+    groups = groups.sort("row").with_row_index("group_id")
+    df = df.join(groups.drop("row"), on=by, how="left")
+    gid = df["group_id"].to_numpy()
+    x = df[EMISSIONS_QUANTITY].to_numpy()
+    rel = df["rel_std"].to_numpy()
+    n_groups = len(groups)
+    acc = np.zeros((n_groups, n_samples))
+    rng = np.random.default_rng(seed)
+    # Sample by batches of rows to bound the memory.
+    batch = max(1, max_elements // n_samples)
+    for start in range(0, len(x), batch):
+        x_b = x[start : start + batch]
+        draws = _draw(rng, x_b, rel[start : start + batch], model, n_samples)
+        gid_b = gid[start : start + batch]
+        order = np.argsort(gid_b, kind="stable")
+        (uniq, starts) = np.unique(gid_b[order], return_index=True)
+        acc[uniq] += np.add.reduceat(draws[order], starts, axis=0)
+    totals = np.bincount(gid, weights=x, minlength=n_groups)
+    keys = list(groups.select(by).iter_rows())
+    return (keys, totals, acc)
+
+
+def _draw(
+    rng: np.random.Generator,
+    x: np.ndarray,
+    rel: np.ndarray,
+    model: UncertaintyModel,
+    n_samples: int,
+) -> np.ndarray:
+    """Draws samples of shape (rows, n_samples)."""
+    shape = (len(x), n_samples)
+    if model.distribution == "normal":
+        z = rng.standard_normal(shape)
+        return x[:, None] * (1.0 + rel[:, None] * z)
+    elif model.distribution == "lognormal":
+        # Parametrized to preserve the mean and the relative standard deviation.
+        sigma2 = np.log1p(rel**2)
+        mu = -0.5 * sigma2
+        z = rng.standard_normal(shape)
+        return x[:, None] * np.exp(mu[:, None] + np.sqrt(sigma2)[:, None] * z)
+    raise ValueError(f"Unknown distribution {model.distribution}")
@@ -0,0 +1,309 @@
+"""
+Data quality checks of the source and country files.
+
+The checks run over the parquet files one row group at a time, so that the
+memory stays bounded by the size of a row group, and over several files in
+parallel. They apply both to the files of the ingestion (see
+`load_source_compact` and `ctrace.shards`) and to the published files.
+
+The checks are:
+
+- enum: the values of the enumerated columns belong to their enumeration.
+- nulls: the rate of missing values of each column, which must stay below a
+  threshold for the required columns.
+- unique: the records are unique by (source_id, start_time, gas) for the
+  sources, and by (iso3_country, subsector, gas, start_time, end_time) for the
+  countries.
+- range: the numerical values are finite and within their bounds (see
+  `value_ranges`), including the latitudes and longitudes.
+
+The main functions are `validate_source_files` and `validate_country_file`,
+which return a `ValidationReport`.
+"""
+
+import concurrent.futures
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Literal, Optional, Tuple, Union
+
+import numpy as np
+import polars as pl
+from polars import col as C
+
+from . import enums
+from .constants import *
+from .data import (
+    _check_gas,
+    _check_year,
+    _source_fname,
+    _source_path,
+)
+
+_logger = logging.getLogger(__name__)
+
+# The kinds of files.
+Kind = Literal["sources", "countries"]
+
+# The checks
+ENUM = "enum"
+NULLS = "nulls"
+UNIQUE = "unique"
+RANGE = "range"
+
+# The keys of the records of each kind of file.
+unique_keys: Dict[str, List[str]] = {
+    "sources": [SOURCE_ID, START_TIME, GAS],
+    "countries": [ISO3_COUNTRY, SUBSECTOR, GAS, START_TIME, END_TIME],
+}
+
+# The maximum rate of missing values of the required columns.
+max_null_rates: Dict[str, float] = {
+    SOURCE_ID: 0.0,
+    ISO3_COUNTRY: 0.0,
+    GAS: 0.0,
+    SECTOR: 0.0,
+    SUBSECTOR: 0.0,
+    START_TIME: 0.0,
+    END_TIME: 0.0,
+}
+
+# The (lower, upper) bounds of the numerical columns, None if unbounded. The
+# values must also be finite.
+value_ranges: Dict[str, Tuple[Optional[float], Optional[float]]] = {
+    EMISSIONS_QUANTITY: (None, None),
+    EMISSIONS_FACTOR: (None, None),
+    ACTIVITY: (None, None),
+    CAPACITY: (0.0, None),
+    CAPACITY_FACTOR: (0.0, None),
+    LAT: (-90.0, 90.0),
+    LON: (-180.0, 180.0),
+}
+
+# The number of invalid values given as examples in the report.
+_num_examples = 3
+
+# Output columns
+FILE = "file"
+CHECK = "check"
+COLUMN = "column"
+NUM_ROWS = "num_rows"
+NUM_FAILED = "num_failed"
+FAILED_RATE = "failed_rate"
+PASSED = "passed"
+DETAIL = "detail"
+
+
+@dataclass
+class ValidationReport:
+    """
+    The results of the checks.
+
+    results: one row for each file, check and column, with the number of rows
+      checked and of rows that failed. The null rates are reported for all the
+      columns with missing values, and only fail for the required columns. The
+      detail holds examples of the invalid values, or the range of the values.
+    """
+
+    results: pl.DataFrame
+
+    @property
+    def ok(self) -> bool:
+        """True if all the checks passed."""
+        return bool(self.results[PASSED].all())
+
+    def failures(self) -> pl.DataFrame:
+        """The checks that failed."""
+        return self.results.filter(~C(PASSED))
+
+    def summary(self) -> pl.DataFrame:
+        """The number of files and rows that failed each check."""
+        return (
+            self.results.group_by(CHECK, COLUMN)
+            .agg(
+                (~C(PASSED)).sum().alias("failed_files"),
+                C(NUM_FAILED).filter(~C(PASSED)).sum(),
+            )
+            .filter(C("failed_files") > 0)
+            .sort(by=[CHECK, COLUMN])
+        )
+
+
+def validate_source_files(
+    gas: Union[Gas, List[Gas]] = GAS_LIST,
+    year: Union[int, List[int], None] = None,
+    p: Union[Path, str, None] = None,
+    max_workers: Optional[int] = None,
+) -> ValidationReport:
+    """
+    Checks the published source files (see `read_source_emissions`).
+
+    The files of each gas and year are checked in parallel. The text columns,
+    in their own files, are not checked.
+    """
+    paths = [
+        _source_path(_source_fname, year_, gas_, p)
+        for year_ in _check_year(year)
+        for gas_ in _check_gas(gas)
+    ]
+    return validate_files(paths, "sources", max_workers)
+
+
+def validate_country_file(parquet_path: Path) -> ValidationReport:
+    """Checks the file of the country emissions (see `read_country_emissions`)."""
+    return validate_files([parquet_path], "countries")
+
+
+def validate_files(
+    paths: List[Path], kind: Kind, max_workers: Optional[int] = None
+) -> ValidationReport:
+    """
+    Checks parquet files of sources or countries, such as the intermediate
+    files of the ingestion.
+    """
+    assert kind in unique_keys, kind
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_validate_file, Path(p_), kind) for p_ in paths]
+        rows = [row for fut in futures for row in fut.result()]
+    schema = {
+        FILE: pl.String,
+        CHECK: pl.String,
+        COLUMN: pl.String,
+        NUM_ROWS: pl.Int64,
+        NUM_FAILED: pl.Int64,
+        FAILED_RATE: pl.Float64,
+        PASSED: pl.Boolean,
+        DETAIL: pl.String,
+    }
+    report = ValidationReport(results=pl.DataFrame(rows, schema=schema, orient="row"))
+    _logger.info(f"validated {len(paths)} files: {report.failures().height} failures")
+    return report
+
+
+def _validate_file(path: Path, kind: Kind) -> List[Tuple[Any, ...]]:
+    import pyarrow.parquet
+
+    _logger.debug(f"validating {path}")
+    pq_file = pyarrow.parquet.ParquetFile(path)
+    names = pq_file.schema_arrow.names
+    keys = [c for c in unique_keys[kind] if c in names]
+    enum_cols = {c: e for c, e in _column_enums().items() if c in names}
+    range_cols = [c for c in value_ranges if c in names]
+    num_rows = 0
+    nulls = dict.fromkeys(names, 0)
+    invalid: Dict[str, Dict[str, int]] = {c: {} for c in enum_cols}
+    out_of_range = dict.fromkeys(range_cols, 0)
+    bounds: Dict[str, Tuple[Any, Any]] = {}
+    hashes: List[np.ndarray] = []
+    for i in range(pq_file.num_row_groups):
+        df = pl.from_arrow(pq_file.read_row_group(i))
+        assert isinstance(df, pl.DataFrame)
+        num_rows += df.height
+        for c, n in df.null_count().row(0, named=True).items():
+            nulls[c] += n
+        for c, enum in enum_cols.items():
+            counts = (
+                df[c]
+                .drop_nulls()
+                .cast(pl.String)
+                .value_counts()
+                .filter(~C(c).is_in(enum.categories.implode()))
+            )
+            for v, n in counts.iter_rows():
+                invalid[c][v] = invalid[c].get(v, 0) + n
+        for c in range_cols:
+            (lo, hi) = value_ranges[c]
+            s = df[c].cast(pl.Float64).drop_nulls()
+            bad = ~s.is_finite()
+            if lo is not None:
+                bad = bad | (s < lo)
+            if hi is not None:
+                bad = bad | (s > hi)
+            out_of_range[c] += int(bad.sum())
+            finite = s.filter(s.is_finite())
+            if finite.len():
+                (v_min, v_max) = (finite.min(), finite.max())
+                if c in bounds:
+                    v_min = min(v_min, bounds[c][0])
+                    v_max = max(v_max, bounds[c][1])
+                bounds[c] = (v_min, v_max)
+        if keys:
+            hashes.append(df.select(_key_hash(keys)).to_series().to_numpy())
+    name = str(path)
+    rows: List[Tuple[Any, ...]] = []
+
+    def add(check: str, column: str, num_failed: int, passed: bool, detail: str):
+        rate = num_failed / num_rows if num_rows else 0.0
+        rows.append((name, check, column, num_rows, num_failed, rate, passed, detail))
+
+    for c, counts_ in invalid.items():
+        top = sorted(counts_.items(), key=lambda kv: -kv[1])[:_num_examples]
+        detail = ", ".join(f"{v!r} ({n})" for v, n in top)
+        add(ENUM, c, sum(counts_.values()), not counts_, detail)
+    for c, n in nulls.items():
+        max_rate = max_null_rates.get(c)
+        if n == 0 and max_rate is None:
+            continue
+        passed = max_rate is None or n <= max_rate * num_rows
+        detail = f"max rate {max_rate}" if max_rate is not None else ""
+        add(NULLS, c, n, passed, detail)
+    if keys:
+        add(UNIQUE, ",".join(keys), *_duplicates(path, keys, hashes))
+    for c in range_cols:
+        detail = "no values"
+        if c in bounds:
+            (v_min, v_max) = bounds[c]
+            detail = f"values in [{v_min:g}, {v_max:g}]"
+        add(RANGE, c, out_of_range[c], out_of_range[c] == 0, detail)
+    return rows
+
+
+def _duplicates(
+    path: Path, keys: List[str], hashes: List[np.ndarray]
+) -> Tuple[int, bool, str]:
+    """
+    The number of duplicate records (beyond the first one of each key).
+
+    The hashes of the keys of all the row groups give the candidate duplicates.
+    Their keys are read again and compared, so that the collisions of the hashes
+    are not counted.
+    """
+    if not hashes:
+        return (0, True, "")
+    (uniques, counts) = np.unique(np.concatenate(hashes), return_counts=True)
+    if not (counts > 1).any():
+        return (0, True, "")
+    dup_hashes = pl.Series(uniques[counts > 1])
+    dups = (
+        pl.scan_parquet(path)
+        .select(keys)
+        .filter(_key_hash(keys).is_in(dup_hashes.implode()))
+        .group_by(keys)
+        .agg(pl.len().alias("_count"))
+        .filter(C("_count") > 1)
+        .collect()
+    )
+    num_duplicates = int((dups["_count"] - 1).sum())
+    if num_duplicates == 0:
+        return (0, True, "")
+    examples = dups.sort(by=["_count"] + keys, descending=[True] + [False] * len(keys))
+    detail = "; ".join(
+        ", ".join(f"{k}={v}" for k, v in d.items())
+        for d in examples.drop("_count").head(_num_examples).iter_rows(named=True)
+    )
+    return (num_duplicates, False, detail)
+
+
+def _key_hash(keys: List[str]) -> pl.Expr:
+    # The enumerated columns are hashed by value: their codes depend on the reader.
+    enum_cols = _column_enums()
+    return pl.struct(
+        [C(c).cast(pl.String) if c in enum_cols else C(c) for c in keys]
+    ).hash()
+
+
+def _column_enums() -> Dict[str, pl.Enum]:
+    return {
+        **enums.column_enums(),
+        **{"conf_" + c: enums.confidence_level_enum for c in confidence_columns},
+    }
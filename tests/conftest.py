@@ -0,0 +1,81 @@
+"""
+Shared fixtures: small synthetic datasets in the layout of the published files.
+"""
+
+import datetime
+import random
+from typing import Callable
+
+import polars as pl
+import pytest
+
+from ctrace.constants import *
+
+_countries = ["USA", "FRA", "CHN", "IND", "XAD"]
+_name_words = ["North", "South", "Coal", "Gas"]
+
+
+def fake_sources(
+    num_sources: int = 40,
+    gas: str = CO2,
+    year: int = 2023,
+    seed: int = 0,
+    first_id: int = 0,
+) -> pl.DataFrame:
+    """
+    The monthly records of `num_sources` sources of one gas and one year, with
+    all the columns of the source files (see `all_columns`).
+    """
+    rnd = random.Random(seed)
+    rows: dict = {c: [] for c in all_columns}
+    for src in range(first_id, first_id + num_sources):
+        for month in range(1, 13):
+            row = dict.fromkeys(all_columns)
+            row[SOURCE_ID] = src
+            row[SOURCE_NAME] = f"Plant {src} {_name_words[src % 4]}"
+            row[ISO3_COUNTRY] = _countries[src % 5]
+            row[SECTOR] = SECTORS[src % 6]
+            row[SUBSECTOR] = SUBSECTORS[src % 6]
+            row[START_TIME] = datetime.datetime(
+                year, month, 1, tzinfo=datetime.timezone.utc
+            )
+            row[END_TIME] = datetime.datetime(
+                year, month, 28, tzinfo=datetime.timezone.utc
+            )
+            row[TEMPORAL_GRANULARITY] = "month"
+            row[GAS] = gas
+            row[EMISSIONS_QUANTITY] = rnd.random() * 1000 * (1 + src % 7)
+            row[ACTIVITY] = rnd.random()
+            row[CAPACITY_FACTOR] = rnd.random()
+            row[LAT] = rnd.uniform(-60, 70)
+            row[LON] = rnd.uniform(-180, 180)
+            row[OTHER1] = "x"
+            for c in all_columns:
+                rows[c].append(row[c])
+    dt = pl.Datetime("ms", "UTC")
+    df = pl.DataFrame(
+        rows,
+        schema_overrides={
+            SOURCE_ID: pl.UInt64,
+            START_TIME: dt,
+            END_TIME: dt,
+            CREATED_DATE: dt,
+            MODIFIED_DATE: dt,
+            EMISSIONS_FACTOR: pl.Float64,
+            CAPACITY: pl.Float64,
+        },
+    )
+    levels = ["very high", "high", "medium", "low", "very low"]
+    return df.with_columns(
+        [pl.lit("medium").alias("conf_" + c) for c in confidence_columns]
+    ).with_columns(
+        pl.Series(
+            "conf_" + EMISSIONS_QUANTITY, [levels[i % 5] for i in range(df.height)]
+        )
+    )
+
+
+@pytest.fixture(scope="session")
+def make_sources() -> Callable[..., pl.DataFrame]:
+    """The `fake_sources` function."""
+    return fake_sources
@@ -0,0 +1,198 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from ctrace import cache
+
+_old = "v3-2023"
+_new = cache._current_version
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv(cache.CACHE_DIR_ENV, str(tmp_path / "cache"))
+    monkeypatch.delenv(cache.MAX_SIZE_ENV, raising=False)
+    return tmp_path / "cache"
+
+
+def _write(p: Path, size: int, age: float) -> Path:
+    p.parent.mkdir(parents=True, exist_ok=True)
+    p.write_bytes(b"x" * size)
+    t = time.time() - age
+    os.utime(p, (t, t))
+    return p
+
+
+def test_prune(cache_dir):
+    hub = cache.kind_dir(cache.HUB)
+    archives = cache.kind_dir(cache.ARCHIVE)
+    files = {
+        "old_recent": _write(archives / _old / "co2.zip", 100, age=10),
+        "old_unused": _write(hub / f"{_old}/a_{_old}_2022_co2.parquet", 100, age=50),
+        "new_unused": _write(hub / f"{_new}/a_{_new}_2022_co2.parquet", 100, age=40),
+        "new_recent": _write(hub / f"{_new}/a_{_new}_2023_co2.parquet", 100, age=20),
+        "no_version": _write(archives / "other.zip", 100, age=30),
+    }
+    # A block directory of a remote file counts as a single entry.
+    blocks = cache.kind_dir(cache.BLOCKS) / "abc"
+    _write(blocks / "0", 30, age=5)
+    _write(blocks / "1", 20, age=5)
+    (blocks / "url").write_text(f"https://host/{_new}/file.parquet")
+    es = {e.path: e for e in cache.entries()}
+    assert es[blocks].size == 50 + len((blocks / "url").read_text())
+    assert {e.version for e in es.values()} == {_old, _new, None}
+
+    total = sum(e.size for e in es.values())
+    # The old versions first, then the least recently used.
+    assert [e.path for e in cache.prune(max_size=total - 200, dry_run=True)] == [
+        files["old_unused"],
+        files["old_recent"],
+    ]
+    evicted = cache.prune(max_size=total - 250)
+    assert [e.path for e in evicted] == [
+        files["old_unused"],
+        files["old_recent"],
+        files["new_unused"],
+    ]
+    assert all(not e.path.exists() for e in evicted)
+    # A file in use is not evicted.
+    with cache.lock(files["new_recent"]):
+        assert [e.path for e in cache.prune(keep_versions=[_old])] == [blocks]
+    assert [e.path for e in cache.prune(keep_versions=[_old])] == [files["new_recent"]]
+    assert files["no_version"].exists()
+
+
+def test_auto_prune(cache_dir, monkeypatch):
+    monkeypatch.setenv(cache.MAX_SIZE_ENV, "1K")
+    archives = cache.kind_dir(cache.ARCHIVE)
+    _write(archives / _old / "a.zip", 1000, age=10)
+
+    class Pooch:
+        abspath = archives / _new
+
+        def fetch(self, name: str) -> str:
+            return str(_write(self.abspath / name, 500, age=0))
+
+    assert cache.fetch_archive(Pooch(), "b.zip").exists()
+    assert not (archives / _old / "a.zip").exists()
+
+
+def test_fetch_archive_once(cache_dir):
+    calls = []
+
+    class Pooch:
+        abspath = cache.kind_dir(cache.ARCHIVE) / _new
+
+        def fetch(self, name: str) -> str:
+            # Like pooch: the file is downloaded if it does not exist.
+            p = self.abspath / name
+            if not p.exists():
+                calls.append(name)
+                time.sleep(0.05)
+                _write(p, 10, age=0)
+            return str(p)
+
+    threads = [
+        threading.Thread(target=cache.fetch_archive, args=(Pooch(), "co2.zip"))
+        for _ in range(8)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert calls == ["co2.zip"]
+
+
+def test_lock_across_processes(cache_dir):
+    p = cache_dir / "file"
+    code = (
+        "import sys, time; from pathlib import Path; from ctrace import cache\n"
+        "with cache.lock(Path(sys.argv[1])):\n"
+        "    print('locked', flush=True); time.sleep(1)\n"
+    )
+    env = dict(os.environ, PYTHONPATH=str(Path(__file__).parents[1] / "src"))
+    proc = subprocess.Popen(  # noqa: S603
+        [sys.executable, "-c", code, str(p)], env=env, stdout=subprocess.PIPE, text=True
+    )
+    try:
+        assert proc.stdout is not None and proc.stdout.readline() == "locked\n"
+        with cache.lock(p, blocking=False) as acquired:
+            assert not acquired
+        with cache.lock(p) as acquired:
+            assert acquired
+    finally:
+        proc.wait()
+    assert proc.returncode == 0
+
+
+def test_parse_size():
+    assert cache.parse_size("512") == 512
+    assert cache.parse_size("1.5K") == 1536
+    assert cache.parse_size("50G") == 50 << 30
+    assert cache.parse_size("2tb") == 2 << 40
+
+
+@pytest.fixture
+def hub(monkeypatch):
+    """A fake hub: the names of the files and their content, and the downloads."""
+    files = {f"{_new}/climate_trace-sources_{_new}_2023_co2.parquet": b"a"}
+    downloads = []
+
+    def download(filename: str, force: bool = False) -> Path:
+        downloads.append(filename)
+        p = cache.kind_dir(cache.HUB) / filename
+        if not p.exists() or p.read_bytes() != files[filename]:
+            # Like the hub: written next to the file, then moved in place.
+            p.parent.mkdir(parents=True, exist_ok=True)
+            tmp_p = p.with_name(p.name + ".incomplete")
+            tmp_p.write_bytes(files[filename])
+            os.replace(tmp_p, p)
+        return p
+
+    monkeypatch.setattr(cache, "_download_hub", download)
+    return (files, downloads)
+
+
+def test_manifest_offline(cache_dir, hub):
+    (files, downloads) = hub
+    [name] = files
+    assert cache.resolve(name) is None
+    p = cache.fetch_hub(name)
+    assert p.read_bytes() == b"a"
+    assert cache.read_manifest()[name] == {
+        "path": f"hub/{name}",
+        "version": _new,
+        "year": 2023,
+        "gas": "co2",
+    }
+    # Resolved from the manifest, without any download.
+    assert cache.fetch_hub(name) == p
+    assert cache.resolve(name) == p
+    assert downloads == [name]
+    # The updates are only fetched on request.
+    files[name] = b"bb"
+    assert cache.fetch_hub(name).read_bytes() == b"a"
+    assert cache.refresh() == [name]
+    assert cache.fetch_hub(name).read_bytes() == b"bb"
+    assert cache.refresh() == []
+    assert len(downloads) == 3
+
+
+def test_manifest_existing_and_pruned(cache_dir, hub):
+    (files, downloads) = hub
+    [name] = files
+    # A file downloaded before the manifest existed.
+    _write(cache.kind_dir(cache.HUB) / name, 1, age=0)
+    assert cache.fetch_hub(name) == cache.kind_dir(cache.HUB) / name
+    assert name in cache.read_manifest()
+    assert downloads == []
+    # The evicted files are removed from the manifest.
+    assert len(cache.prune(max_size=0)) == 1
+    assert cache.read_manifest() == {}
+    cache.fetch_hub(name)
+    assert downloads == [name]
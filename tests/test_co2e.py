@@ -0,0 +1,80 @@
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+
+from ctrace import co2e
+from ctrace.constants import *
+from ctrace.data import read_source_emissions, write_source_file
+
+# The sources of each base gas: the gases overlap on some of the sources only.
+_gases = {CO2: (0, 40), CH4: (10, 30), N2O: (20, 30)}
+_conf = "conf_" + EMISSIONS_QUANTITY
+
+
+@pytest.fixture(scope="module")
+def sources_dir(tmp_path_factory, make_sources):
+    p = tmp_path_factory.mktemp("co2e")
+    for seed, (gas, (first_id, num_sources)) in enumerate(_gases.items()):
+        df = make_sources(num_sources, gas=gas, seed=seed, first_id=first_id)
+        write_source_file(df.lazy(), gas, 2023, p)
+    return p
+
+
+def _expected(df: pl.DataFrame, gas: Gas) -> pl.DataFrame:
+    """The derived emissions, from a pivot of the base gases."""
+    wide = df.pivot(
+        on=GAS, index=co2e.source_keys, values=EMISSIONS_QUANTITY
+    ).with_columns(C(list(_gases)).fill_null(0.0))
+    total = sum(C(g) * w for g, w in co2e.default_gwp[gas].items())
+    conf = df.group_by(co2e.source_keys).agg(C(_conf).max())
+    return (
+        wide.select(*co2e.source_keys, total.alias(EMISSIONS_QUANTITY))
+        .join(conf, on=co2e.source_keys)
+        .sort(by=co2e.source_keys)
+    )
+
+
+def test_read_sources(sources_dir):
+    base = read_source_emissions(list(_gases), 2023, sources_dir).collect()
+    df = co2e.read_sources([CO2E_100YR, CO2E_20YR], 2023, sources_dir).collect()
+    assert df.columns == base.columns
+    assert df.height == 2 * 50 * 12
+    assert df[EMISSIONS_FACTOR].null_count() == df.height
+    for gas in [CO2E_100YR, CO2E_20YR]:
+        res = (
+            df.filter(c_gas == gas)
+            .select(*co2e.source_keys, EMISSIONS_QUANTITY, _conf)
+            .sort(by=co2e.source_keys)
+        )
+        assert_frame_equal(res, _expected(base, gas), check_dtypes=False)
+    cols = [SOURCE_ID, START_TIME, EMISSIONS_QUANTITY]
+    res = co2e.read_sources([CO2, CO2E_20YR], 2023, sources_dir, columns=cols)
+    assert res.collect().height == 40 * 12 + 50 * 12
+
+
+def test_check_co2e(sources_dir):
+    base = read_source_emissions(list(_gases), 2023, sources_dir).collect()
+    published = _expected(base, CO2E_100YR).with_columns(
+        pl.when(C(SOURCE_ID) == 25)
+        .then(c_emissions_quantity * 2)
+        .otherwise(c_emissions_quantity)
+        .alias(EMISSIONS_QUANTITY)
+    )
+    # Source 3 is missing from the published emissions.
+    published = published.filter(C(SOURCE_ID) != 3).with_columns(
+        pl.lit(CO2E_100YR).alias(GAS)
+    )
+    cols = co2e.source_keys + [GAS, EMISSIONS_QUANTITY]
+    df = pl.concat(
+        [base.select(cols).with_columns(c_gas.cast(pl.String)), published.select(cols)]
+    )
+    res = co2e.check_co2e(df, co2e.source_keys)
+    assert res.height == 24
+    assert res.filter(C(co2e.PUBLISHED_EMISSIONS).is_null())[
+        SOURCE_ID
+    ].unique().to_list() == [3]
+    gaps = res.filter(C(SOURCE_ID) == 25)
+    assert gaps.height == 12
+    assert_frame_equal(
+        gaps.select(co2e.REL_GAP), pl.DataFrame({co2e.REL_GAP: [-0.5] * 12})
+    )
@@ -0,0 +1,81 @@
+import polars as pl
+import pyarrow.parquet
+import pytest
+
+from ctrace import dataset_catalog
+from ctrace.constants import *
+from ctrace.data import (
+    WriterConfig,
+    _filters_expr,
+    _source_fname,
+    _source_path,
+    read_source_emissions,
+    write_source_file,
+)
+
+_years = [2022, 2023]
+_gases = [CO2, CH4]
+
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory, make_sources):
+    p = tmp_path_factory.mktemp("catalog")
+    config = WriterConfig(row_group_size=100)
+    for year in _years:
+        for k, gas in enumerate(_gases):
+            # CH4 has no record in the waste subsector in 2022.
+            df = make_sources(num_sources=40 - 10 * k, gas=gas, year=year, seed=year)
+            if (year, gas) == (2022, CH4):
+                df = df.filter(C(SUBSECTOR) != SUBSECTORS[5])
+            write_source_file(df.lazy(), gas, year, p, config=config)
+    return p
+
+
+@pytest.fixture(scope="module", params=["files", "dataset"])
+def cat(request, dataset):
+    if request.param == "dataset":
+        dataset_catalog.build_catalog(dataset)
+    return dataset_catalog.catalog(dataset)
+
+
+def test_counts(dataset, cat):
+    df = read_source_emissions(_gases, _years, dataset).collect()
+    assert cat.count() == df.height
+    assert (
+        cat.count(CH4, 2023)
+        == df.filter((C(GAS) == CH4) & (C(START_TIME).dt.year() == 2023)).height
+    )
+    subsector = SUBSECTORS[2]
+    expected = df.filter(C(SUBSECTOR) == subsector)
+    assert cat.count(subsector=subsector) == expected.height
+    assert cat.total_emissions(subsector=[subsector]) == pytest.approx(
+        expected[EMISSIONS_QUANTITY].sum()
+    )
+    assert not cat.exists(CH4, 2022, SUBSECTORS[5])
+    assert cat.exists(CH4, 2023, SUBSECTORS[5])
+    assert cat.files[dataset_catalog.NUM_ROWS].sum() == df.height
+    by_year = dict(cat.subsectors_by_year().iter_rows())
+    assert len(by_year[2023]) == 6
+
+
+def test_plan(dataset, cat):
+    filters = [(SUBSECTOR, "==", SUBSECTORS[1]), (SOURCE_ID, "<", 20)]
+    plan = cat.plan(_gases, _years, filters)
+    planned = set(
+        plan.select(dataset_catalog.YEAR, C(GAS).cast(pl.String), "row_group").rows()
+    )
+    # Every row group with a matching record is planned, and the others are not
+    # all planned.
+    total = 0
+    for year in _years:
+        for gas in _gases:
+            pq_file = pyarrow.parquet.ParquetFile(
+                _source_path(_source_fname, year, gas, dataset)
+            )
+            total += pq_file.num_row_groups
+            for rg in range(pq_file.num_row_groups):
+                df = pl.from_arrow(pq_file.read_row_group(rg))
+                if df.filter(_filters_expr(filters)).height > 0:
+                    assert (year, gas, rg) in planned
+    assert 0 < len(planned) < total
+    assert plan[dataset_catalog.NUM_ROWS].sum() < cat.count()
@@ -0,0 +1,99 @@
+import polars as pl
+from polars.testing import assert_frame_equal
+
+from ctrace import diff
+from ctrace.constants import *
+from ctrace.data import version, write_source_file
+
+
+def _expected(old: pl.DataFrame, new: pl.DataFrame, keys: list) -> pl.DataFrame:
+    """The changes from a join of both snapshots, compared column by column."""
+    values = [c for c in old.columns if c not in keys and c not in text_columns]
+    joined = old.with_columns(pl.lit(True).alias("_old")).join(
+        new.with_columns(pl.lit(True).alias("_new")),
+        on=keys,
+        how="full",
+        coalesce=True,
+        suffix="_new",
+    )
+    changed = pl.any_horizontal([C(c).ne_missing(C(c + "_new")) for c in values])
+    return (
+        joined.with_columns(
+            pl.when(C("_new").is_null())
+            .then(pl.lit(diff.REMOVED))
+            .when(C("_old").is_null())
+            .then(pl.lit(diff.ADDED))
+            .when(changed)
+            .then(pl.lit(diff.CHANGED))
+            .alias(diff.CHANGE),
+            C(EMISSIONS_QUANTITY).alias(diff.OLD_EMISSIONS),
+            C(EMISSIONS_QUANTITY + "_new").alias(diff.NEW_EMISSIONS),
+        )
+        .filter(C(diff.CHANGE).is_not_null())
+        .select(*keys, diff.CHANGE, diff.OLD_EMISSIONS, diff.NEW_EMISSIONS)
+        .sort(by=keys)
+    )
+
+
+def test_diff_sources(tmp_path, make_sources):
+    old = make_sources(num_sources=50)
+    new = (
+        pl.concat([old, make_sources(num_sources=3, first_id=100).select(old.columns)])
+        .filter(C(SOURCE_ID) != 7)
+        .with_columns(
+            pl.when((C(SOURCE_ID) == 3) & (C(START_TIME).dt.month() == 2))
+            .then(C(EMISSIONS_QUANTITY) + 1)
+            .otherwise(C(EMISSIONS_QUANTITY))
+            .alias(EMISSIONS_QUANTITY),
+            # A change in another column.
+            pl.when(C(SOURCE_ID) == 4).then(0.5).otherwise(C(ACTIVITY)).alias(ACTIVITY),
+            # The text columns are not compared.
+            pl.when(C(SOURCE_ID) == 5)
+            .then(pl.lit("y"))
+            .otherwise(C(OTHER1))
+            .alias(OTHER1),
+        )
+    )
+    write_source_file(old.lazy(), CO2, 2023, tmp_path / "old")
+    write_source_file(new.lazy(), CO2, 2023, tmp_path / "new")
+    res = diff.diff_sources(
+        version, version, CO2, 2023, tmp_path / "old", tmp_path / "new"
+    )
+    expected = _expected(old, new, diff.source_keys)
+    assert_frame_equal(
+        res.changes.with_columns(C(GAS).cast(pl.String)).sort(by=diff.source_keys),
+        expected,
+    )
+    counts = dict(res.summary.select(diff.CHANGE, "len").iter_rows())
+    assert counts == {diff.ADDED: 3 * 12, diff.REMOVED: 12, diff.CHANGED: 1 + 12}
+    rows = res.rows(
+        pl.scan_parquet(next((tmp_path / "new").rglob("*.parquet"))), diff.ADDED
+    )
+    assert sorted(rows.select(SOURCE_ID).unique().collect().to_series()) == [
+        100,
+        101,
+        102,
+    ]
+
+
+def test_diff_countries(tmp_path, make_sources):
+    keys = diff.country_keys
+    old = (
+        make_sources(num_sources=30)
+        .group_by(keys)
+        .agg(C(EMISSIONS_QUANTITY).sum())
+        .with_columns(C(GAS).cast(pl.String))
+    )
+    new = old.filter(C(ISO3_COUNTRY) != "USA").with_columns(
+        pl.when(C(ISO3_COUNTRY) == "FRA")
+        .then(C(EMISSIONS_QUANTITY) * 2)
+        .otherwise(C(EMISSIONS_QUANTITY))
+        .alias(EMISSIONS_QUANTITY)
+    )
+    old.write_parquet(tmp_path / "old.parquet")
+    new.write_parquet(tmp_path / "new.parquet")
+    res = diff.diff_countries(tmp_path / "old.parquet", tmp_path / "new.parquet")
+    counts = dict(res.summary.select(diff.CHANGE, "len").iter_rows())
+    assert counts == {diff.REMOVED: 6 * 12, diff.CHANGED: 6 * 12}
+    changed = res.changes.filter(C(diff.CHANGE) == diff.CHANGED)
+    assert (changed[diff.NEW_EMISSIONS] == 2 * changed[diff.OLD_EMISSIONS]).all()
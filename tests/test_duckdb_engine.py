@@ -0,0 +1,104 @@
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+
+from ctrace.constants import *
+from ctrace.data import read_country_emissions, read_source_emissions, write_source_file
+
+duckdb = pytest.importorskip("duckdb")
+from ctrace import duckdb_engine  # noqa: E402
+
+
+def _strings(df: pl.DataFrame) -> pl.DataFrame:
+    """
+    The enumerations as strings and the times in UTC, as their types differ
+    between the engines.
+    """
+    return df.with_columns(
+        [
+            C(c).cast(pl.String)
+            for c, t in df.schema.items()
+            if isinstance(t, (pl.Enum, pl.Categorical))
+        ]
+        + [
+            C(c).dt.convert_time_zone("UTC").cast(pl.Datetime("us", "UTC"))
+            for c, t in df.schema.items()
+            if isinstance(t, pl.Datetime)
+        ]
+    )
+
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory, make_sources):
+    p = tmp_path_factory.mktemp("duckdb")
+    for year in [2022, 2023]:
+        df = make_sources(num_sources=40, year=year, seed=year)
+        write_source_file(df.lazy(), CO2, year, p)
+    return p
+
+
+@pytest.fixture(scope="module")
+def con(tmp_path_factory):
+    return duckdb_engine.connect(
+        memory_limit="500MB", temp_directory=tmp_path_factory.mktemp("spill"), threads=1
+    )
+
+
+def test_read_source_emissions(dataset, con):
+    columns = [SOURCE_ID, START_TIME, SUBSECTOR, GAS, SOURCE_NAME, EMISSIONS_QUANTITY]
+    expected = read_source_emissions(CO2, [2022, 2023], dataset, columns).collect()
+    rel = read_source_emissions(
+        CO2, [2022, 2023], dataset, columns, engine="duckdb", con=con
+    )
+    assert rel.columns == columns
+    res = rel.order("year(start_time), source_id, start_time").pl()
+    assert_frame_equal(
+        _strings(res), _strings(expected), check_dtypes=False, check_row_order=False
+    )
+    # The same aggregation in SQL and with Polars.
+    agg = con.sql(
+        "SELECT subsector::VARCHAR AS subsector, sum(emissions_quantity) AS total "
+        "FROM rel GROUP BY ALL ORDER BY subsector"
+    ).pl()
+    expected_agg = (
+        expected.group_by(C(SUBSECTOR).cast(pl.String))
+        .agg(C(EMISSIONS_QUANTITY).sum().alias("total"))
+        .sort(by=SUBSECTOR)
+    )
+    assert_frame_equal(agg, expected_agg)
+
+
+def test_read_country_emissions(tmp_path, make_sources, con):
+    df = (
+        pl.concat([make_sources(num_sources=10, gas=g) for g in [CO2, CH4, "bogus"]])
+        .group_by(ISO3_COUNTRY, SECTOR, SUBSECTOR, GAS, START_TIME, END_TIME)
+        .agg(C(EMISSIONS_QUANTITY).sum())
+        .with_columns(pl.lit("month").alias(TEMPORAL_GRANULARITY))
+    )
+    df.write_parquet(tmp_path / "countries.parquet")
+    expected = read_country_emissions(
+        [CO2, CH4], parquet_path=tmp_path / "countries.parquet"
+    )
+    rel = read_country_emissions(
+        [CO2, CH4],
+        parquet_path=tmp_path / "countries.parquet",
+        engine="duckdb",
+        con=con,
+    )
+    assert rel.types[rel.columns.index(GAS)].id == "enum"
+    assert_frame_equal(
+        _strings(rel.pl()),
+        _strings(expected),
+        check_dtypes=False,
+        check_row_order=False,
+    )
+
+
+def test_connect(con):
+    assert con.sql("SELECT current_setting('threads')").fetchone() == (1,)
+    assert con.sql("SELECT current_setting('memory_limit')").fetchone() == (
+        "476.8 MiB",
+    )
+    assert con.sql("SELECT 'low'::confidence_level_enum").fetchone() == ("low",)
+    with pytest.raises(duckdb.ConversionException):
+        con.sql("SELECT 'bad'::confidence_level_enum").fetchone()
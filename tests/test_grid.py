@@ -0,0 +1,31 @@
+import numpy as np
+import polars as pl
+
+from ctrace import grid
+from ctrace.constants import *
+from ctrace.data import write_source_file
+
+
+def _expected(df: pl.DataFrame, resolution: float, by_sector: bool) -> np.ndarray:
+    n_lat = int(180 / resolution)
+    n_lon = int(360 / resolution)
+    layers = list(SECTORS) if by_sector else [grid.TOTAL]
+    values = np.zeros((len(layers), n_lat, n_lon))
+    for row in df.iter_rows(named=True):
+        k = layers.index(row[SECTOR]) if by_sector else 0
+        i = min(int((row[LAT] + 90) // resolution), n_lat - 1)
+        j = min(int((row[LON] + 180) // resolution), n_lon - 1)
+        values[k, i, j] += row[EMISSIONS_QUANTITY]
+    return values
+
+
+def test_grid_emissions(tmp_path, make_sources):
+    df = make_sources(num_sources=300)
+    write_source_file(df.lazy(), CO2, 2023, tmp_path)
+    for by_sector in [False, True]:
+        # Small batches: the cells of the sources are summed over many batches.
+        g = grid.grid_emissions(
+            CO2, 2023, tmp_path, resolution=10.0, by_sector=by_sector, max_rows=100
+        )
+        np.testing.assert_allclose(g.values, _expected(df, 10.0, by_sector))
+    assert np.isclose(g.values.sum(), df[EMISSIONS_QUANTITY].sum())
@@ -0,0 +1,31 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import ctrace
+from ctrace import enums
+
+
+def test_star_import():
+    ns: dict = {}
+    exec("from ctrace import *", ns)  # noqa: S102
+    assert set(ctrace.__all__) <= set(ns)
+    assert ns["read_source_emissions"] is ctrace.data.read_source_emissions
+    assert ns["gas_enum"] is enums.gas_enum
+    public_enums = {n for n in dir(enums) if not n.startswith("_")}
+    modules = {"Dict", "List", "Sequence", "sys"}
+    assert public_enums - modules <= set(ctrace.__all__)
+
+
+def test_lazy_import():
+    code = "import sys, ctrace; print('ctrace.data' in sys.modules)"
+    env = dict(os.environ, PYTHONPATH=str(Path(__file__).parents[1] / "src"))
+    out = subprocess.run(  # noqa: S603
+        [sys.executable, "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+        env=env,
+    )
+    assert out.stdout.strip() == "False"
@@ -0,0 +1,68 @@
+import random
+
+import numpy as np
+import polars as pl
+import pytest
+
+from ctrace import name_index
+from ctrace.constants import *
+from ctrace.data import write_source_file
+
+
+@pytest.fixture(scope="module")
+def index_dir(tmp_path_factory, make_sources):
+    p = tmp_path_factory.mktemp("names")
+    write_source_file(make_sources(num_sources=40).lazy(), CO2, 2023, p)
+    name_index.build_name_index(p)
+    return p
+
+
+def _osa(a: str, b: str) -> int:
+    """The edit distance with transpositions, one cell at a time."""
+    d = [
+        [i + j if i * j == 0 else 0 for j in range(len(b) + 1)]
+        for i in range(len(a) + 1)
+    ]
+    for i in range(1, len(a) + 1):
+        for j in range(1, len(b) + 1):
+            d[i][j] = min(
+                d[i - 1][j] + 1,
+                d[i][j - 1] + 1,
+                d[i - 1][j - 1] + (a[i - 1] != b[j - 1]),
+            )
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                d[i][j] = min(d[i][j], d[i - 2][j - 2] + 1)
+    return d[len(a)][len(b)]
+
+
+def test_edit_distances():
+    rnd = random.Random(0)
+    for _ in range(200):
+        a = "".join(rnd.choices("abc", k=rnd.randint(1, 7)))
+        length = rnd.randint(1, 7)
+        words = ["".join(rnd.choices("abc", k=length)) for _ in range(30)]
+        codes = np.array([[ord(c) for c in w] for w in words], dtype=np.uint32)
+        max_distance = rnd.randint(0, 4)
+        res = name_index._edit_distances(a, codes, max_distance)
+        expected = [min(_osa(a, w), max_distance + 1) for w in words]
+        assert res.tolist() == expected
+
+
+def test_search(index_dir):
+    res = name_index.search_sources("plant 7", index_dir, mode="token")
+    assert res[SOURCE_ID].to_list() == [7]
+    res = name_index.search_sources("pla nor", index_dir, limit=None)
+    assert sorted(res[SOURCE_ID].to_list()) == list(range(0, 40, 4))
+    # A transposition and a missing letter.
+    res = name_index.search_sources("Plnat Nrth", index_dir, mode="fuzzy", limit=None)
+    assert sorted(res[SOURCE_ID].to_list()) == list(range(0, 40, 4))
+    assert name_index.search_sources("plnat", index_dir, mode="token").is_empty()
+    res = name_index.search_sources("coal", index_dir, iso3_country="FRA")
+    assert res[SOURCE_ID].to_list() == [6, 26]
+
+
+def test_read_sources_by_id(index_dir):
+    df = name_index.read_sources_by_id([3, 12], CO2, 2023, index_dir)
+    assert df.group_by(SOURCE_ID).len().sort(by=SOURCE_ID).rows() == [(3, 12), (12, 12)]
+    assert name_index.read_sources_by_id([999], CO2, 2023, index_dir).height == 0
+    assert isinstance(df, pl.DataFrame)
@@ -0,0 +1,53 @@
+import os
+import threading
+import warnings
+
+from ctrace import profiling
+from ctrace.constants import *
+from ctrace.data import WriterConfig, write_source_file
+
+
+def test_profile_source_query(tmp_path, make_sources):
+    config = WriterConfig(row_group_size=120)
+    write_source_file(
+        make_sources(num_sources=60).lazy(), CO2, 2023, tmp_path, config=config
+    )
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", DeprecationWarning)
+        (df, profile) = profiling.profile_source_query(
+            CO2,
+            2023,
+            tmp_path,
+            columns=[SOURCE_ID, SUBSECTOR, EMISSIONS_QUANTITY],
+            filters=[(SUBSECTOR, "==", SUBSECTORS[0])],
+        )
+    assert df.height == 10 * 12
+    assert profile.num_rows == df.height
+    assert len(profile.files) == 1
+    [scan] = profile.files
+    assert scan.num_row_groups == 6
+    # The records are sorted by subsector: only one row group may match.
+    assert scan.estimated_row_groups_skipped == 5
+    assert profile.bytes_read == scan.bytes_read > 0
+    # The row groups that Polars actually read.
+    [(read, total)] = profile.row_groups_read
+    assert total == 6 and 1 <= read <= 6
+    d = profile.to_dict()
+    assert d["files"][0]["estimated_row_groups_skipped"] == 5
+    assert d["row_groups_read"] == [(read, total)]
+
+
+def test_captured_stderr_is_written_back(capfd):
+    def other_thread() -> None:
+        os.write(2, b"from another thread\n")
+
+    # Polars writes its messages to the file descriptor directly.
+    with profiling._captured_stderr() as log:
+        os.write(2, b"during the query\n")
+        t = threading.Thread(target=other_thread)
+        t.start()
+        t.join()
+    assert "during the query" in "".join(log)
+    err = capfd.readouterr().err
+    assert "during the query" in err
+    assert "from another thread" in err
@@ -0,0 +1,55 @@
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+
+from ctrace import ranking
+from ctrace.constants import *
+from ctrace.data import WriterConfig, write_source_file
+
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory, make_sources):
+    p = tmp_path_factory.mktemp("ranking")
+    df = make_sources(num_sources=100)
+    # Many row groups, so that some of them are skipped.
+    write_source_file(df.lazy(), CO2, 2023, p, config=WriterConfig(row_group_size=50))
+    return (p, df)
+
+
+@pytest.mark.parametrize(
+    "by, columns",
+    [
+        (None, None),
+        ([SECTOR], None),
+        ([SECTOR, ISO3_COUNTRY], [SOURCE_ID, START_TIME]),
+        # The emissions are not the last column of the records.
+        ([SECTOR], [EMISSIONS_QUANTITY, SOURCE_ID, ACTIVITY]),
+    ],
+)
+def test_top_emitters(dataset, by, columns):
+    (p, df) = dataset
+    res = ranking.top_emitters(CO2, 2023, k=7, by=by, columns=columns, p=p)
+    by = by or []
+    out_cols = list(
+        dict.fromkeys(by + (columns or [SOURCE_ID, START_TIME]) + [EMISSIONS_QUANTITY])
+    )
+    expected = (
+        df.sort(by=EMISSIONS_QUANTITY, descending=True)
+        .group_by(by or pl.lit(0), maintain_order=True)
+        .head(7)
+        .select(out_cols)
+        .sort(by=by + [EMISSIONS_QUANTITY], descending=[False] * len(by) + [True])
+    )
+    assert_frame_equal(
+        res.drop(ranking.RANK), expected, check_dtypes=False, check_column_order=True
+    )
+    assert res[ranking.RANK].max() == 7
+
+
+def test_top_emitters_filters(dataset):
+    (p, df) = dataset
+    res = ranking.top_emitters(
+        CO2, 2023, k=3, filters=[(ISO3_COUNTRY, "==", "FRA")], p=p
+    )
+    expected = df.filter(C(ISO3_COUNTRY) == "FRA").top_k(3, by=EMISSIONS_QUANTITY)
+    assert res[SOURCE_ID].to_list() == expected[SOURCE_ID].to_list()
@@ -0,0 +1,49 @@
+import polars as pl
+import pytest
+
+from ctrace import reconcile
+from ctrace.constants import *
+from ctrace.data import write_source_file
+
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory, make_sources):
+    p = tmp_path_factory.mktemp("reconcile")
+    dfs = {gas: make_sources(num_sources=30, gas=gas) for gas in [CO2, CO2E_100YR]}
+    for gas, df in dfs.items():
+        write_source_file(df.lazy(), gas, 2023, p)
+    # The country emissions are the sums of the sources, except for one country.
+    countries = (
+        pl.concat(dfs.values())
+        .group_by(ISO3_COUNTRY, SECTOR, SUBSECTOR, GAS, START_TIME, END_TIME)
+        .agg(C(EMISSIONS_QUANTITY).sum())
+        .with_columns(
+            pl.when(C(ISO3_COUNTRY) == "FRA")
+            .then(C(EMISSIONS_QUANTITY) * 2)
+            .otherwise(C(EMISSIONS_QUANTITY))
+            .alias(EMISSIONS_QUANTITY),
+            pl.lit("month").alias(TEMPORAL_GRANULARITY),
+        )
+    )
+    countries.write_parquet(p / "countries.parquet")
+    return p
+
+
+def test_reconcile(dataset):
+    res = reconcile.reconcile(
+        [CO2, CO2E_100YR], 2023, dataset, dataset / "countries.parquet"
+    )
+    assert res.gaps.height == 30 * 2 * 12
+    mismatches = res.mismatches()
+    assert set(mismatches[ISO3_COUNTRY].cast(pl.String)) == {"FRA"}
+    assert mismatches.height == 6 * 2 * 12
+    assert res.missing_co2e.is_empty()
+    excluded = res.excluded.sort(by=GAS)
+    assert excluded[ISO3_COUNTRY].cast(pl.String).to_list() == ["XAD"] * 2
+    assert excluded["len"].to_list() == [6 * 12] * 2
+
+
+def test_reconcile_co2e_only(dataset):
+    res = reconcile.reconcile(CO2E_100YR, 2023, dataset, dataset / "countries.parquet")
+    assert res.gaps.height == 30 * 12
+    assert res.missing_co2e.is_empty()
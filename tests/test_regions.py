@@ -0,0 +1,82 @@
+import numpy as np
+import polars as pl
+import pytest
+
+from ctrace import regions
+from ctrace.constants import *
+from ctrace.data import write_source_file
+from ctrace.regions import REGION_ID
+
+_square = [[(0, 0), (10, 0), (10, 10), (0, 10)]]
+# A triangle, with a square hole, that crosses many cells.
+_triangle = [[(20, 0), (40, 0), (30, 17)], [(28, 2), (32, 2), (32, 6), (28, 6)]]
+
+
+@pytest.fixture
+def index() -> regions.RegionIndex:
+    return regions.RegionIndex({"sq": _square, "tri": _triangle}, cell_size=1.0)
+
+
+def test_locate_interior_only():
+    index = regions.RegionIndex({"sq": _square})
+    assert index.locate([5.0], [5.0]).tolist() == [0]
+    assert index.locate([2.5, 7.5], [7.5, 2.5]).tolist() == [0, 0]
+
+
+def test_locate_outside_only(index):
+    assert index.locate([50.0], [50.0]).tolist() == [-1]
+    assert index.locate([50.0, -5.0, 0.5], [50.0, 5.0, 15.0]).tolist() == [-1] * 3
+
+
+def test_locate_empty(index):
+    assert index.locate([], []).tolist() == []
+
+
+def test_locate_boundary(index):
+    # In the square, in the hole, in the triangle, near its top, near its right
+    # edge, and without coordinates.
+    lat = [0.5, 5.0, 1.0, 16.0, 16.9, 1.0, np.nan]
+    lon = [9.5, 30.0, 30.0, 30.0, 31.0, 39.9, 5.0]
+    assert index.locate(lat, lon).tolist() == [0, -1, 1, 1, -1, -1, -1]
+
+
+def test_locate_matches_brute_force(index):
+    rng = np.random.default_rng(0)
+    lat = rng.uniform(-5, 20, 20_000)
+    lon = rng.uniform(-5, 45, 20_000)
+    res = index.locate(lat, lon, chunk_size=3_000)
+    # Even-odd test of every point against every ring.
+    expected = np.full(len(lat), -1)
+    for r, rings in enumerate([_square, _triangle]):
+        inside = np.zeros(len(lat), dtype=bool)
+        for ring in rings:
+            for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1], strict=True):
+                spans = (y1 > lat) != (y2 > lat)
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    x_cross = x1 + (lat - y1) * (x2 - x1) / (y2 - y1)
+                inside ^= spans & (lon < x_cross)
+        expected[inside] = r
+    np.testing.assert_array_equal(res, expected)
+
+
+def test_assign_regions_incremental(tmp_path, make_sources):
+    index = regions.RegionIndex({"sq": _square}, cell_size=1.0)
+    df = make_sources(num_sources=20).with_columns(
+        pl.lit(5.0).alias(LAT), pl.lit(5.0).alias(LON)
+    )
+    write_source_file(df.lazy(), CO2, 2023, tmp_path / "a")
+    res = regions.assign_regions(index, CO2, 2023, tmp_path / "a", cache_dir=tmp_path)
+    assert res[REGION_ID].cast(pl.String).to_list() == ["sq"] * 20
+    # A few new sources, all inside the interior cells, then all outside.
+    more = make_sources(num_sources=2, first_id=100).with_columns(
+        pl.lit(5.0).alias(LAT), pl.lit(5.0).alias(LON)
+    )
+    write_source_file(pl.concat([df, more]).lazy(), CO2, 2023, tmp_path / "b")
+    res = regions.assign_regions(index, CO2, 2023, tmp_path / "b")
+    assert res.height == 22 and res[REGION_ID].null_count() == 0
+    far = make_sources(num_sources=2, first_id=200).with_columns(
+        pl.lit(50.0).alias(LAT), pl.lit(50.0).alias(LON)
+    )
+    write_source_file(pl.concat([df, far]).lazy(), CO2, 2023, tmp_path / "c")
+    res = regions.assign_regions(index, CO2, 2023, tmp_path / "c")
+    assert res.filter(C(SOURCE_ID) >= 200)[REGION_ID].null_count() == 2
@@ -0,0 +1,136 @@
+import http.server
+import re
+import threading
+from pathlib import Path
+
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+
+from ctrace import remote
+from ctrace.constants import *
+from ctrace.data import _source_fname, read_source_emissions, version, write_source_file
+
+_range_re = re.compile(r"bytes=(\d+)-(\d+)?")
+
+
+class _RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the files of `root`, with support for the Range requests."""
+
+    root: Path
+    range_support = True
+
+    def do_HEAD(self) -> None:
+        self._serve(body=False)
+
+    def do_GET(self) -> None:
+        self._serve(body=True)
+
+    def _serve(self, body: bool) -> None:
+        path = self.root / self.path.lstrip("/")
+        if not path.is_file():
+            self.send_error(404)
+            return
+        data = path.read_bytes()
+        m = _range_re.fullmatch(self.headers.get("Range", ""))
+        if m and self.range_support:
+            start = int(m.group(1))
+            end = int(m.group(2)) if m.group(2) else len(data) - 1
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+            data = data[start : end + 1]
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def dataset(tmp_path, make_sources):
+    df = make_sources(num_sources=200)
+    write_source_file(df.lazy(), CO2, 2023, tmp_path / "data")
+    return tmp_path / "data"
+
+
+def _server(root: Path, range_support: bool = True):
+    handler = type(
+        "Handler", (_RangeHandler,), {"root": root, "range_support": range_support}
+    )
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def server(dataset):
+    server = _server(dataset)
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+def test_scan_remote_parquet(dataset, server, tmp_path):
+    name = _source_fname.format(version=version, year=2023, gas=CO2)
+    expected = pl.read_parquet(dataset / name)
+    df = remote.scan_remote_parquet(
+        f"{server}/{name}", cache_dir=tmp_path / "cache", block_size=4096
+    )
+    assert_frame_equal(df.collect(), expected)
+    res = df.filter(C(SOURCE_ID) == 7).select(SOURCE_ID, START_TIME).collect()
+    assert res.height == 12
+    assert remote.read_remote_parquet_schema(
+        f"{server}/{name}", cache_dir=tmp_path / "cache"
+    ) == list(expected.columns)
+
+
+def test_range_file_cache(dataset, server, tmp_path):
+    name = _source_fname.format(version=version, year=2023, gas=CO2)
+    data = (dataset / name).read_bytes()
+    f = remote.RangeFile(f"{server}/{name}", tmp_path / "cache", block_size=1000)
+    assert f.size == len(data)
+    assert f.read_at(1500, 1000) == data[1500:2500]
+    assert (f.num_requests, f.bytes_fetched) == (1, 2000)
+    # The cached blocks are not fetched again.
+    f.seek(-10, 2)
+    assert f.read() == data[-10:]
+    assert f.read_at(1000, 1000) == data[1000:2000]
+    assert f.num_requests == 2
+    f2 = remote.RangeFile(f"{server}/{name}", tmp_path / "cache", block_size=1000)
+    assert f2.read_at(1200, 500) == data[1200:1700]
+    assert f2.num_requests == 0
+
+
+def test_no_range_support(dataset, tmp_path):
+    server = _server(dataset, range_support=False)
+    name = _source_fname.format(version=version, year=2023, gas=CO2)
+    data = (dataset / name).read_bytes()
+    url = f"http://127.0.0.1:{server.server_address[1]}/{name}"
+    try:
+        f = remote.RangeFile(url, tmp_path / "cache", block_size=1000)
+        assert f.read_at(2500, 10) == data[2500:2510]
+        assert f.read_at(0, len(data)) == data
+        assert f.num_requests == 1
+    finally:
+        server.shutdown()
+
+
+def test_read_source_emissions_remote(dataset, server, tmp_path, monkeypatch):
+    monkeypatch.setattr(remote, "default_cache_dir", lambda: tmp_path / "cache")
+    columns = [SOURCE_ID, START_TIME, SOURCE_NAME, EMISSIONS_QUANTITY, OTHER1]
+    expected = read_source_emissions(CO2, 2023, dataset, columns=columns).collect()
+    df = read_source_emissions(CO2, 2023, server, columns=columns, remote=True)
+    res = df.collect()
+    assert_frame_equal(res, expected)
+    # The text columns of the companion file are aligned row by row.
+    names = res.select(
+        (C(SOURCE_NAME).str.split(" ").list.get(1) == C(SOURCE_ID).cast(pl.String))
+    )
+    assert names.to_series().all()
+    assert_frame_equal(
+        df.filter(C(SOURCE_ID) == 42).collect(),
+        expected.filter(C(SOURCE_ID) == 42),
+    )
@@ -0,0 +1,50 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+_probe = """
+import json, os
+import ctrace.data
+import polars as pl
+import pyarrow
+from ctrace import runtime
+print(json.dumps({
+    "polars_temp_dir": os.environ.get("POLARS_TEMP_DIR"),
+    "polars_threads": pl.thread_pool_size(),
+    "pyarrow_threads": pyarrow.cpu_count(),
+    "process_dir": str(runtime.process_dir()),
+}))
+"""
+
+
+def _run(env: dict) -> dict:
+    env = {
+        k: v
+        for k, v in os.environ.items()
+        if not k.startswith(("CTRACE_", "POLARS_", "OMP_"))
+    } | env
+    src = str(Path(__file__).parents[1] / "src")
+    env["PYTHONPATH"] = os.pathsep.join([src, env.get("PYTHONPATH", "")])
+    out = subprocess.run(  # noqa: S603
+        [sys.executable, "-c", _probe], env=env, capture_output=True, check=True
+    )
+    return json.loads(out.stdout)
+
+
+def test_environment_applied_on_import(tmp_path):
+    res = _run({"CTRACE_THREADS": "2", "CTRACE_SCRATCH_DIR": str(tmp_path)})
+    assert res["polars_threads"] == 2
+    assert res["pyarrow_threads"] == 2
+    process_dir = Path(res["process_dir"])
+    assert process_dir.parent == tmp_path
+    assert res["polars_temp_dir"] == str(process_dir / "polars")
+    # The directory of the process is removed on exit.
+    assert not process_dir.exists()
+
+
+def test_concurrent_processes_get_their_own_directory(tmp_path):
+    env = {"CTRACE_SCRATCH_DIR": str(tmp_path)}
+    dirs = {_run(env)["process_dir"] for _ in range(3)}
+    assert len(dirs) == 3
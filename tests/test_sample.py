@@ -0,0 +1,60 @@
+import math
+
+import polars as pl
+import pytest
+
+from ctrace import sample
+from ctrace.constants import *
+from ctrace.data import read_source_emissions, write_source_file
+
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory, make_sources):
+    p = tmp_path_factory.mktemp("sample")
+    df = make_sources(num_sources=600, seed=1)
+    write_source_file(df.lazy(), CO2, 2023, p, sample_rates=[0.05, 0.2])
+    return (p, df)
+
+
+@pytest.mark.parametrize("rate", [0.05, 0.2])
+def test_sample_sizes(dataset, rate):
+    (p, df) = dataset
+    res = read_source_emissions(CO2, 2023, p, approximate=rate).collect()
+    strata = res.group_by(sample.STRATUM).agg(
+        pl.len(), C(sample.STRATUM_SIZE).first(), C(sample.SAMPLE_SIZE).first()
+    )
+    for n, size, sample_size in strata.select(
+        "len", sample.STRATUM_SIZE, sample.SAMPLE_SIZE
+    ).rows():
+        assert (
+            n
+            == sample_size
+            == min(size, max(math.ceil(size * rate), sample.min_stratum_size))
+        )
+    assert strata[sample.STRATUM_SIZE].sum() == df.height
+    # The sampled records are records of the file.
+    keys = res.select(SOURCE_ID, START_TIME).join(
+        df.select(SOURCE_ID, START_TIME), on=[SOURCE_ID, START_TIME], how="anti"
+    )
+    assert keys.is_empty()
+
+
+def test_estimate(dataset):
+    (p, df) = dataset
+    res = sample.estimate(
+        read_source_emissions(CO2, 2023, p, approximate=0.2), by=[SECTOR]
+    )
+    expected = (
+        df.group_by(SECTOR)
+        .agg(
+            C(EMISSIONS_QUANTITY).sum().alias(sample.SUM), pl.len().alias(sample.COUNT)
+        )
+        .sort(by=SECTOR)
+    )
+    assert res[SECTOR].cast(pl.String).to_list() == expected[SECTOR].to_list()
+    # The counts of the strata are known exactly.
+    assert res[sample.COUNT].to_list() == pytest.approx(
+        expected[sample.COUNT].to_list()
+    )
+    gap = (res[sample.SUM] - expected[sample.SUM]).abs()
+    assert (gap <= 2 * res[sample.SUM + sample.ERROR_SUFFIX]).all()
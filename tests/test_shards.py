@@ -0,0 +1,157 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+import zipfile
+from pathlib import Path
+
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+
+from ctrace import shards
+from ctrace.constants import *
+from ctrace.data import read_source_emissions
+
+_gases = [CO2, CH4]
+_archives = ["power.zip", "waste.zip"]
+_members = ["a", "b", "c"]
+
+
+def _to_csv(df: pl.DataFrame) -> str:
+    return df.with_columns(
+        [
+            C(c).dt.strftime("%Y-%m-%d %H:%M:%S")
+            for c, t in df.schema.items()
+            if isinstance(t, pl.Datetime)
+        ]
+    ).write_csv()
+
+
+@pytest.fixture(scope="module")
+def archives(tmp_path_factory, make_sources):
+    """Small archives in the layout of the official ones, as <p>/<gas>/<archive>."""
+    root = tmp_path_factory.mktemp("archives")
+    k = 0
+    for gas in _gases:
+        for archive in _archives:
+            (root / gas).mkdir(exist_ok=True)
+            with zipfile.ZipFile(root / gas / archive, "w") as zf:
+                for m in _members:
+                    k += 1
+                    df = pl.concat(
+                        [
+                            make_sources(10, gas, year, seed=k, first_id=k * 1000)
+                            for year in [2022, 2023]
+                        ]
+                    )
+                    conf = df.select(
+                        START_TIME,
+                        END_TIME,
+                        CREATED_DATE,
+                        MODIFIED_DATE,
+                        ISO3_COUNTRY,
+                        SOURCE_ID,
+                        SECTOR,
+                        SUBSECTOR,
+                        GAS,
+                        *[C("conf_" + c).alias(c) for c in confidence_columns],
+                    )
+                    base = f"DATA/{archive[:-4]}/{m}_emissions_sources"
+                    sources = df.select(pl.exclude("^conf_.*$"))
+                    zf.writestr(base + ".csv", _to_csv(sources))
+                    zf.writestr(base + "_confidence.csv", _to_csv(conf))
+    return root
+
+
+def _work(job_dir: Path, archives: Path, lease_seconds: float) -> subprocess.Popen:
+    """A worker in its own process, like on another node."""
+    env = dict(os.environ)
+    src = str(Path(__file__).parents[1] / "src")
+    env["PYTHONPATH"] = os.pathsep.join([src, env.get("PYTHONPATH", "")])
+    cmd = [sys.executable, "-m", "ctrace.shards", "work", str(job_dir)]
+    cmd += ["--archives", str(archives), "--lease-seconds", str(lease_seconds)]
+    return subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL)  # noqa: S603
+
+
+def _dead_pid() -> int:
+    proc = subprocess.Popen([sys.executable, "-c", "pass"])
+    proc.wait()
+    return proc.pid
+
+
+def test_sharded_ingestion(tmp_path, archives):
+    job = shards.create_job(tmp_path / "job", archives, _gases, _archives)
+    assert len(job) == len(_gases) * len(_archives) * len(_members)
+    assert shards.read_job(tmp_path / "job") == job
+    assert len({s.id for s in job}) == len(job)
+    # A claim past its lease, and the claim of a process of this host that died.
+    claims_dir = tmp_path / "job" / "claims"
+    claims_dir.mkdir()
+    (claims_dir / job[0].id).write_text("other-host-1")
+    old = time.time() - 3600
+    os.utime(claims_dir / job[0].id, (old, old))
+    (claims_dir / job[1].id).write_text(f"{socket.gethostname()}-{_dead_pid()}")
+    # A live claim within its lease is left alone.
+    (claims_dir / job[2].id).write_text("other-host-2")
+    workers = [_work(tmp_path / "job", archives, 600) for _ in range(4)]
+    assert [w.wait(timeout=300) for w in workers] == [0] * 4
+    status = shards.job_status(tmp_path / "job")
+    states = [shards.DONE] * len(job)
+    states[2] = shards.CLAIMED
+    assert status[shards.STATE].to_list() == states
+    assert status[shards.WORKER][2] == "other-host-2"
+    # The lease of the last claim expires, and a worker of this process takes it.
+    assert shards.run_worker(tmp_path / "job", archives, lease_seconds=0) == [job[2].id]
+    assert (shards.job_status(tmp_path / "job")[shards.STATE] == shards.DONE).all()
+
+    # The same job with a single worker gives the same files.
+    shards.create_job(tmp_path / "job1", archives, _gases, _archives)
+    shards.run_worker(tmp_path / "job1", archives)
+    paths = shards.merge_shards(tmp_path / "job", tmp_path / "out")
+    paths1 = shards.merge_shards(tmp_path / "job1", tmp_path / "out1")
+    assert len(paths) == 2 * 2 * 2
+    for path, path1 in zip(paths, paths1, strict=True):
+        assert path.relative_to(tmp_path / "out") == path1.relative_to(
+            tmp_path / "out1"
+        )
+        assert path.read_bytes() == path1.read_bytes()
+    df = read_source_emissions(_gases, [2022, 2023], tmp_path / "out").collect()
+    assert df.height == len(job) * 2 * 10 * 12
+    assert df[SOURCE_ID].n_unique() == len(job) * 10
+    totals = (
+        df.group_by(C(GAS).cast(pl.String))
+        .agg(C(EMISSIONS_QUANTITY).sum())
+        .sort(by=GAS)
+    )
+    expected = (
+        pl.concat(
+            [
+                pl.read_parquet(shards._part_path(tmp_path / "job", s)).select(
+                    C(GAS).cast(pl.String), EMISSIONS_QUANTITY
+                )
+                for s in job
+            ]
+        )
+        .group_by(GAS)
+        .agg(C(EMISSIONS_QUANTITY).sum())
+        .sort(by=GAS)
+    )
+    assert_frame_equal(totals, expected)
+
+
+def test_failed_shards(tmp_path, archives):
+    job = shards.create_job(tmp_path / "job", archives, gas=CO2, archives=_archives)
+    broken = tmp_path / "broken"
+    (broken / CO2).mkdir(parents=True)
+    for archive in _archives:
+        with zipfile.ZipFile(broken / CO2 / archive, "w") as zf:
+            zf.writestr("README", "")
+    assert shards.run_worker(tmp_path / "job", broken) == []
+    assert (shards.job_status(tmp_path / "job")[shards.STATE] == shards.FAILED).all()
+    # The failed shards are only processed again on request.
+    assert shards.run_worker(tmp_path / "job", archives) == []
+    assert len(shards.run_worker(tmp_path / "job", archives, retry_failed=True)) == len(
+        job
+    )
@@ -0,0 +1,65 @@
+import polars as pl
+import pyarrow
+import pytest
+from polars.testing import assert_frame_equal
+
+from ctrace import stream
+from ctrace.constants import *
+from ctrace.data import (
+    WriterConfig,
+    _filters_expr,
+    read_source_emissions,
+    write_source_file,
+)
+
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory, make_sources):
+    p = tmp_path_factory.mktemp("stream")
+    config = WriterConfig(row_group_size=100)
+    for year in [2022, 2023]:
+        df = make_sources(num_sources=50, year=year, seed=year)
+        write_source_file(df.lazy(), CO2, year, p, config=config)
+    return p
+
+
+@pytest.mark.parametrize(
+    "columns, filters",
+    [
+        (None, None),
+        ([SOURCE_ID, START_TIME, EMISSIONS_QUANTITY], None),
+        (
+            [SOURCE_ID, SOURCE_NAME, SUBSECTOR, EMISSIONS_QUANTITY],
+            [(SUBSECTOR, "in", list(SUBSECTORS[1:3])), (SOURCE_ID, ">=", 10)],
+        ),
+    ],
+)
+def test_iter_source_batches(dataset, columns, filters):
+    expected = read_source_emissions(CO2, [2022, 2023], dataset, columns)
+    if filters:
+        expected = expected.filter(_filters_expr(filters))
+    dfs = list(
+        stream.iter_source_batches(
+            CO2,
+            [2022, 2023],
+            dataset,
+            columns,
+            filters,
+            max_rows=70,
+            output="polars",
+        )
+    )
+    assert all(0 < df.height <= 70 for df in dfs)
+    assert_frame_equal(pl.concat(dfs), expected.collect())
+
+
+def test_max_bytes(dataset):
+    batches = list(
+        stream.iter_source_batches(CO2, 2023, dataset, max_rows=1000, max_bytes=20_000)
+    )
+    assert all(isinstance(b, pyarrow.RecordBatch) for b in batches)
+    assert sum(b.num_rows for b in batches) == 50 * 12
+    assert max(b.nbytes for b in batches) <= 20_000 * 1.2
+    # The batches have the types of the frames of read_source_emissions.
+    schema = read_source_emissions(CO2, 2023, dataset).collect_schema()
+    assert pl.from_arrow(batches[0]).schema == schema
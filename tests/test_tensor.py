@@ -0,0 +1,88 @@
+import datetime
+
+import numpy as np
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+
+from ctrace.constants import *
+from ctrace.tensor import MONTH, country_tensor
+
+
+@pytest.fixture(scope="module")
+def countries(make_sources):
+    """Country emissions with two records in some months, and missing emissions."""
+    dfs = []
+    for seed, gas in enumerate([CO2, CH4]):
+        df = make_sources(num_sources=30, gas=gas, seed=seed)
+        df = df.with_columns(
+            (c_start_time + datetime.timedelta(days=14) * (C(SOURCE_ID) % 2)).alias(
+                START_TIME
+            ),
+            pl.when(C(SOURCE_ID) == 7)
+            .then(None)
+            .otherwise(c_emissions_quantity)
+            .alias(EMISSIONS_QUANTITY),
+        )
+        dfs.append(
+            df.select(ISO3_COUNTRY, SUBSECTOR, GAS, START_TIME, EMISSIONS_QUANTITY)
+        )
+    return pl.concat(dfs)
+
+
+def _expected(df: pl.DataFrame) -> pl.DataFrame:
+    return (
+        df.filter(c_emissions_quantity.is_not_null())
+        .group_by(
+            ISO3_COUNTRY,
+            SUBSECTOR,
+            GAS,
+            c_start_time.dt.truncate("1mo").alias(MONTH),
+        )
+        .agg(c_emissions_quantity.sum())
+    )
+
+
+def _sorted(df: pl.DataFrame) -> pl.DataFrame:
+    return df.with_columns(C(ISO3_COUNTRY, SUBSECTOR, GAS).cast(pl.String)).sort(
+        by=[ISO3_COUNTRY, SUBSECTOR, GAS, MONTH]
+    )
+
+
+def test_cells(countries):
+    t = country_tensor(countries)
+    expected = _expected(countries)
+    assert_frame_equal(_sorted(t.to_frame()), _sorted(expected), check_dtypes=False)
+    assert len(t.months) == 12
+    for row in expected.sample(20, seed=0).iter_rows(named=True):
+        value = t.get(
+            row[ISO3_COUNTRY], row[SUBSECTOR], row[GAS], row[MONTH].strftime("%Y-%m")
+        )
+        assert value == pytest.approx(row[EMISSIONS_QUANTITY])
+    # The only source of CHN in this subsector has missing emissions.
+    assert np.isnan(t.get("CHN", SUBSECTORS[1], CO2, "2023-03"))
+
+
+def test_sums(countries):
+    t = country_tensor(countries)
+    expected = _expected(countries)
+    by_country = (
+        expected.filter(c_gas == CO2)
+        .group_by(ISO3_COUNTRY)
+        .agg(c_emissions_quantity.sum())
+    )
+    res = t.sum([SUBSECTOR, MONTH], gas=CO2)
+    for iso3, value in by_country.iter_rows():
+        assert res[t.index(ISO3_COUNTRY, iso3)] == pytest.approx(value)
+    assert np.isnan(res[t.index(ISO3_COUNTRY, "DEU")])
+    total = t.sum([ISO3_COUNTRY, SUBSECTOR, MONTH], gas=CH4)
+    assert total == pytest.approx(
+        expected.filter(c_gas == CH4)[EMISSIONS_QUANTITY].sum()
+    )
+    (arr, kept) = t.select(iso3_country=["FRA", "USA"], gas=CO2, month="2023-05")
+    assert kept == [ISO3_COUNTRY, SUBSECTOR]
+    assert arr.shape == (2, len(t.names(SUBSECTOR)))
+    may = expected.filter(
+        (c_gas == CO2) & (C(MONTH).dt.month() == 5) & (C(ISO3_COUNTRY) == "USA")
+    )
+    assert np.nansum(arr[1]) == pytest.approx(may[EMISSIONS_QUANTITY].sum())
@@ -0,0 +1,38 @@
+import numpy as np
+import polars as pl
+
+from ctrace import timeseries
+from ctrace.constants import *
+from ctrace.data import write_source_file
+
+
+def test_write_timeseries_file(tmp_path, make_sources):
+    df = make_sources(num_sources=30)
+    # A month without emissions, and a month of a source without any record.
+    df = df.with_columns(
+        pl.when((C(SOURCE_ID) == 5) & (C(START_TIME).dt.month() == 3))
+        .then(None)
+        .otherwise(C(EMISSIONS_QUANTITY))
+        .alias(EMISSIONS_QUANTITY)
+    ).filter(~((C(SOURCE_ID) == 6) & (C(START_TIME).dt.month() == 4)))
+    write_source_file(df.lazy(), CO2, 2023, tmp_path)
+    timeseries.write_timeseries_file(CO2, 2023, tmp_path)
+    months = timeseries.timeseries_months(CO2, tmp_path)
+    assert months.tolist() == list(
+        np.arange(np.datetime64("2023-01"), np.datetime64("2024-01"))
+    )
+    ts = timeseries.read_source_timeseries(CO2, tmp_path).collect()
+    assert ts.height == 30
+    ts = ts.sort(by=SOURCE_ID)
+    values = timeseries.timeseries_values(ts)
+    assert values.shape == (30, 12)
+    expected = (
+        df.sort(by=[SOURCE_ID, START_TIME])[EMISSIONS_QUANTITY]
+        .fill_null(np.nan)
+        .to_numpy()
+    )
+    np.testing.assert_array_equal(np.isnan(values[5]), np.arange(12) == 2)
+    np.testing.assert_array_equal(np.isnan(values[6]), np.arange(12) == 3)
+    np.testing.assert_allclose(values[~np.isnan(values)], expected[~np.isnan(expected)])
+    activity = timeseries.timeseries_values(ts, ACTIVITY)
+    assert np.isnan(activity[6, 3]) and not np.isnan(activity[5, 2])
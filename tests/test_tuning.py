@@ -0,0 +1,25 @@
+from ctrace import tuning
+from ctrace.constants import *
+from ctrace.data import WriterConfig, read_source_emissions, write_source_file
+
+
+def test_sample_records(make_sources):
+    df = make_sources(num_sources=500)
+    sample = tuning._sample_records(df.lazy(), 1000, seed=0)
+    assert 800 < sample.height < 1200
+    assert sample.join(df, on=df.columns, how="anti").is_empty()
+    assert not tuning._sample_records(df.lazy(), 1000, seed=1).equals(sample)
+    assert tuning._sample_records(df.lazy(), 10_000, seed=0).equals(df)
+
+
+def test_tune(tmp_path, make_sources):
+    write_source_file(make_sources(num_sources=200).lazy(), CO2, 2023, tmp_path)
+    lf = read_source_emissions(CO2, 2023, tmp_path)
+    settings = {"compression_level": [1, 9], "row_group_size": [500]}
+    (config, report) = tuning.tune(
+        lf, CO2, 2023, sample_rows=1000, settings=settings, repeat=1
+    )
+    assert isinstance(config, WriterConfig)
+    assert report.height == 4
+    assert report[tuning.SCORE].is_sorted()
+    assert report.filter(C(tuning.CANDIDATE) == "base")[tuning.SCORE].item() > 0
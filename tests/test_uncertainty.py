@@ -0,0 +1,53 @@
+import numpy as np
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+
+from ctrace import uncertainty
+from ctrace.constants import *
+from ctrace.data import WriterConfig, read_source_emissions, write_source_file
+
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory, make_sources):
+    p = tmp_path_factory.mktemp("uncertainty")
+    df = make_sources(num_sources=60)
+    write_source_file(df.lazy(), CO2, 2023, p, config=WriterConfig(row_group_size=100))
+    return p
+
+
+def test_monte_carlo(dataset):
+    by = [SECTOR]
+    res = uncertainty.monte_carlo(
+        CO2, 2023, by=by, p=dataset, n_samples=4000, max_elements=50_000
+    )
+    lf = read_source_emissions(CO2, 2023, dataset)
+    expected = (
+        uncertainty.propagate(lf, by)
+        .with_columns(C(SECTOR).cast(pl.String))
+        .sort(by=SECTOR)
+        .collect()
+    )
+    assert res[SECTOR].to_list() == expected[SECTOR].to_list()
+    np.testing.assert_allclose(res[EMISSIONS_QUANTITY], expected[EMISSIONS_QUANTITY])
+    # The sampled means are within a few standard errors of the sums.
+    std_err = expected[uncertainty.EMISSIONS_STD].to_numpy() / np.sqrt(4000)
+    gap = np.abs(res[uncertainty.EMISSIONS_MEAN] - expected[EMISSIONS_QUANTITY])
+    assert (gap.to_numpy() < 5 * std_err).all()
+    np.testing.assert_allclose(
+        res[uncertainty.EMISSIONS_STD], expected[uncertainty.EMISSIONS_STD], rtol=0.1
+    )
+    assert (res[uncertainty.EMISSIONS_Q05] < res[uncertainty.EMISSIONS_Q95]).all()
+
+
+def test_monte_carlo_seed(dataset):
+    def run(seed: int, max_workers: int) -> pl.DataFrame:
+        return uncertainty.monte_carlo(
+            CO2, 2023, p=dataset, n_samples=200, seed=seed, max_workers=max_workers
+        )
+
+    res = run(seed=3, max_workers=1)
+    # The results do not depend on the number of threads.
+    assert_frame_equal(run(seed=3, max_workers=4), res)
+    other = run(seed=4, max_workers=1)
+    assert not other[uncertainty.EMISSIONS_Q95].equals(res[uncertainty.EMISSIONS_Q95])
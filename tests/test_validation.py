@@ -0,0 +1,69 @@
+import polars as pl
+import pytest
+
+from ctrace import validation
+from ctrace.constants import *
+
+
+@pytest.fixture
+def bad_file(tmp_path, make_sources):
+    df = make_sources(num_sources=50).select(pl.exclude("^conf_.*$"))
+    df = df.with_columns(
+        pl.when(pl.int_range(pl.len()) == 0)
+        .then(pl.lit("bogus"))
+        .otherwise(C(SUBSECTOR))
+        .alias(SUBSECTOR),
+        pl.when(pl.int_range(pl.len()) == 1)
+        .then(None)
+        .otherwise(C(SOURCE_ID))
+        .alias(SOURCE_ID),
+        pl.when(pl.int_range(pl.len()) == 2).then(95.0).otherwise(C(LAT)).alias(LAT),
+    )
+    # One record twice.
+    df = pl.concat([df, df.slice(100, 1)])
+    path = tmp_path / "sources.parquet"
+    df.write_parquet(path, row_group_size=128)
+    return path
+
+
+def _result(report: validation.ValidationReport, check: str, column: str) -> dict:
+    [row] = (
+        report.results.filter(
+            (C(validation.CHECK) == check) & (C(validation.COLUMN) == column)
+        )
+        .drop(validation.FILE)
+        .to_dicts()
+    )
+    return row
+
+
+def test_validate_files(bad_file):
+    report = validation.validate_files([bad_file], "sources")
+    assert not report.ok
+    failed = report.failures().select(validation.CHECK, validation.COLUMN).rows()
+    assert sorted(failed) == [
+        (validation.ENUM, SUBSECTOR),
+        (validation.NULLS, SOURCE_ID),
+        (validation.RANGE, LAT),
+        (validation.UNIQUE, f"{SOURCE_ID},{START_TIME},{GAS}"),
+    ]
+    enum = _result(report, validation.ENUM, SUBSECTOR)
+    assert (enum[validation.NUM_FAILED], enum[validation.DETAIL]) == (1, "'bogus' (1)")
+    assert _result(report, validation.NULLS, SOURCE_ID)[validation.NUM_FAILED] == 1
+    lat = _result(report, validation.RANGE, LAT)
+    assert lat[validation.NUM_FAILED] == 1
+    assert lat[validation.NUM_ROWS] == 50 * 12 + 1
+    unique = _result(report, validation.UNIQUE, f"{SOURCE_ID},{START_TIME},{GAS}")
+    assert unique[validation.NUM_FAILED] == 1
+    assert unique[validation.DETAIL].startswith(f"{SOURCE_ID}=8, ")
+    assert _result(report, validation.ENUM, SECTOR)[validation.PASSED]
+
+
+def test_hash_collisions(bad_file, monkeypatch):
+    # A hash with many collisions: only the records with the same key are duplicates.
+    key_hash = validation._key_hash
+    monkeypatch.setattr(validation, "_key_hash", lambda keys: key_hash(keys) % 4)
+    report = validation.validate_files([bad_file], "sources")
+    unique = _result(report, validation.UNIQUE, f"{SOURCE_ID},{START_TIME},{GAS}")
+    assert unique[validation.NUM_FAILED] == 1
+    assert unique[validation.DETAIL].startswith(f"{SOURCE_ID}=8, ")